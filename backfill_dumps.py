@@ -0,0 +1,351 @@
+'''
+Historical backfill from Reddit dump files (NDJSON, optionally zstd-compressed).
+
+The live API only serves recent listings. Monthly or per-subreddit dumps
+(RS_*/RC_*, *_submissions.zst / *_comments.zst) cover the full history. The
+backfill works in two steps:
+
+    python backfill_dumps.py stage dumps/RS_2023-01.zst dumps/RC_2023-01.zst
+    python backfill_dumps.py process --classifier local
+    python backfill_dumps.py status
+
+stage streams each file in DUMP_READ_CHUNK pieces (constant memory, however
+large the file), keeps the submissions and comments of the subreddits in
+subreddits.txt and writes them to a SQLite staging file. The uncompressed
+byte offset of every file is committed together with the rows it produced,
+so an interrupted stage continues from there. zstd streams cannot seek, so
+resuming a .zst file decompresses and discards the part already read.
+Submissions and comments may come from the same or separate files.
+
+backfill.sqlite3
+ ├─ dump_files: path, offset (uncompressed bytes), done, lines, kept
+ ├─ submissions: id, subreddit, created_utc, data (JSON), status (pending / stored / queued / skipped)
+ └─ comments: id, link_id, data (JSON)
+
+process rebuilds each pending submission's comment tree from the staging
+file and runs it through the crawler's own stages (classify_comment_records,
+analyze_new_post, store_new_post and the author/category aggregation), in
+chunks of BACKFILL_CHUNK_POSTS posts with the fetch/classify/persist
+pipeline. Aggregates are committed and statuses saved after every chunk.
+Posts already in Firestore are skipped. Like the crawler, process checks the
+ID index against the Firestore watermark first (IdIndex.claim) and writes a
+new watermark when it is done. With --deferred the chunks go into a
+Gemini batch job instead, applied later with `python crawler.py --apply`.
+
+Reading .zst files needs the optional 'zstandard' package (pip install zstandard).
+'''
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+DUMP_READ_CHUNK = 1 << 22 # Decompressed bytes read from a dump at a time
+STAGE_COMMIT_LINES = 200_000 # Dump lines between staging commits (and offset checkpoints)
+BACKFILL_CHUNK_POSTS = int(os.getenv("BACKFILL_CHUNK_POSTS", "200")) # Posts processed between aggregate commits
+BACKFILL_STAGING_PATH = os.getenv("BACKFILL_STAGING_PATH", "backfill.sqlite3")
+
+
+# --- Reading dumps ---
+@contextlib.contextmanager
+def open_dump(path):
+    """Binary stream of an NDJSON dump, decompressing .zst files on the fly."""
+    with open(path, "rb") as raw:
+        if not path.endswith(".zst"):
+            yield raw
+            return
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("Reading .zst dumps needs the 'zstandard' package (pip install zstandard).")
+        # Reddit dumps are compressed with a long window, above zstandard's default limit
+        with zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(raw) as reader:
+            yield reader
+
+
+def iter_dump_lines(path, start=0, chunk_size=DUMP_READ_CHUNK):
+    """Yields (line, offset after the line) from uncompressed byte `start` on; only one chunk is held in memory."""
+    with open_dump(path) as stream:
+        position = 0
+        if start:
+            if path.endswith(".zst"):
+                while position < start: # No random access into a zstd frame, skip by reading
+                    skipped = stream.read(min(chunk_size, start - position))
+                    if not skipped:
+                        break
+                    position += len(skipped)
+            else:
+                position = stream.seek(start)
+        partial = b""
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                position += len(line) + 1
+                yield line, position
+        if partial.strip():
+            position += len(partial)
+            yield partial, position
+
+
+# --- Staging ---
+def open_staging(path=BACKFILL_STAGING_PATH):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """CREATE TABLE IF NOT EXISTS dump_files (
+               path TEXT PRIMARY KEY, offset INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0,
+               lines INTEGER NOT NULL DEFAULT 0, kept INTEGER NOT NULL DEFAULT 0);
+           CREATE TABLE IF NOT EXISTS submissions (
+               id TEXT PRIMARY KEY, subreddit TEXT NOT NULL, created_utc REAL NOT NULL,
+               data TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending');
+           CREATE INDEX IF NOT EXISTS idx_submissions_pending ON submissions (subreddit, status, created_utc);
+           CREATE TABLE IF NOT EXISTS comments (id TEXT PRIMARY KEY, link_id TEXT NOT NULL, data TEXT NOT NULL);
+           CREATE INDEX IF NOT EXISTS idx_comments_link ON comments (link_id);"""
+    )
+    return conn
+
+
+def stage_dump(conn, path, subreddits):
+    """Copies the submissions/comments of `subreddits` (lowercase names) from one dump into staging, resumably."""
+    conn.execute("INSERT OR IGNORE INTO dump_files (path) VALUES (?)", (path,))
+    offset, done, lines, kept = conn.execute(
+        "SELECT offset, done, lines, kept FROM dump_files WHERE path = ?", (path,)).fetchone()
+    if done:
+        print(f"{path}: already staged ({kept} of {lines} lines kept)")
+        return
+    if offset:
+        print(f"{path}: resuming at byte {offset}")
+    needles = [name.encode("utf-8") for name in subreddits]
+    submission_rows, comment_rows = [], []
+    started = time.time()
+
+    def checkpoint(position, finished=False):
+        conn.executemany("INSERT OR IGNORE INTO submissions (id, subreddit, created_utc, data) VALUES (?, ?, ?, ?)", submission_rows)
+        conn.executemany("INSERT OR IGNORE INTO comments (id, link_id, data) VALUES (?, ?, ?)", comment_rows)
+        conn.execute("UPDATE dump_files SET offset = ?, done = ?, lines = ?, kept = ? WHERE path = ?",
+                     (position, int(finished), lines, kept, path))
+        conn.commit() # Rows and offset in one transaction
+        submission_rows.clear()
+        comment_rows.clear()
+
+    position = offset
+    for line, position in iter_dump_lines(path, offset):
+        lines += 1
+        lowered = line.lower()
+        # Cheap byte test first; almost every line of a full dump belongs to other subreddits
+        if any(needle in lowered for needle in needles):
+            try:
+                data = json.loads(line)
+            except ValueError:
+                data = {}
+            if str(data.get("subreddit", "")).lower() in subreddits and data.get("id"):
+                kept += 1
+                if "link_id" in data: # Comments have link_id, submissions do not
+                    comment_rows.append((data["id"], data["link_id"], json.dumps(data)))
+                else:
+                    submission_rows.append((data["id"], data["subreddit"].lower(), float(data.get("created_utc") or 0), json.dumps(data)))
+        if lines % STAGE_COMMIT_LINES == 0:
+            checkpoint(position)
+            print(f"{path}: {lines} lines, {kept} kept, {position / 1e9:.2f} GB ({time.time() - started:.0f}s)")
+    checkpoint(position, finished=True)
+    print(f"{path}: done, {kept} of {lines} lines kept in {time.time() - started:.0f}s")
+
+
+# --- Records ---
+def post_record_from_dump(data):
+    """Same fields as reddit_fetch.post_record_from."""
+    return {
+        "post_id": data["id"],
+        "title": data.get("title") or "",
+        "author": data.get("author") or "[deleted]",
+        "created_utc": float(data.get("created_utc") or 0),
+        "body": data.get("selftext") or "",
+        "score": int(data.get("score") or 0),
+        "url": data.get("url") or "",
+    }
+
+
+def comment_tree_records(post_record, comments):
+    """
+    Comment records of one submission in breadth-first tree order (siblings
+    oldest first). Replies whose parent is missing from the dump come last.
+    """
+    def created(comment):
+        return float(comment.get("created_utc") or 0)
+
+    children = collections.defaultdict(list)
+    for comment in comments:
+        children[comment.get("parent_id")].append(comment)
+    ordered = []
+    pending = collections.deque(sorted(children.pop(f"t3_{post_record['post_id']}", []), key=created))
+    while pending:
+        comment = pending.popleft()
+        ordered.append(comment)
+        pending.extend(sorted(children.pop(f"t1_{comment['id']}", []), key=created))
+    ordered.extend(sorted((comment for group in children.values() for comment in group), key=created))
+
+    return [{
+        "comment_id": comment["id"],
+        "author": comment.get("author") or "[deleted]",
+        "body": comment.get("body") or "",
+        "score": int(comment.get("score") or 0),
+        "created_utc": created(comment) or post_record["created_utc"], # Fallback to the post time
+    } for comment in ordered if "body" in comment]
+
+
+def staged_posts(conn, subreddit, limit):
+    """The next `limit` pending submissions of `subreddit`, oldest first, as (post_record, comment_records)."""
+    rows = conn.execute(
+        "SELECT data FROM submissions WHERE subreddit = ? AND status = 'pending' ORDER BY created_utc LIMIT ?",
+        (subreddit, limit)).fetchall()
+    for (data,) in rows:
+        post_record = post_record_from_dump(json.loads(data))
+        comments = [json.loads(comment) for (comment,) in conn.execute(
+            "SELECT data FROM comments WHERE link_id = ?", (f"t3_{post_record['post_id']}",))]
+        yield post_record, comment_tree_records(post_record, comments)
+
+
+def set_status(conn, post_ids, status):
+    conn.executemany("UPDATE submissions SET status = ? WHERE id = ?", [(status, post_id) for post_id in post_ids])
+    conn.commit()
+
+
+# --- Processing ---
+def process_subreddit(conn, crawler, model, subreddit_name, job=None, max_posts=None):
+    """Runs the pending staged posts of one subreddit through the crawler's stages. Returns posts handled."""
+    subreddit = subreddit_name.lower()
+    refs = crawler.get_collections(subreddit_name)
+    crawler.get_telemetry().set_subreddit(subreddit_name)
+    handled = 0
+    while max_posts is None or handled < max_posts:
+        chunk_size = BACKFILL_CHUNK_POSTS if max_posts is None else min(BACKFILL_CHUNK_POSTS, max_posts - handled)
+        chunk = list(staged_posts(conn, subreddit, chunk_size))
+        if not chunk:
+            break
+        started = time.time()
+
+        # Posts the live crawler (or an earlier backfill) already stored
+        post_refs = {record["post_id"]: refs["posts"].document(record["post_id"]) for record, _ in chunk}
+        stored = crawler.find_stored(list(post_refs.values()))
+        skipped = [post_id for post_id, ref in post_refs.items() if ref.path in stored]
+        chunk = [(post_record, comments) for post_record, comments in chunk if post_refs[post_record["post_id"]].path not in stored]
+        set_status(conn, skipped, "skipped")
+
+        persisted = []
+        if job is not None:
+            for post_record, comment_records in chunk:
+                crawler.defer_comment_classifications(job, comment_records)
+                crawler.defer_post_analysis(job, post_record, comment_records)
+                job.add_record({"type": "post", "subreddit": subreddit_name, "post": post_record, "comments": comment_records})
+            set_status(conn, [post_record["post_id"] for post_record, _ in chunk], "queued")
+        else:
+            author_updates, category_updates = crawler.new_aggregation_stores()
+
+            def classify(item):
+                post_record, comment_records = item
+                context = f"[{subreddit_name}] backfill post {post_record['post_id']}"
+                classifications = crawler.classify_comment_records(
+                    model, refs, comment_records, context=context, post_id=post_record["post_id"])
+                analysis = crawler.analyze_new_post(model, refs, post_record, comment_records, context=context)
+                return post_record, comment_records, classifications, analysis
+
+            def persist(item):
+                post_record, comment_records, classifications, analysis = item
+                crawler.store_new_post(refs, subreddit_name, post_record, comment_records, classifications, analysis,
+                                       author_updates, category_updates)
+                persisted.append(post_record["post_id"])
+
+            crawler.run_pipeline(iter(chunk), [classify, persist], context=f"[{subreddit_name}] backfill")
+            crawler.commit_author_stats(author_updates, refs)
+            crawler.commit_category_stats_non_transactional(category_updates, refs)
+            set_status(conn, persisted, "stored") # Failed posts stay pending for the next run
+
+        handled += len(chunk) + len(skipped)
+        print(f"[{subreddit_name}] Backfill chunk: {len(chunk)} posts processed, {len(skipped)} already stored "
+              f"({time.time() - started:.1f}s)")
+        if job is None and chunk and not persisted:
+            logging.error(f"[{subreddit_name}] No post of a backfill chunk could be stored, stopping")
+            break # Every post failed; retrying the same chunk would loop forever
+    return handled
+
+
+def print_status(conn):
+    for path, offset, done, lines, kept in conn.execute("SELECT path, offset, done, lines, kept FROM dump_files ORDER BY path"):
+        print(f"{path}: {'done' if done else 'partial'}, {offset / 1e9:.2f} GB read, {kept} of {lines} lines kept")
+    for subreddit, status, count in conn.execute(
+            "SELECT subreddit, status, COUNT(*) FROM submissions GROUP BY subreddit, status ORDER BY subreddit, status"):
+        print(f"r/{subreddit}: {count} {status}")
+    print(f"{conn.execute('SELECT COUNT(*) FROM comments').fetchone()[0]} comments staged")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill subreddit history from Reddit dump files.")
+    parser.add_argument("--staging", default=BACKFILL_STAGING_PATH, help="SQLite staging file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stage_parser = commands.add_parser("stage", help="Stream dump files into the staging file (resumable)")
+    stage_parser.add_argument("dumps", nargs="+", help="NDJSON dump files (.zst or plain)")
+    stage_parser.add_argument("--subreddits", default="subreddits.txt", help="File with one subreddit per line")
+    process_parser = commands.add_parser("process", help="Classify and store staged posts")
+    process_parser.add_argument("--subreddits", default="subreddits.txt", help="File with one subreddit per line")
+    process_parser.add_argument("--max-posts", type=int, help="Stop after this many posts per subreddit")
+    process_parser.add_argument("--deferred", action="store_true", help="Write a Gemini batch job instead of calling the API")
+    process_parser.add_argument("--runner", choices=["gemini", "local"], default=os.getenv("BATCH_JOB_RUNNER", "gemini"))
+    process_parser.add_argument("--jobs-dir", default=os.getenv("BATCH_JOBS_DIR", "jobs"))
+    process_parser.add_argument("--classifier", choices=["gemini", "local"],
+                                default=os.getenv("CLASSIFIER_BACKEND", "gemini"), help="Comment classifier backend")
+    commands.add_parser("status", help="Show staging progress")
+    args = parser.parse_args()
+
+    conn = open_staging(args.staging)
+    try:
+        if args.command == "stage":
+            with open(args.subreddits) as f:
+                subreddits = {line.strip().lower() for line in f if line.strip()}
+            for path in args.dumps:
+                stage_dump(conn, path, subreddits)
+        elif args.command == "process":
+            import crawler # Initializes Reddit and Firebase
+            import classifier_backends
+            from batch_jobs import BatchJob, LocalJobRunner, GeminiJobRunner
+            from id_index import IdIndex
+            from llm_cache import LLMCache
+            from prompt_models import PromptModels
+
+            crawler.genai.configure(api_key=crawler.GOOGLE_GEMINI_API_KEY)
+            model = PromptModels("gemini-2.5-flash-lite")
+            crawler.llm_cache = LLMCache(os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'))
+            crawler.comment_classifier = classifier_backends.create_backend(
+                args.classifier, gemini_classify=lambda items, context="": crawler.classify_comments(model, items, context=context))
+            if crawler.ID_INDEX:
+                crawler.id_index = IdIndex(os.getenv('ID_INDEX_PATH', 'id_index.sqlite3'))
+                crawler.id_index.claim(crawler.db, "reddit") # Same index file and watermark as the Reddit crawler
+            job = BatchJob.create(args.jobs_dir) if args.deferred else None
+            try:
+                for subreddit_name in crawler.load_subreddits(args.subreddits):
+                    print(f"\n--- Backfilling r/{subreddit_name} ---")
+                    handled = process_subreddit(conn, crawler, model, subreddit_name, job=job, max_posts=args.max_posts)
+                    print(f"[{subreddit_name}] {handled} staged posts handled")
+            finally:
+                if job is not None:
+                    job.close()
+                    if job.request_count:
+                        (LocalJobRunner(model) if args.runner == "local" else GeminiJobRunner(crawler.GOOGLE_GEMINI_API_KEY, model.model_name)).submit(job)
+                    else:
+                        job.save_state(status="succeeded")
+                    print(f"Batch job {job.job_dir}: {job.request_count} requests. "
+                          f"Run `python crawler.py --apply {job.job_dir}` once it has finished.")
+                crawler.comment_classifier.close()
+                crawler.llm_cache.close()
+                if crawler.id_index is not None:
+                    crawler.id_index.stamp(crawler.db, "reddit") # Copies of the index without these posts are stale now
+                    crawler.id_index.close()
+                model.close()
+        print_status(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,215 @@
+'''
+Offline (deferred) Gemini jobs stored as JSONL files.
+
+A deferred crawl does not call Gemini. It writes every classification and
+summary prompt to a job directory and submits the whole file as one bulk job.
+Later, `python crawler.py --apply <job_dir>` reads the responses and folds
+them into Firestore through the normal aggregation code.
+
+jobs/<job_id>/ (directory)
+ ├─ job.json         state: created / submitted / succeeded / failed / applied, runner, remote job name
+ ├─ requests.jsonl   {"key": ..., "request": {"contents": [...], "system_instruction": ..., "generation_config": ...}}
+ ├─ manifest.jsonl   crawled posts/comments needed to apply the results
+ └─ responses.jsonl  {"key": ..., "response": {"candidates": [...]}} or {"key": ..., "error": ...}
+
+The request/response line format follows the Gemini Batch API, so the same
+files work with GeminiJobRunner (real bulk submission, needs the optional
+`google-genai` package) and with LocalJobRunner, a file-based stand-in that
+executes the requests itself for testing.
+'''
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+class BatchJob:
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.state_path = os.path.join(job_dir, "job.json")
+        self.requests_path = os.path.join(job_dir, "requests.jsonl")
+        self.manifest_path = os.path.join(job_dir, "manifest.jsonl")
+        self.responses_path = os.path.join(job_dir, "responses.jsonl")
+        self._requests_file = None
+        self._manifest_file = None
+        self.request_count = 0
+        self._lock = threading.Lock() # Parallel crawl workers write to the same job
+
+    @classmethod
+    def create(cls, jobs_root="jobs"):
+        # The random suffix keeps jobs created in the same second (e.g. a crawl and a backfill) apart
+        job_id = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        job = cls(os.path.join(jobs_root, job_id))
+        os.makedirs(job.job_dir, exist_ok=False)
+        job.save_state(status="created", created=time.time())
+        return job
+
+    # --- State ---
+    def load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, **fields):
+        state = self.load_state()
+        state.update(fields)
+        with open(self.state_path, "w") as f:
+            json.dump(state, f, indent=2)
+        return state
+
+    # --- Writing (during the deferred crawl) ---
+    def add_request(self, key, prompt, generation_config=None, system_instruction=None):
+        line = {"key": key, "request": {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}}
+        if system_instruction:
+            line["request"]["system_instruction"] = {"parts": [{"text": system_instruction}]}
+        if generation_config is not None:
+            line["request"]["generation_config"] = generation_config
+        with self._lock:
+            if self._requests_file is None:
+                self._requests_file = open(self.requests_path, "a", encoding="utf-8")
+            self._requests_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.request_count += 1
+
+    def add_record(self, record):
+        with self._lock:
+            if self._manifest_file is None:
+                self._manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+            self._manifest_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        for f in (self._requests_file, self._manifest_file):
+            if f is not None:
+                f.close()
+        self._requests_file = None
+        self._manifest_file = None
+
+    # --- Reading (during apply) ---
+    def iter_requests(self):
+        if not os.path.exists(self.requests_path):
+            return
+        with open(self.requests_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def iter_records(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def load_responses(self):
+        """Returns {key: response text} for every successful response line."""
+        responses = {}
+        errors = 0
+        if not os.path.exists(self.responses_path):
+            return responses
+        with open(self.responses_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                text = response_text(item.get("response"))
+                if text:
+                    responses[item["key"]] = text
+                else:
+                    errors += 1
+        if errors:
+            logging.error(f"Batch job {self.job_dir}: {errors} responses missing or failed.")
+        return responses
+
+
+def response_text(response):
+    """Joins the text parts of the first candidate of a GenerateContentResponse dict."""
+    if not response:
+        return ""
+    try:
+        parts = response["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    return "".join(part.get("text", "") for part in parts).strip()
+
+
+class LocalJobRunner:
+    """
+    File-based stand-in for the bulk API: executes every request with `model`
+    (anything with generate_content, e.g. a GenerativeModel or a stub) and
+    writes responses.jsonl in the Batch API format.
+    """
+    name = "local"
+
+    def __init__(self, model):
+        self.model = model
+
+    def submit(self, job):
+        job.save_state(status="submitted", runner=self.name, submitted=time.time())
+        with open(job.responses_path, "w", encoding="utf-8") as out:
+            for item in job.iter_requests():
+                prompt = item["request"]["contents"][0]["parts"][0]["text"]
+                generation_config = item["request"].get("generation_config")
+                system_instruction = (item["request"].get("system_instruction") or {}).get("parts", [{}])[0].get("text")
+                model = self.model
+                if system_instruction:
+                    if hasattr(model, "for_template"):
+                        model = model.for_template(system_instruction)
+                    else:
+                        prompt = system_instruction + prompt
+                try:
+                    if generation_config is not None:
+                        reply = model.generate_content(prompt, generation_config=generation_config)
+                    else:
+                        reply = model.generate_content(prompt)
+                    line = {"key": item["key"], "response": {"candidates": [{"content": {"parts": [{"text": reply.text}]}}]}}
+                except Exception as e:
+                    line = {"key": item["key"], "error": {"message": str(e)}}
+                out.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return job.save_state(status="succeeded", finished=time.time())
+
+    def fetch(self, job):
+        return job.load_state()
+
+
+class GeminiJobRunner:
+    """Submits the requests file to the Gemini Batch API and downloads the results."""
+    name = "gemini"
+
+    def __init__(self, api_key, model_name):
+        try:
+            from google import genai as google_genai
+        except ImportError:
+            raise RuntimeError("GeminiJobRunner needs the 'google-genai' package (pip install google-genai).")
+        self.client = google_genai.Client(api_key=api_key)
+        self.model_name = model_name
+
+    def submit(self, job):
+        uploaded = self.client.files.upload(
+            file=job.requests_path,
+            config={"display_name": os.path.basename(job.job_dir), "mime_type": "jsonl"},
+        )
+        remote = self.client.batches.create(
+            model=self.model_name,
+            src=uploaded.name,
+            config={"display_name": f"tpcraw-{os.path.basename(job.job_dir)}"},
+        )
+        return job.save_state(status="submitted", runner=self.name, remote_name=remote.name, submitted=time.time())
+
+    def fetch(self, job):
+        """Polls the remote job once; downloads responses.jsonl when it has finished."""
+        state = job.load_state()
+        remote = self.client.batches.get(name=state["remote_name"])
+        remote_state = remote.state.name
+        if remote_state == "JOB_STATE_SUCCEEDED":
+            content = self.client.files.download(file=remote.dest.file_name)
+            with open(job.responses_path, "wb") as f:
+                f.write(content)
+            return job.save_state(status="succeeded", finished=time.time())
+        if remote_state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            return job.save_state(status="failed", remote_state=remote_state)
+        return job.save_state(remote_state=remote_state)
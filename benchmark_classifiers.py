@@ -0,0 +1,118 @@
+'''
+Benchmarks classifier backends against stored Gemini labels.
+
+Samples comments that the crawler already labelled with Gemini (from
+Firestore, or from a JSONL file with body/sentiment/emotion/category/iit
+fields), runs every requested backend over the texts and reports throughput
+(comments/sec) and agreement with the stored labels, per field and for all
+four fields at once:
+
+    python benchmark_classifiers.py --backends local,fake --sample 500
+    python benchmark_classifiers.py --from-jsonl sample.jsonl --backends local --json results.json
+
+Running the gemini backend as well re-classifies the sample with the current
+prompts, which shows how stable Gemini itself is on the same texts.
+'''
+import argparse
+import json
+import time
+
+import classification_schema
+import classifier_backends
+
+FIELDS = ["sentiment", "emotion", "category", "iit"]
+
+
+def label_tuple(data):
+    """Stored comment fields as a classification tuple (categories lowercased like the parser does)."""
+    category = classification_schema.normalize_category(data.get("category")) or str(data.get("category"))
+    return (data.get("sentiment"), str(data.get("emotion", "")).lower(), category, str(data.get("iit", "")).lower())
+
+
+def sample_from_firestore(sample_size):
+    import crawler
+    items = []
+    for snapshot in crawler.db.collection_group("comments").limit(sample_size * 2).stream():
+        data = snapshot.to_dict() or {}
+        if not data.get("body") or data.get("category") in (None, "Uncategorized"):
+            continue # Unlabelled or defaulted comments say nothing about agreement
+        items.append((snapshot.reference.path, data["body"], label_tuple(data)))
+        if len(items) >= sample_size:
+            break
+    return items
+
+
+def sample_from_jsonl(path, sample_size):
+    items = []
+    with open(path) as f:
+        for index, line in enumerate(f):
+            if len(items) >= sample_size:
+                break
+            if line.strip():
+                data = json.loads(line)
+                items.append((str(data.get("id", index)), data.get("body", ""), label_tuple(data)))
+    return items
+
+
+def benchmark_backend(backend, items):
+    start = time.perf_counter()
+    results = backend.classify([(item_id, body) for item_id, body, _ in items], context="[benchmark]")
+    elapsed = time.perf_counter() - start
+
+    matches = dict.fromkeys(FIELDS + ["all"], 0)
+    for item_id, _, reference in items:
+        predicted = results.get(item_id, classification_schema.DEFAULT_CLASSIFICATION)
+        for field, ours, theirs in zip(FIELDS, predicted, reference):
+            matches[field] += ours == theirs
+        matches["all"] += tuple(predicted) == reference
+    count = len(items)
+    return {
+        "backend": backend.name,
+        "comments": count,
+        "seconds": round(elapsed, 3),
+        "commentsPerSecond": round(count / elapsed, 1) if elapsed else 0,
+        "agreement": {field: round(matches[field] / count * 100, 1) if count else 0 for field in matches},
+    }
+
+
+def create_backend(name):
+    if name != "gemini":
+        return classifier_backends.create_backend(name, allow_fake=True) # Labels are only compared, never stored
+    import crawler
+    from llm_cache import LLMCache
+    from prompt_models import PromptModels
+    crawler.genai.configure(api_key=crawler.GOOGLE_GEMINI_API_KEY)
+    model = PromptModels("gemini-2.5-flash-lite")
+    crawler.llm_cache = LLMCache(":memory:") # Fresh answers, not the replies the labels came from
+    return classifier_backends.create_backend(
+        "gemini", gemini_classify=lambda items, context="": crawler.classify_comments(model, items, context=context))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare classifier backends on throughput and agreement with Gemini labels.")
+    parser.add_argument("--backends", default="local,fake", help="Comma-separated backends (gemini, local, fake)")
+    parser.add_argument("--sample", type=int, default=500, help="Number of labelled comments to sample")
+    parser.add_argument("--from-jsonl", metavar="PATH", help="Read the sample from a JSONL file instead of Firestore")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    items = sample_from_jsonl(args.from_jsonl, args.sample) if args.from_jsonl else sample_from_firestore(args.sample)
+    print(f"Sampled {len(items)} labelled comments.")
+
+    results = []
+    for name in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        backend = create_backend(name)
+        try:
+            results.append(benchmark_backend(backend, items))
+        finally:
+            backend.close()
+
+    print(f"{'backend':<10}{'comments/s':>12}{'sentiment':>11}{'emotion':>9}{'category':>10}{'iit':>8}{'all':>8}")
+    for result in results:
+        agreement = result["agreement"]
+        percents = {field: f"{value}%" for field, value in agreement.items()}
+        print(f"{result['backend']:<10}{result['commentsPerSecond']:>12}{percents['sentiment']:>11}{percents['emotion']:>9}"
+              f"{percents['category']:>10}{percents['iit']:>8}{percents['all']:>8}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
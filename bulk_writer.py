@@ -0,0 +1,273 @@
+'''
+Shared Firestore bulk write layer for the crawlers and the database patches.
+
+Callers queue writes on a BulkWriter instead of filling db.batch() by hand:
+
+    with BulkWriter(db, context="[sgexams] comments") as writer:
+        for ref, data in documents:
+            writer.set(ref, data)
+    # every write has been committed (or counted as failed) here
+
+Queued writes are cut into batches of `batch_size` operations, and the
+batches are committed in parallel on a process-wide pool of
+BULK_WRITE_WORKERS threads. Batches are applied independently and in no
+particular order, so writes to the same document should be separated by a
+flush().
+
+A batch that fails with a transient error (rate limits, contention,
+timeouts, server errors; see rate_limiter.is_retryable_error) is retried
+with exponential backoff. A batch that fails for any other reason is split,
+and its writes are retried one by one, so one bad write does not take the
+rest of its batch down with it. Only writes that still fail are dropped. They
+are logged with their document path and counted in the process-wide
+WriteStats (get_write_stats()), which the crawlers print at the end of a run.
+
+After a transient error, the batch may or may not have been applied. Writing
+the same values again is harmless, but Increment, ArrayUnion and ArrayRemove
+transforms could be applied twice. Batches that contain them are therefore
+not retried after a transient error. Their writes are counted as failed.
+Counters that must not be lost or doubled should be written outside a
+BulkWriter, in a transaction.
+
+Throughput follows Firestore's "500/50/5" ramp-up rule: at most
+BULK_WRITE_INITIAL_OPS writes per second at first, then 50% more after every
+five minutes of writing, up to BULK_WRITE_MAX_OPS. The limit is shared by all
+writers in the process, so parallel crawl workers ramp up together instead
+of hotspotting a fresh collection.
+
+With an IdIndex as `index`, the paths of documents set() are added to it
+once their batch has been committed.
+'''
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from google.cloud.firestore_v1 import transforms as firestore_transforms
+except ImportError:  # google-cloud-firestore ships with firebase-admin, but keep this module importable on its own
+    firestore_transforms = None
+
+from rate_limiter import TokenBucket, is_retryable_error, retry_after_seconds, backoff_delay
+
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", "400")) # Operations per batch (Firestore allows 500)
+BULK_WRITE_WORKERS = int(os.getenv("BULK_WRITE_WORKERS", "4")) # Batches committed in parallel, process-wide
+BULK_WRITE_MAX_ATTEMPTS = int(os.getenv("BULK_WRITE_MAX_ATTEMPTS", "5")) # Tries per batch for transient errors
+BULK_WRITE_INITIAL_OPS = float(os.getenv("BULK_WRITE_INITIAL_OPS", "500")) # Writes per second before ramping up
+BULK_WRITE_MAX_OPS = float(os.getenv("BULK_WRITE_MAX_OPS", "10000")) # Ceiling of the ramp-up (0 disables throttling)
+BULK_WRITE_RAMP_SECONDS = 300 # Throughput grows by BULK_WRITE_RAMP_FACTOR after this much writing
+BULK_WRITE_RAMP_FACTOR = 1.5
+MAX_RECORDED_FAILURES = 100 # Failed document paths kept for the end-of-run summary
+
+
+def has_repeat_unsafe_transform(value):
+    """True if `value` (write data, nested dicts/lists included) contains an Increment, ArrayUnion or ArrayRemove."""
+    if firestore_transforms is None:
+        return False
+    if isinstance(value, (firestore_transforms.Increment, firestore_transforms.ArrayUnion, firestore_transforms.ArrayRemove)):
+        return True
+    if isinstance(value, dict):
+        return any(has_repeat_unsafe_transform(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_repeat_unsafe_transform(item) for item in value)
+    return False
+
+
+class RampingBucket(TokenBucket):
+    """TokenBucket (per second) whose rate grows by `factor` every `ramp_seconds` since the first write."""
+
+    def __init__(self, initial_per_second, max_per_second, ramp_seconds=BULK_WRITE_RAMP_SECONDS, factor=BULK_WRITE_RAMP_FACTOR):
+        super().__init__(initial_per_second * 60, capacity=initial_per_second)
+        self.initial_per_second = initial_per_second
+        self.max_per_second = max_per_second
+        self.ramp_seconds = ramp_seconds
+        self.factor = factor
+        self.started = None
+
+    def acquire(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            if self.started is None:
+                self.started = now
+            steps = int((now - self.started) // self.ramp_seconds)
+            rate = min(self.max_per_second, self.initial_per_second * self.factor ** steps)
+            if rate != self.rate_per_second:
+                self._refill() # Tokens earned so far at the old rate
+                self.rate_per_second = rate
+                self.capacity = rate
+        return super().acquire(amount)
+
+
+class WriteStats:
+    """Process-wide counts of committed and failed writes."""
+
+    def __init__(self):
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+        self.split_batches = 0
+        self.failures = [] # (document path, error), at most MAX_RECORDED_FAILURES
+        self._lock = threading.Lock()
+
+    def record(self, committed=0, failed=(), batches=0, retries=0, split_batches=0):
+        with self._lock:
+            self.committed += committed
+            self.failed += len(failed)
+            self.batches += batches
+            self.retries += retries
+            self.split_batches += split_batches
+            room = MAX_RECORDED_FAILURES - len(self.failures)
+            if room > 0:
+                self.failures.extend(failed[:room])
+
+    def summary(self):
+        with self._lock:
+            return {"committed": self.committed, "failed": self.failed, "batches": self.batches,
+                    "retries": self.retries, "splitBatches": self.split_batches}
+
+
+class BulkWriter:
+    def __init__(self, db, index=None, context="", batch_size=BULK_WRITE_BATCH_SIZE, max_attempts=BULK_WRITE_MAX_ATTEMPTS):
+        self.db = db
+        self.index = index
+        self.context = context
+        self.batch_size = max(1, min(batch_size, 500))
+        self.max_attempts = max(1, max_attempts)
+        self.committed = 0 # Writes of this writer, for callers that report their own counts
+        self.failed = 0
+        self._pending = [] # (method, reference, args)
+        self._futures = []
+        self._lock = threading.Lock()
+
+    # --- Queueing ---
+    def set(self, reference, document_data, merge=False):
+        self._add(("set", reference, (document_data, merge)))
+
+    def update(self, reference, field_updates):
+        self._add(("update", reference, (field_updates,)))
+
+    def delete(self, reference):
+        self._add(("delete", reference, ()))
+
+    def _add(self, operation):
+        with self._lock:
+            self._pending.append(operation)
+            if len(self._pending) < self.batch_size:
+                return
+            operations, self._pending = self._pending, []
+            self._futures.append(get_executor().submit(self._commit, operations))
+
+    def flush(self):
+        """Commits everything queued and waits for it. Returns (committed, failed) of this writer so far."""
+        with self._lock:
+            if self._pending:
+                operations, self._pending = self._pending, []
+                self._futures.append(get_executor().submit(self._commit, operations))
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result() # _commit() handles its own errors
+        return self.committed, self.failed
+
+    def close(self):
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.flush()
+        return False
+
+    # --- Committing ---
+    def _try_commit(self, operations):
+        """
+        Commits `operations` as one batch, retrying transient errors unless the
+        batch has transforms that a second commit could apply twice.
+        Returns (error or None, retries, whether the error was transient).
+        """
+        retries = 0
+        repeat_unsafe = any(has_repeat_unsafe_transform(args) for _, _, args in operations)
+        for attempt in range(self.max_attempts):
+            bucket = get_write_bucket()
+            if bucket is not None:
+                bucket.acquire(len(operations))
+            try:
+                batch = self.db.batch()
+                for method, reference, args in operations:
+                    getattr(batch, method)(reference, *args)
+            except Exception as e:
+                return e, retries, False # Invalid write data, sending it again will not help
+            try:
+                batch.commit()
+                return None, retries, False
+            except Exception as e:
+                transient = is_retryable_error(e)
+                if not transient or attempt + 1 >= self.max_attempts:
+                    return e, retries, transient
+                if repeat_unsafe:
+                    logging.error(f"{self.context} Batch of {len(operations)} writes with increments/array transforms "
+                                  f"failed ({e}); not retried, it may already have been applied")
+                    return e, retries, transient
+                retries += 1
+                delay = retry_after_seconds(e) or backoff_delay(attempt, base_delay=1.0, max_delay=30.0)
+                logging.warning(f"{self.context} Batch of {len(operations)} writes failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _commit(self, operations):
+        error, retries, transient = self._try_commit(operations)
+        committed, failed, split = [], [], 0
+        if error is None:
+            committed = operations
+        elif len(operations) > 1 and not transient:
+            # Usually a single bad write (missing document, oversized value): find it
+            split = 1
+            logging.warning(f"{self.context} Batch of {len(operations)} writes failed ({error}), retrying them one by one")
+            for operation in operations:
+                single_error, single_retries, _ = self._try_commit([operation])
+                retries += single_retries
+                if single_error is None:
+                    committed.append(operation)
+                else:
+                    failed.append((operation[1].path, str(single_error)))
+        else:
+            failed = [(reference.path, str(error)) for _, reference, _ in operations]
+
+        for path, message in failed:
+            logging.error(f"{self.context} Write to {path} failed: {message}")
+        if self.index is not None:
+            self.index.add(reference.path for method, reference, _ in committed if method == "set")
+        with self._lock:
+            self.committed += len(committed)
+            self.failed += len(failed)
+        get_write_stats().record(committed=len(committed), failed=failed, batches=1, retries=retries, split_batches=split)
+
+
+# --- Process-wide state ---
+_executor = None
+_bucket = None
+_stats = WriteStats()
+_state_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _state_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, BULK_WRITE_WORKERS), thread_name_prefix="bulk-write")
+        return _executor
+
+
+def get_write_bucket():
+    global _bucket
+    with _state_lock:
+        if _bucket is None:
+            if BULK_WRITE_MAX_OPS <= 0:
+                return None
+            _bucket = RampingBucket(BULK_WRITE_INITIAL_OPS, BULK_WRITE_MAX_OPS)
+        return _bucket
+
+
+def get_write_stats():
+    return _stats
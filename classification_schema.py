@@ -0,0 +1,202 @@
+'''
+Schema-constrained classification replies from Gemini.
+
+Classification prompts ask for JSON, and every request carries a response
+schema (response_mime_type "application/json") whose emotion, category and iit
+fields are enums, so the model can only answer with known labels. Replies are
+still validated locally: anything that does not match the schema raises
+ClassificationError, which lets the crawlers re-ask just the failed items
+instead of silently storing neutral/"Uncategorized" defaults.
+
+Categories are stored lowercase, as the crawlers always have; common spelling
+variants ("exam", "student-life", "CCAs", ...) are mapped onto the enum.
+Parse outcomes are counted per request kind and reported through stats().
+'''
+import copy
+import json
+import threading
+from collections import Counter, defaultdict
+
+EMOTIONS = ["happy", "relief", "stress", "frustration", "pride", "disappointment", "confusion", "neutral"]
+CATEGORIES = [
+    "academic", "exams", "facilities", "subjects", "administration", "career", "admission", "results", "internship",
+    "lecturer", "student life", "infrastructure", "classroom", "events", "cca",
+]
+IIT_VALUES = ["yes", "no"]
+
+# Used when an item still fails validation after all re-asks
+DEFAULT_CLASSIFICATION = (0, "Neutral", "Uncategorized", "no")
+
+CATEGORY_ALIASES = {
+    "academics": "academic", "exam": "exams", "examination": "exams", "examinations": "exams",
+    "facility": "facilities", "subject": "subjects", "module": "subjects", "modules": "subjects",
+    "admin": "administration", "careers": "career", "admissions": "admission", "result": "results",
+    "internships": "internship", "lecturers": "lecturer", "studentlife": "student life",
+    "classrooms": "classroom", "event": "events", "ccas": "cca",
+}
+
+_CLASSIFICATION_PROPERTIES = {
+    "sentiment": {"type": "INTEGER", "description": "1 for positive, -1 for negative, 0 for neutral"},
+    "emotion": {"type": "STRING", "format": "enum", "enum": EMOTIONS},
+    "category": {"type": "STRING", "format": "enum", "enum": CATEGORIES},
+    "iit": {"type": "STRING", "format": "enum", "enum": IIT_VALUES},
+}
+_CLASSIFICATION_FIELDS = ["sentiment", "emotion", "category", "iit"]
+
+CLASSIFICATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": _CLASSIFICATION_PROPERTIES,
+    "required": _CLASSIFICATION_FIELDS,
+}
+BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict({"id": {"type": "STRING"}}, **_CLASSIFICATION_PROPERTIES),
+        "required": ["id"] + _CLASSIFICATION_FIELDS,
+    },
+}
+POST_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": dict(_CLASSIFICATION_PROPERTIES, summary={"type": "STRING"}),
+    "required": _CLASSIFICATION_FIELDS + ["summary"],
+}
+
+
+class ClassificationError(ValueError):
+    """A reply (or one item of it) does not match the classification schema."""
+
+
+def json_generation_config(schema):
+    """generation_config for a JSON reply constrained to `schema` (plain dict, also valid in batch request files)."""
+    return {"response_mime_type": "application/json", "response_schema": copy.deepcopy(schema)}
+
+
+def load_json_reply(response_text):
+    """Decodes a JSON reply from Gemini, tolerating a surrounding markdown code fence. Raises ValueError."""
+    text = response_text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.lower().startswith("json"):
+            text = text[4:]
+    return json.loads(text)
+
+
+def normalize_category(category):
+    """Maps a category label onto the enum (lowercase), or returns None if it is not a known category."""
+    key = " ".join(str(category or "").strip().lower().replace("-", " ").replace("_", " ").split())
+    key = CATEGORY_ALIASES.get(key, CATEGORY_ALIASES.get(key.replace(" ", ""), key))
+    return key if key in CATEGORIES else None
+
+
+def validate_classification(item):
+    """
+    Validates a {sentiment, emotion, category, iit} object against the schema.
+    Returns (sentiment, emotion, category, iit_flag); raises ClassificationError.
+    """
+    if not isinstance(item, dict):
+        raise ClassificationError(f"expected a JSON object, got {type(item).__name__}")
+
+    sentiment = item.get("sentiment")
+    if isinstance(sentiment, str) and sentiment.strip().lstrip("+-").isdigit():
+        sentiment = int(sentiment.strip())
+    if isinstance(sentiment, bool) or sentiment not in (-1, 0, 1):
+        raise ClassificationError(f"invalid sentiment {item.get('sentiment')!r}")
+
+    emotion = str(item.get("emotion") or "").strip().lower()
+    if emotion not in EMOTIONS:
+        raise ClassificationError(f"invalid emotion {item.get('emotion')!r}")
+
+    category = normalize_category(item.get("category"))
+    if category is None:
+        raise ClassificationError(f"invalid category {item.get('category')!r}")
+
+    iit_flag = item.get("iit")
+    if isinstance(iit_flag, bool):
+        iit_flag = "yes" if iit_flag else "no"
+    iit_flag = str(iit_flag or "").strip().lower()
+    if iit_flag not in IIT_VALUES:
+        raise ClassificationError(f"invalid iit flag {item.get('iit')!r}")
+
+    return int(sentiment), emotion, category, iit_flag
+
+
+def parse_classification(response_text):
+    """Parses a single-object classification reply. Raises ClassificationError."""
+    try:
+        item = load_json_reply(response_text)
+    except ValueError as e:
+        raise ClassificationError(f"invalid JSON: {e}")
+    return validate_classification(item)
+
+
+def parse_analysis(response_text):
+    """Parses a classification + "summary" reply. Returns (..., summary); raises ClassificationError."""
+    try:
+        item = load_json_reply(response_text)
+    except ValueError as e:
+        raise ClassificationError(f"invalid JSON: {e}")
+    classification = validate_classification(item)
+    summary = str(item.get("summary") or "").strip()
+    if not summary:
+        raise ClassificationError("missing summary")
+    return classification + (summary,)
+
+
+def parse_batch_classification(response_text):
+    """
+    Parses a batch reply (JSON array of objects with "id").
+    Returns ({id: classification} for valid items, {id: error message} for invalid ones).
+    Raises ClassificationError when the reply as a whole is not a JSON array.
+    """
+    try:
+        items = load_json_reply(response_text)
+    except ValueError as e:
+        raise ClassificationError(f"invalid JSON: {e}")
+    if not isinstance(items, list):
+        raise ClassificationError("expected a JSON array")
+
+    results = {}
+    errors = {}
+    for item in items:
+        if not isinstance(item, dict) or "id" not in item:
+            continue
+        try:
+            results[str(item["id"])] = validate_classification(item)
+        except ClassificationError as e:
+            errors[str(item["id"])] = str(e)
+    return results, errors
+
+
+# --- Parse-failure statistics ---
+_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+
+
+def record(kind, parsed=0, failed=0, gave_up=0):
+    """Counts parse outcomes for a request kind ("comment", "post", ...); gave_up = items left at defaults."""
+    with _stats_lock:
+        counter = _stats[kind]
+        counter["parsed"] += parsed
+        counter["failed"] += failed
+        counter["gaveUp"] += gave_up
+
+
+def stats():
+    """{kind: {"parsed", "failed", "gaveUp", "failureRate"}} with failureRate in percent of parse attempts."""
+    with _stats_lock:
+        result = {}
+        for kind, counter in _stats.items():
+            attempts = counter["parsed"] + counter["failed"]
+            result[kind] = {
+                "parsed": counter["parsed"],
+                "failed": counter["failed"],
+                "gaveUp": counter["gaveUp"],
+                "failureRate": round(counter["failed"] / attempts * 100, 1) if attempts else 0,
+            }
+        return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
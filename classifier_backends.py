@@ -0,0 +1,229 @@
+'''
+Pluggable comment classifier backends.
+
+Every backend turns (comment_id, text) pairs into
+{comment_id: (sentiment, emotion, category, iit_flag)}, the same tuples the
+Gemini parsers produce, so the crawlers and patch scripts do not care where
+the labels come from:
+
+    gemini   Gemini through the caller's own pipeline (prompts, batching,
+             response cache, rate limits), passed in as `gemini_classify`
+    local    CPU text-classification models (Hugging Face transformers) run
+             in a process pool: a sentiment model, an emotion model mapped
+             onto our emotion labels, and keyword rules for category and iit
+    fake     deterministic labels derived from a hash of the text, for tests
+             and benchmarks only: create_backend() refuses it unless the
+             caller passes allow_fake=True, so it cannot write made-up labels
+             to Firestore by accident
+
+Select one with CLASSIFIER_BACKEND (default gemini). The local backend needs
+the optional `transformers` and `torch` packages; its models are configured
+with LOCAL_SENTIMENT_MODEL / LOCAL_EMOTION_MODEL and the pool size with
+LOCAL_CLASSIFIER_WORKERS. benchmark_classifiers.py measures throughput and
+agreement with the stored Gemini labels.
+'''
+import abc
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import classification_schema
+import comment_heuristics
+
+CLASSIFIER_BACKEND = os.getenv("CLASSIFIER_BACKEND", "gemini")
+LOCAL_SENTIMENT_MODEL = os.getenv("LOCAL_SENTIMENT_MODEL", "cardiffnlp/twitter-roberta-base-sentiment-latest")
+LOCAL_EMOTION_MODEL = os.getenv("LOCAL_EMOTION_MODEL", "j-hartmann/emotion-english-distilroberta-base")
+LOCAL_CLASSIFIER_WORKERS = int(os.getenv("LOCAL_CLASSIFIER_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+LOCAL_CLASSIFIER_CHUNK = int(os.getenv("LOCAL_CLASSIFIER_CHUNK", "64")) # Texts per worker task
+
+SENTIMENT_LABELS = {"negative": -1, "neutral": 0, "positive": 1, "label_0": -1, "label_1": 0, "label_2": 1}
+# Ekman-style emotion model labels -> our emotion enum
+EMOTION_LABELS = {
+    "joy": "happy", "neutral": "neutral", "sadness": "disappointment", "anger": "frustration",
+    "disgust": "frustration", "fear": "stress", "surprise": "confusion",
+}
+CATEGORY_KEYWORDS = [ # First match wins, so more specific categories come first
+    ("internship", r"\b(internships?|itp|attachment)\b"),
+    ("results", r"\b(results?|gpa|grades?|cgpa|transcript)\b"),
+    ("exams", r"\b(exams?|examinations?|tests?|quiz(zes)?|finals|midterms?|paper)\b"),
+    ("admission", r"\b(admissions?|apply|application|eae|jae|polytechnic foundation|pfp|intake|enrol+ment)\b"),
+    ("career", r"\b(careers?|jobs?|salary|employ(er|ment)|hiring|interview)\b"),
+    ("lecturer", r"\b(lecturers?|tutors?|teachers?|profs?|professors?|mentors?)\b"),
+    ("cca", r"\b(cca|ccas|club|clubs|interest group)\b"),
+    ("events", r"\b(events?|open house|orientation|o-?week|fest(ival)?|concert|hackathon)\b"),
+    ("classroom", r"\b(classrooms?|lecture theatre|lt\d*|tutorial room|labs?)\b"),
+    ("facilities", r"\b(library|canteen|food court|toilets?|gym|wifi|wi-fi|printers?|lockers?|air-?con)\b"),
+    ("infrastructure", r"\b(buildings?|mrt|bus|shuttle|renovation|construction|lifts?|escalators?)\b"),
+    ("administration", r"\b(admin|administration|fees?|bursary|scholarships?|appeal|policy|email from school)\b"),
+    ("subjects", r"\b(modules?|subjects?|programming|math(s|ematics)?|python|java|database|networking)\b"),
+    ("academic", r"\b(diploma|course|semester|assignments?|projects?|studies|study|gpa|mst)\b"),
+    ("student life", r"\b(friends?|classmates?|stress(ed)?|burn(ed|t)? ?out|life|social|hostel)\b"),
+]
+IIT_PATTERN = re.compile(
+    r"\b(iit|informatics|big data|bda|applied ai|aai|information technology|cybersecurity|digital forensics|cdf|"
+    r"immersive media|game development|igd|common ict|cict|school of it)\b",
+    re.IGNORECASE,
+)
+_CATEGORY_PATTERNS = [(category, re.compile(pattern, re.IGNORECASE)) for category, pattern in CATEGORY_KEYWORDS]
+
+
+def keyword_category(text):
+    for category, pattern in _CATEGORY_PATTERNS:
+        if pattern.search(text or ""):
+            return category
+    return classification_schema.DEFAULT_CLASSIFICATION[2]
+
+
+def keyword_iit(text):
+    return "yes" if IIT_PATTERN.search(text or "") else "no"
+
+
+class ClassifierBackend(abc.ABC):
+    """Labels comments with (sentiment, emotion, category, iit_flag) tuples."""
+    name = "base"
+
+    @abc.abstractmethod
+    def classify(self, comment_items, context=""):
+        """Returns {comment_id: (sentiment, emotion, category, iit_flag)} for (comment_id, text) pairs."""
+
+    @property
+    def labeler(self):
+        """Backend and model behind the labels, kept with near-duplicate index entries."""
+        return self.name
+
+    def close(self):
+        pass
+
+
+class GeminiBackend(ClassifierBackend):
+    """Delegates to the caller's Gemini pipeline, e.g. crawler.classify_comments bound to a model."""
+    name = "gemini"
+
+    def __init__(self, gemini_classify):
+        self.gemini_classify = gemini_classify
+
+    def classify(self, comment_items, context=""):
+        return self.gemini_classify(comment_items, context=context)
+
+
+class FakeBackend(ClassifierBackend):
+    """Deterministic labels from a hash of the text: the same text always gets the same tuple."""
+    name = "fake"
+
+    def classify(self, comment_items, context=""):
+        results = {}
+        for comment_id, text in comment_items:
+            digest = hashlib.sha256((text or "").encode("utf-8")).digest()
+            results[comment_id] = (
+                digest[0] % 3 - 1,
+                classification_schema.EMOTIONS[digest[1] % len(classification_schema.EMOTIONS)],
+                classification_schema.CATEGORIES[digest[2] % len(classification_schema.CATEGORIES)],
+                "yes" if digest[3] % 4 == 0 else "no",
+            )
+        return results
+
+
+# --- Local CPU models (one set of pipelines per worker process) ---
+_worker_pipelines = None
+
+
+def _init_local_worker(sentiment_model, emotion_model):
+    global _worker_pipelines
+    import torch
+    from transformers import pipeline
+    torch.set_num_threads(1) # One core per worker; the pool provides the parallelism
+    _worker_pipelines = (
+        pipeline("text-classification", model=sentiment_model, device=-1, truncation=True),
+        pipeline("text-classification", model=emotion_model, device=-1, truncation=True),
+    )
+
+
+def _classify_local_chunk(texts):
+    sentiment_pipe, emotion_pipe = _worker_pipelines
+    texts = [text or "" for text in texts]
+    sentiments = sentiment_pipe(texts, batch_size=16)
+    emotions = emotion_pipe(texts, batch_size=16)
+    return [
+        (
+            SENTIMENT_LABELS.get(sentiment["label"].lower(), 0),
+            EMOTION_LABELS.get(emotion["label"].lower(), "neutral"),
+            keyword_category(text),
+            keyword_iit(text),
+        )
+        for text, sentiment, emotion in zip(texts, sentiments, emotions)
+    ]
+
+
+class LocalModelBackend(ClassifierBackend):
+    name = "local"
+
+    def __init__(self, sentiment_model=LOCAL_SENTIMENT_MODEL, emotion_model=LOCAL_EMOTION_MODEL,
+                 workers=LOCAL_CLASSIFIER_WORKERS, chunk_size=LOCAL_CLASSIFIER_CHUNK):
+        try:
+            import transformers  # noqa: F401 - only checking that the optional dependency is there
+        except ImportError:
+            raise RuntimeError("The local classifier backend needs the 'transformers' and 'torch' packages "
+                               "(pip install transformers torch).")
+        self.sentiment_model = sentiment_model
+        self.emotion_model = emotion_model
+        self.workers = max(1, workers)
+        self.chunk_size = max(1, chunk_size)
+        self._pool = None
+
+    @property
+    def labeler(self):
+        return f"local:{self.sentiment_model}+{self.emotion_model}"
+
+    def _get_pool(self):
+        if self._pool is None: # Started lazily: every worker loads both models once
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_local_worker,
+                initargs=(self.sentiment_model, self.emotion_model),
+            )
+        return self._pool
+
+    def classify(self, comment_items, context=""):
+        results = {}
+        pending = []
+        for comment_id, text in comment_items:
+            trivial = comment_heuristics.classify_trivial(text)
+            if trivial is not None:
+                results[comment_id] = trivial
+            else:
+                pending.append((comment_id, text))
+        if not pending:
+            return results
+
+        chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+        labelled = self._get_pool().map(_classify_local_chunk, [[text for _, text in chunk] for chunk in chunks])
+        for chunk, chunk_labels in zip(chunks, labelled):
+            for (comment_id, _), classification in zip(chunk, chunk_labels):
+                results[comment_id] = classification
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def create_backend(name=CLASSIFIER_BACKEND, gemini_classify=None, allow_fake=False):
+    """
+    Builds the backend called `name`; the Gemini backend needs the caller's
+    `gemini_classify` function. "fake" is only built with `allow_fake`, for
+    callers that never store the labels.
+    """
+    name = (name or "gemini").lower()
+    if name == "gemini":
+        if gemini_classify is None:
+            raise ValueError("The gemini classifier backend needs a gemini_classify function.")
+        return GeminiBackend(gemini_classify)
+    if name == "local":
+        return LocalModelBackend()
+    if name == "fake":
+        if not allow_fake:
+            raise ValueError("The fake classifier backend is only for tests and benchmarks, not for runs that store labels.")
+        return FakeBackend()
+    raise ValueError(f"Unknown classifier backend '{name}' (expected gemini or local).")
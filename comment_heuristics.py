@@ -0,0 +1,111 @@
+'''
+Local pre-classifier for trivial comments.
+
+A large share of comments are "thanks", "+1", emoji-only replies, bare links or
+"[deleted]"/"[removed]" placeholders. These can be labelled deterministically,
+so the crawlers only send ambiguous text to Gemini. classify_trivial() returns
+the same (sentiment, emotion, category, iit_flag) tuple the Gemini parsers
+produce, or None when the text needs the model.
+'''
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+DEFAULT_CATEGORY = "Uncategorized"
+
+PLACEHOLDER_TEXTS = {"[deleted]", "[removed]", "[removed by reddit]", "[ removed by reddit ]"}
+
+# Normalized (lowercase, punctuation stripped) short replies and their labels
+POSITIVE_PHRASES = {
+    "thanks", "thank you", "thanks a lot", "thank you so much", "thanks so much", "thx", "ty", "tysm", "tyvm",
+    "congrats", "congratulations", "congrats op", "nice", "nice one", "good luck", "all the best", "well done",
+    "awesome", "great", "love this", "legend", "wholesome", "jiayou", "ganbatte",
+}
+NEUTRAL_PHRASES = {
+    "+1", "this", "same", "same here", "me too", "agreed", "agree", "true", "ok", "okay", "k", "yes", "no",
+    "lol", "lmao", "haha", "hahaha", "bump", "following", "commenting to follow", "up", "^", "yup", "yep",
+}
+NEGATIVE_PHRASES = {"rip", "oof", "sad", "f", "damn", "wtf", "ugh"}
+
+POSITIVE_EMOJI = set("👍🙏❤😊😄😁🥳🎉👏💪🔥🥰😍✨💯😀😃")
+NEGATIVE_EMOJI = set("😭😢😡😠👎😞😔😩😫💔😤")
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+", re.IGNORECASE)
+# Emoji and other symbols (So/Sk), combining marks such as variation selectors (Mn),
+# zero-width joiners of emoji sequences (Cf) and punctuation (P*)
+EMOJI_CATEGORIES = {"So", "Sk", "Mn", "Cf"}
+NON_TEXT_CATEGORIES = EMOJI_CATEGORIES | {"Pc", "Pd", "Ps", "Pe", "Pi", "Pf", "Po"}
+STRIP_CHARS = " \t\r\n.,!?~*_\"'`()[]:;-"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _record(rule):
+    with _stats_lock:
+        _stats[rule] += 1
+
+
+def is_emoji_only(text):
+    """True if `text` has no letters or digits in any script, only emoji, symbols and punctuation."""
+    return all(ch.isspace() or unicodedata.category(ch) in NON_TEXT_CATEGORIES for ch in text)
+
+
+def _classify(text):
+    """Returns (rule, classification) or (None, None)."""
+    stripped = (text or "").strip()
+    if not stripped or stripped.lower() in PLACEHOLDER_TEXTS:
+        return "placeholder", (0, "Neutral", DEFAULT_CATEGORY, "no")
+
+    without_links = URL_PATTERN.sub("", stripped).strip()
+    if not without_links:
+        return "link_only", (0, "Neutral", DEFAULT_CATEGORY, "no")
+
+    lowered = without_links.lower()
+    if is_emoji_only(lowered):
+        # Emoji / punctuation only: use the emoji lexicon for polarity
+        positive = sum(1 for ch in lowered if ch in POSITIVE_EMOJI)
+        negative = sum(1 for ch in lowered if ch in NEGATIVE_EMOJI)
+        if positive > negative:
+            return "emoji_only", (1, "happy", DEFAULT_CATEGORY, "no")
+        if negative > positive:
+            return "emoji_only", (-1, "disappointment", DEFAULT_CATEGORY, "no")
+        return "emoji_only", (0, "Neutral", DEFAULT_CATEGORY, "no")
+
+    normalized = " ".join(lowered.strip(STRIP_CHARS).split())
+    # Drop emoji such as in "thanks 🙏", but keep letters of any script
+    normalized = "".join(ch for ch in normalized if unicodedata.category(ch) not in EMOJI_CATEGORIES)
+    normalized = " ".join(normalized.strip(STRIP_CHARS).split())
+    if normalized in POSITIVE_PHRASES:
+        return "short_reply", (1, "happy", DEFAULT_CATEGORY, "no")
+    if normalized in NEUTRAL_PHRASES:
+        return "short_reply", (0, "Neutral", DEFAULT_CATEGORY, "no")
+    if normalized in NEGATIVE_PHRASES:
+        return "short_reply", (-1, "disappointment", DEFAULT_CATEGORY, "no")
+    return None, None
+
+
+def classify_trivial(text):
+    """
+    Labels trivial comments locally. Returns (sentiment, emotion, category, iit_flag)
+    or None if the text should be sent to the model. Skips are counted per rule.
+    """
+    rule, classification = _classify(text)
+    if rule is None:
+        return None
+    _record(rule)
+    return classification
+
+
+def stats():
+    """Number of model calls skipped so far, per rule and in total."""
+    with _stats_lock:
+        result = dict(_stats)
+    result["total"] = sum(result.values())
+    return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
@@ -1,5 +1,7 @@
+import argparse
 import math
 import praw
+import prawcore
 import os
 import datetime
 from dotenv import load_dotenv
@@ -9,35 +11,49 @@ import google.generativeai as genai
 import time
 import logging
 import re
+import json
+import queue
+import signal
+import threading
 from collections import defaultdict # Added for easier aggregation
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import LLMCache
+from prompt_models import PromptModels, response_block_reason, reply_text
+from batch_jobs import BatchJob, LocalJobRunner, GeminiJobRunner
+import comment_heuristics
+import classification_schema
+import classifier_backends
+from near_duplicates import NearDuplicateIndex
+from id_index import IdIndex
+from bulk_writer import BulkWriter, get_write_stats
+from poll_scheduler import PollScheduler
+from reddit_fetch import AsyncRedditFetcher, post_record_from, comment_records_from, fetch_comment_tree, expand_more_comments
+from llm_telemetry import get_telemetry, usage_token_counts
+from rate_limiter import EmptyResponseError, get_rate_limiter, get_reddit_bucket, is_retryable_error, is_quota_error, retry_after_seconds, backoff_delay
 
 
 PROMPT_COMMENT = '''
 You are an AI assigned to evaluate a Reddit post comment. 
-Review the following text and provide a concise output in this format: 
-a sentiment score (1 for positive, -1 for negative, or 0 for neutral), 
-then a comma, the identified emotion (happy, relief, stress, frustration, 
-pride, disappointment, confusion, neutral), another comma, the determined category 
-(academic, exams, facilities, subjects, administration, career, admission, results, internship,
-lecturer, student life, infrastructure, classroom, events, CCA),
-and finally, a comma followed by "yes" or "no" indicating whether the text 
-relates to the School of IIT (or the School of Informatics & IT, which includes
-diplomas like Big Data Analytics/BDA, Applied AI/AAI, Information Technology/IT, Cybersecurity & Digital Forensics/CDF, 
-Immersive Media & Game Development/IGD and Common ICT)/CICT.
+Review the following text and respond with ONLY a JSON object with these fields:
+- "sentiment": 1 for positive, -1 for negative, or 0 for neutral
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (or the School of Informatics & IT,
+which includes diplomas like Big Data Analytics/BDA, Applied AI/AAI, Information Technology/IT,
+Cybersecurity & Digital Forensics/CDF, Immersive Media & Game Development/IGD and Common ICT/CICT)
 '''
 
 PROMPT_POST_COMMENTS = '''
 You are an AI assigned to evaluate a Reddit post and its accompanying comments about. 
-Review the following text and provide a concise output in this format: 
-a sentiment score (1 for positive, -1 for negative, or 0 for neutral), 
-then a comma, the identified emotion (happy, relief, stress, frustration, 
-pride, disappointment, confusion, neutral), another comma, the determined category 
-(academic, exams, facilities, subjects, administration, career, admission, results, internship,
-lecturer, student life, infrastructure, classroom, events, CCA), 
-and finally, another comma followed by "yes" or "no" indicating whether the text 
-relates to the School of IIT (or the School of Informatics & IT, which includes
-programs like Big Data Analytics (BDA), Applied AI (AAI), IT (ITO), Cybersecurity & Digital Forensics (CDF), 
-Immersive Media & Game Development (IGD) and Common ICT (CIT).
+Review the following text and respond with ONLY a JSON object with these fields:
+- "sentiment": the overall sentiment score (1 for positive, -1 for negative, or 0 for neutral)
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (or the School of Informatics & IT,
+which includes programs like Big Data Analytics (BDA), Applied AI (AAI), IT (ITO), Cybersecurity & Digital Forensics (CDF),
+Immersive Media & Game Development (IGD) and Common ICT (CIT))
 '''
 
 PROMPT_SUMMARY = '''
@@ -61,8 +77,105 @@ attachments, or unrelated filler), simply state:
 “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
 '''
 
+PROMPT_COMMENT_BATCH = '''
+You are an AI assigned to evaluate a batch of Reddit post comments.
+The input is a JSON array of objects, each with an "id" and a "text".
+For every comment, determine:
+- "sentiment": 1 for positive, -1 for negative, or 0 for neutral
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (or the School of Informatics & IT,
+which includes diplomas like Big Data Analytics/BDA, Applied AI/AAI, Information Technology/IT,
+Cybersecurity & Digital Forensics/CDF, Immersive Media & Game Development/IGD and Common ICT/CICT)
+Respond with ONLY a JSON array containing one object per input comment, in the form
+{"id": "<id>", "sentiment": <int>, "emotion": "<emotion>", "category": "<category>", "iit": "<yes|no>"}.
+Use the exact "id" values from the input and do not add any other text.
+'''
+
+PROMPT_POST_ANALYSIS = '''
+You are an AI tasked with analyzing a Reddit post and its accompanying comments.
+Produce a single JSON object with exactly these fields:
+- "sentiment": the overall sentiment score (1 for positive, -1 for negative, or 0 for neutral)
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (or the School of Informatics & IT,
+which includes programs like Big Data Analytics (BDA), Applied AI (AAI), IT (ITO), Cybersecurity & Digital Forensics (CDF),
+Immersive Media & Game Development (IGD) and Common ICT (CIT))
+- "summary": a summary written as follows (do not provide headings or titles for any paragraphs):
+  1. A concise paragraph summarizing the key topics, issues, or themes discussed across the post and comments.
+  2. A second paragraph describing the overall sentiment and emotional tone expressed, mentioning any references
+  to specific academic subjects, school facilities, or aspects of campus life, if applicable.
+  3. If appropriate, a third paragraph highlighting any concerns raised or constructive suggestions for school
+  authorities, clearly referencing any specific subjects, facilities, or experiences mentioned.
+  Separate paragraphs with a blank line. If the provided text lacks sufficient content for analysis (e.g., it only
+  contains links, attachments, or unrelated filler), the summary should simply be:
+  “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
+Respond with ONLY the JSON object and no other text.
+'''
+
+PROMPT_CHUNK_SUMMARY = '''
+You are an AI assigned to read one part of a long Reddit thread (a post and its comments).
+Write a compact set of notes (at most 150 words) covering the key topics, issues or themes raised in this part,
+the prevailing sentiment and emotions, any specific subjects, facilities, diplomas or schools mentioned,
+and any concerns or suggestions for school authorities. Do not add headings or commentary about the task.
+'''
+
+PROMPT_SUMMARY_REFRESH = '''
+You are an AI maintaining the analysis of a Reddit post and its comments. You are given the EXISTING summary of
+the thread followed by NEW comments posted since that summary was written.
+Produce a single JSON object with exactly these fields, describing the thread as a whole (existing + new):
+- "sentiment": the overall sentiment score (1 for positive, -1 for negative, or 0 for neutral)
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (or the School of Informatics & IT)
+- "summary": the updated summary in the same style as the existing one (do not provide headings or titles for any
+paragraphs): a paragraph on the key topics, a paragraph on the overall sentiment and emotional tone, and, if
+appropriate, a paragraph on concerns or suggestions for school authorities. Separate paragraphs with a blank line.
+Respond with ONLY the JSON object and no other text.
+'''
+
+# Prompt type names used in telemetry
+PROMPT_TYPES = {
+    PROMPT_COMMENT: "comment",
+    PROMPT_POST_COMMENTS: "post_comments",
+    PROMPT_SUMMARY: "summary",
+    PROMPT_COMMENT_BATCH: "comment_batch",
+    PROMPT_POST_ANALYSIS: "post_analysis",
+    PROMPT_CHUNK_SUMMARY: "chunk_summary",
+    PROMPT_SUMMARY_REFRESH: "summary_refresh",
+}
+
 # --- Constants ---
-BATCH_COMMIT_SIZE = 400 # Max operations per batch is 500, use a lower number for safety
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8')) # Max in-flight comment classification requests
+CLASSIFY_BATCH_SIZE = int(os.getenv('CLASSIFY_BATCH_SIZE', '20')) # Comments per batched classification request (<= 1 disables batching)
+COMBINED_POST_ANALYSIS = os.getenv('COMBINED_POST_ANALYSIS', '0') == '1' # One PROMPT_POST_ANALYSIS call instead of PROMPT_POST_COMMENTS + PROMPT_SUMMARY
+MAP_REDUCE_THRESHOLD_TOKENS = int(os.getenv('MAP_REDUCE_THRESHOLD_TOKENS', '30000')) # Threads above this size are summarized chunk by chunk
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv('MAP_REDUCE_CHUNK_TOKENS', '8000')) # Token budget per chunk in map-reduce summarization
+CLASSIFY_MAX_REASKS = int(os.getenv('CLASSIFY_MAX_REASKS', '1')) # Times a missing/invalid classification is re-asked before using defaults
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4')) # Posts buffered between the fetch, classify and persist stages
+MORE_COMMENTS_RESUME_POSTS = int(os.getenv('MORE_COMMENTS_RESUME_POSTS', '10')) # Partially expanded posts resumed per subreddit per run
+NEW_POSTS_LIMIT = 100 # Submissions read from the 'new' listing per run (without catch-up)
+RECENT_COMMENTS_LIMIT = 200 # Comments read from the recent comments listing per run (without catch-up)
+CATCH_UP = os.getenv('CATCH_UP', '0') == '1' # Page back through the listings until last_timestamp is reached (--catch-up)
+CATCH_UP_CHECKPOINT_POSTS = int(os.getenv('CATCH_UP_CHECKPOINT_POSTS', '20')) # Posts stored between catch-up checkpoints
+REDDIT_INFO_BATCH = 100 # Fullnames per reddit.info() request (Reddit's maximum)
+FIRESTORE_GET_ALL_CHUNK = 300 # Documents per batched Firestore get_all() read
+ENGAGEMENT_REFRESH_DAYS = float(os.getenv('ENGAGEMENT_REFRESH_DAYS', '7')) # Posts this recent get their score and engagementScore refreshed (0 disables)
+ENGAGEMENT_REFRESH_HOURS = float(os.getenv('ENGAGEMENT_REFRESH_HOURS', '20')) # Minimum time between refreshes of one subreddit
+CRAWL_WORKERS = int(os.getenv('CRAWL_WORKERS', '1')) # Subreddits crawled concurrently (each worker has its own PRAW instance)
+SUMMARY_REFRESH_MIN_NEW_COMMENTS = int(os.getenv('SUMMARY_REFRESH_MIN_NEW_COMMENTS', '5')) # Unsummarized comments needed before an old post's summary is refreshed (0 disables)
+NEAR_DUPLICATES = os.getenv('NEAR_DUPLICATES', '1') == '1' # Reuse results of near-identical posts/comments (near_duplicates.py)
+NEAR_DUP_MAX_DISTANCE = int(os.getenv('NEAR_DUP_MAX_DISTANCE', '4')) # Max differing SimHash bits (of 64) for a near-duplicate
+NEAR_DUP_MIN_TOKENS = int(os.getenv('NEAR_DUP_MIN_TOKENS', '8')) # Shorter texts are never treated as duplicates
+ID_INDEX = os.getenv('ID_INDEX', '1') == '1' # Answer "already stored?" from the local ID index (id_index.py)
+
+# Schema-constrained JSON replies (see classification_schema.py)
+CLASSIFICATION_GENERATION_CONFIG = classification_schema.json_generation_config(classification_schema.CLASSIFICATION_SCHEMA)
+BATCH_CLASSIFICATION_GENERATION_CONFIG = classification_schema.json_generation_config(classification_schema.BATCH_CLASSIFICATION_SCHEMA)
+POST_ANALYSIS_GENERATION_CONFIG = classification_schema.json_generation_config(classification_schema.POST_ANALYSIS_SCHEMA)
 
 # Setup logging to file
 logging.basicConfig(filename='crawler_errors.log',
@@ -78,12 +191,26 @@ REDDIT_CLIENT_SECRET = os.getenv('REDDIT_CLIENT_SECRET')
 REDDIT_USER_AGENT = os.getenv('REDDIT_USER_AGENT')
 GOOGLE_GEMINI_API_KEY = os.getenv('GOOGLE_GEMINI_API_KEY')
 
+class SharedBudgetRequestor(prawcore.Requestor):
+    """Takes every Reddit API request (of any PRAW instance) from the shared REDDIT_RPM bucket."""
+
+    def request(self, *args, **kwargs):
+        bucket = get_reddit_bucket()
+        if bucket is not None:
+            bucket.acquire(1)
+        return super().request(*args, **kwargs)
+
+def make_reddit():
+    """New PRAW instance; PRAW is not thread-safe, so every parallel crawl worker gets its own."""
+    return praw.Reddit(
+        client_id=REDDIT_CLIENT_ID,
+        client_secret=REDDIT_CLIENT_SECRET,
+        user_agent=REDDIT_USER_AGENT,
+        requestor_class=SharedBudgetRequestor,
+    )
+
 # Initialize the Reddit API using PRAW
-reddit = praw.Reddit(
-    client_id=REDDIT_CLIENT_ID,
-    client_secret=REDDIT_CLIENT_SECRET,
-    user_agent=REDDIT_USER_AGENT
-)
+reddit = make_reddit()
 
 # Initialize Firebase Firestore
 try:
@@ -156,30 +283,493 @@ def set_last_timestamp(timestamp, subreddit, refs):
     except Exception as e:
         logging.error(f"[{subreddit}] Error saving last_timestamp: {e}")
 
+# --- Listing windows, gaps and catch-up ---
+# Without catch-up each run reads at most NEW_POSTS_LIMIT posts and
+# RECENT_COMMENTS_LIMIT comments. When a listing does not reach back to
+# last_timestamp, anything older than what was read may have been missed;
+# report_gap() records that in meta/crawl_gaps_{subreddit}.
+crawl_gaps = [] # Gaps detected in this run, listed in the end-of-run summary
+
+def report_gap(refs, subreddit_name, kind, since, oldest_seen):
+    """Records that the `kind` listing ("posts" / "comments") stopped at `oldest_seen` before reaching `since`."""
+    gap = {"subreddit": subreddit_name, "kind": kind, "from": since, "to": oldest_seen,
+           "catchUp": CATCH_UP, "detected": time.time()}
+    crawl_gaps.append(gap)
+    if CATCH_UP:
+        hint = "Reddit's listing ended (about 1000 items); backfill this range from a dump"
+    else:
+        hint = "re-run with --catch-up"
+    message = (f"[{subreddit_name}] GAP: the {kind} listing did not reach back to the last crawl; {kind} between "
+               f"{datetime.datetime.fromtimestamp(since)} and {datetime.datetime.fromtimestamp(oldest_seen)} may be missing ({hint}).")
+    logging.warning(message)
+    print(message)
+    try:
+        refs["meta"].document(f"crawl_gaps_{subreddit_name}").set(
+            {"gaps": firestore.ArrayUnion([gap]), "lastDetected": firestore.SERVER_TIMESTAMP}, merge=True)
+    except Exception as e:
+        logging.error(f"[{subreddit_name}] Error saving crawl gap: {e}")
+
+def list_new_submissions(sub, since, limit):
+    """
+    Submissions of the 'new' listing newer than `since`, newest first. With
+    limit=None PRAW pages back as far as Reddit serves the listing.
+    Returns (submissions, reached) where reached is False if the listing
+    ended before getting back to `since`.
+    """
+    submissions = []
+    for submission in sub.new(limit=limit):
+        if submission.created_utc <= since:
+            return submissions, True
+        submissions.append(submission)
+    return submissions, False
+
+def save_catch_up_checkpoint(refs, subreddit_name, post_record, stored, timestamp):
+    """
+    Catch-up progress: last_timestamp is advanced to `timestamp` (the newest
+    stored post, or just before an older post that is not stored yet) and the
+    cursor is kept for reporting.
+    """
+    set_last_timestamp(timestamp, subreddit_name, refs)
+    try:
+        refs["meta"].document(f"catch_up_{subreddit_name}").set({
+            "cursor": f"t3_{post_record['post_id']}", "timestamp": timestamp,
+            "stored": stored, "updated": firestore.SERVER_TIMESTAMP})
+    except Exception as e:
+        logging.error(f"[{subreddit_name}] Error saving catch-up checkpoint: {e}")
+
+def load_catch_up_checkpoint(refs, subreddit_name):
+    try:
+        snapshot = refs["meta"].document(f"catch_up_{subreddit_name}").get()
+        return snapshot.to_dict() if snapshot.exists else None
+    except Exception as e:
+        logging.error(f"[{subreddit_name}] Error reading catch-up checkpoint: {e}")
+        return None
+
+def clear_catch_up_checkpoint(refs, subreddit_name):
+    try:
+        refs["meta"].document(f"catch_up_{subreddit_name}").delete()
+    except Exception as e:
+        logging.error(f"[{subreddit_name}] Error clearing catch-up checkpoint: {e}")
+
 # Helper function to safely generate content with retries
-def safe_generate_content(model, prompt, retries=3, delay=5):
+GENERATION_BLOCKED_TEXT = "Content generation blocked due to safety settings."
+GENERATION_FAILED_TEXT = "Error generating response after multiple attempts."
+GENERATION_ERROR_TEXTS = (GENERATION_BLOCKED_TEXT, GENERATION_FAILED_TEXT)
+
+llm_cache = None # Set to an LLMCache in __main__; None disables caching
+comment_classifier = None # Set to a classifier backend in __main__; None classifies with Gemini directly
+duplicate_index = None # Set to a NearDuplicateIndex in __main__; None disables near-duplicate reuse
+id_index = None # Set to an IdIndex in __main__; None asks Firestore for every existence check
+reddit_fetcher = None # Set to an AsyncRedditFetcher in __main__ (--fetch async); None fetches new posts with PRAW
+
+def safe_generate_content(model, template, text, retries=5, delay=2, generation_config=None, validate=None):
+    """
+    Sends `template + text` to Gemini with retries. `template` is the fixed
+    prompt preamble and `text` the per-call content. With a PromptModels
+    `model` the template is sent as the system instruction of a per-template
+    handle instead of being concatenated. Together with the model
+    name (and response schema, if any) they key the persistent response cache
+    when one is configured. Replies rejected by `validate` are not cached, so
+    re-asking the same request does not return the same bad reply.
+
+    Every attempt goes through the shared rate limiter. Quota and transient
+    errors are retried with the server's retry delay or exponential backoff
+    with jitter (`delay` is the base); permanent errors fail immediately.
+    """
+    model_name = getattr(model, "model_name", type(model).__name__)
+    cache_template = template
+    if generation_config is not None:
+        cache_template = template + json.dumps(generation_config, sort_keys=True)
+    prompt_type = PROMPT_TYPES.get(template, "other")
+    telemetry = get_telemetry()
+    if llm_cache is not None:
+        cached = llm_cache.get(model_name, cache_template, text)
+        if cached is not None:
+            telemetry.record_cache_hit(prompt_type)
+            return cached
+
+    prompt = template + text
+    if hasattr(model, "for_template"):
+        # PromptModels: the template is the handle's system instruction, only the text is sent
+        handle, contents = model.for_template(template), text
+    else:
+        handle, contents = model, prompt
+    limiter = get_rate_limiter()
+    latency = 0.0
     for attempt in range(retries):
         try:
-            response = model.generate_content(prompt)
-            # Check for valid response and text content
-            if response and hasattr(response, 'text') and response.text:
-                return response.text.strip()
-            # Handle potential blocking or safety issues
-            elif response and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-                 logging.warning(f"Content generation blocked. Reason: {response.prompt_feedback.block_reason}")
-                 return "Content generation blocked due to safety settings." # Return specific message
-            else:
-                # General case for empty or unexpected response structure
-                raise ValueError(f"Empty or invalid response structure received. Response: {response}")
+            limiter.acquire(estimate_tokens(prompt))
+            call_started = time.monotonic()
+            try:
+                if generation_config is not None:
+                    response = handle.generate_content(contents, generation_config=generation_config)
+                else:
+                    response = handle.generate_content(contents)
+            finally:
+                latency = time.monotonic() - call_started
+            # Blocked replies first: response.text raises ValueError on them
+            block_reason = response_block_reason(response)
+            if block_reason:
+                logging.warning(f"Content generation blocked. Reason: {block_reason}")
+                input_tokens, _ = usage_token_counts(response)
+                telemetry.record_call(prompt_type, latency, input_tokens or estimate_tokens(prompt), 0, retries=attempt,
+                                      outcome="blocked", block_reason=block_reason)
+                return GENERATION_BLOCKED_TEXT # Final: asking again gets the same answer
+            response_text = reply_text(response)
+            if not response_text:
+                raise EmptyResponseError(f"Empty or invalid response structure received. Response: {response}")
+            response_text = response_text.strip()
+            input_tokens, output_tokens = usage_token_counts(response)
+            telemetry.record_call(prompt_type, latency, input_tokens or estimate_tokens(prompt),
+                                  output_tokens or estimate_tokens(response_text), retries=attempt)
+            if llm_cache is not None and (validate is None or validate(response_text)):
+                llm_cache.put(model_name, cache_template, text, response_text)
+            return response_text
 
         except Exception as e:
             logging.error(f"Error in generate_content (Attempt {attempt+1}/{retries}): {e}. Prompt snippet: {prompt[:100]}...")
+            if not is_retryable_error(e):
+                logging.error(f"generate_content failed with a non-retryable error: {e}")
+                break
             if attempt < retries - 1:
-                time.sleep(delay)
+                wait = retry_after_seconds(e) or backoff_delay(attempt, base_delay=delay)
+                if is_quota_error(e):
+                    limiter.pause(wait) # Hold back every worker, not just this one
+                else:
+                    time.sleep(wait)
             else:
                  logging.error(f"generate_content failed after {retries} attempts.")
     # Return a fallback message if all retries fail
-    return "Error generating response after multiple attempts."
+    telemetry.record_call(prompt_type, latency, estimate_tokens(prompt), 0, retries=attempt, outcome="failed")
+    return GENERATION_FAILED_TEXT
+
+def parse_classification_response(response_text, context="", kind="comment"):
+    """
+    Parses and validates a JSON classification reply (CLASSIFICATION_SCHEMA).
+    Returns (sentiment, emotion, category, iit_flag), or None if the reply does
+    not match the schema; the outcome is counted under `kind`.
+    """
+    try:
+        classification = classification_schema.parse_classification(response_text)
+    except classification_schema.ClassificationError as e:
+        logging.warning(f"Invalid classification for {context} ({e}). Response: {response_text[:200]}")
+        classification_schema.record(kind, failed=1)
+        return None
+    classification_schema.record(kind, parsed=1)
+    return classification
+
+def is_valid_classification(response_text):
+    try:
+        classification_schema.parse_classification(response_text)
+        return True
+    except classification_schema.ClassificationError:
+        return False
+
+def classify_comments_concurrently(model, comment_bodies, max_workers=GEMINI_MAX_CONCURRENCY):
+    """
+    Sends one PROMPT_COMMENT request per comment body with at most
+    `max_workers` requests in flight. Returns the raw Gemini replies in the
+    same order as `comment_bodies`.
+    """
+    if not comment_bodies:
+        return []
+
+    def classify(comment_body):
+        return safe_generate_content(model, PROMPT_COMMENT, f" Text: ${comment_body}",
+                                     generation_config=CLASSIFICATION_GENERATION_CONFIG, validate=is_valid_classification)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(get_telemetry().bind(classify), comment_bodies))
+
+def parse_batch_classification_response(response_text, context=""):
+    """
+    Parses the JSON array returned for PROMPT_COMMENT_BATCH.
+    Returns {comment_id: (sentiment, emotion, category, iit_flag)} for every
+    entry that matches the schema; invalid or missing entries are left out.
+    """
+    try:
+        results, errors = classification_schema.parse_batch_classification(response_text)
+    except classification_schema.ClassificationError as e:
+        logging.warning(f"Unusable batch classification reply for {context} ({e}). Response: {response_text[:200]}")
+        return {}
+    for comment_id, error in errors.items():
+        logging.warning(f"Invalid classification for {context} comment {comment_id}: {error}")
+    return results
+
+def is_valid_batch_classification(response_text):
+    try:
+        results, _ = classification_schema.parse_batch_classification(response_text)
+        return bool(results)
+    except classification_schema.ClassificationError:
+        return False
+
+def request_structured(model, template, text, generation_config, parse, context="", kind="post", default=None):
+    """
+    Sends one schema-constrained request and returns `parse(reply)`. Replies that
+    fail validation (parse raises ClassificationError) are re-asked up to
+    CLASSIFY_MAX_REASKS times; after that, or if Gemini fails outright, `default`
+    is returned. Parse outcomes are counted under `kind`.
+    """
+    def is_valid(response_text):
+        try:
+            parse(response_text)
+            return True
+        except classification_schema.ClassificationError:
+            return False
+
+    for attempt in range(1 + max(0, CLASSIFY_MAX_REASKS)):
+        response_text = safe_generate_content(model, template, text, generation_config=generation_config, validate=is_valid)
+        if response_text in GENERATION_ERROR_TEXTS:
+            return default
+        try:
+            result = parse(response_text)
+            classification_schema.record(kind, parsed=1)
+            return result
+        except classification_schema.ClassificationError as e:
+            classification_schema.record(kind, failed=1)
+            logging.warning(f"Invalid {kind} reply for {context} (attempt {attempt + 1}): {e}. Response: {response_text[:200]}")
+    classification_schema.record(kind, gave_up=1)
+    return default
+
+def classify_comments(model, comment_items, context="", batch_size=CLASSIFY_BATCH_SIZE, max_workers=GEMINI_MAX_CONCURRENCY):
+    """
+    Classifies a list of (comment_id, comment_body) pairs and returns
+    {comment_id: (sentiment, emotion, category, iit_flag)}.
+
+    Trivial comments ("thanks", emoji, bare links, [deleted]) are labelled
+    locally by comment_heuristics and never reach the model. With batching
+    enabled, the rest are packed `batch_size` at a time into
+    PROMPT_COMMENT_BATCH requests (sent concurrently), otherwise each one gets
+    its own PROMPT_COMMENT request. Replies are validated against the schema;
+    only the comments that are missing or invalid are re-asked, up to
+    CLASSIFY_MAX_REASKS times, before falling back to the default classification.
+    """
+    results = {}
+    if not comment_items:
+        return results
+
+    pending = []
+    for comment_id, body in comment_items:
+        trivial = comment_heuristics.classify_trivial(body)
+        if trivial is not None:
+            results[comment_id] = trivial
+        else:
+            pending.append((comment_id, body))
+
+    kind = "comment_batch" if batch_size > 1 else "comment"
+    unavailable = set() # Gemini failed outright; re-asking would only repeat the retries
+
+    def classify_chunk(chunk):
+        payload = json.dumps([{"id": comment_id, "text": body} for comment_id, body in chunk], ensure_ascii=False)
+        response_text = safe_generate_content(model, PROMPT_COMMENT_BATCH, f" Comments: {payload}",
+                                              generation_config=BATCH_CLASSIFICATION_GENERATION_CONFIG,
+                                              validate=is_valid_batch_classification)
+        chunk_ids = {comment_id for comment_id, _ in chunk}
+        if response_text in GENERATION_ERROR_TEXTS:
+            unavailable.update(chunk_ids)
+            return {}
+        parsed = parse_batch_classification_response(response_text, context=context)
+        chunk_results = {comment_id: value for comment_id, value in parsed.items() if comment_id in chunk_ids}
+        classification_schema.record(kind, parsed=len(chunk_results), failed=len(chunk_ids) - len(chunk_results))
+        return chunk_results
+
+    for attempt in range(1 + max(0, CLASSIFY_MAX_REASKS)):
+        if not pending:
+            break
+        if attempt:
+            print(f"{context} Re-asking {len(pending)} of {len(comment_items)} comments with missing or invalid classifications...")
+
+        if batch_size > 1:
+            chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                for chunk_results in executor.map(get_telemetry().bind(classify_chunk), chunks):
+                    results.update(chunk_results)
+        else:
+            response_texts = classify_comments_concurrently(model, [body for _, body in pending], max_workers=max_workers)
+            for (comment_id, _), response_text in zip(pending, response_texts):
+                if response_text in GENERATION_ERROR_TEXTS:
+                    unavailable.add(comment_id)
+                    continue
+                classification = parse_classification_response(response_text, context=f"{context} comment {comment_id}", kind=kind)
+                if classification is not None:
+                    results[comment_id] = classification
+
+        pending = [(comment_id, body) for comment_id, body in pending
+                   if comment_id not in results and comment_id not in unavailable]
+
+    if pending:
+        logging.error(f"{context} {len(pending)} comments still invalid after {CLASSIFY_MAX_REASKS} re-asks, using defaults.")
+        classification_schema.record(kind, gave_up=len(pending))
+    for comment_id, _ in comment_items:
+        results.setdefault(comment_id, classification_schema.DEFAULT_CLASSIFICATION)
+    return results
+
+def classify_comment_items(model, comment_items, context=""):
+    """Classifies (comment_id, body) pairs with the configured backend (CLASSIFIER_BACKEND), Gemini by default."""
+    if not comment_items:
+        return {}
+    if comment_classifier is None:
+        return classify_comments(model, comment_items, context=context)
+    return comment_classifier.classify(comment_items, context=context)
+
+def comment_labeler(model):
+    """Labeler of this run's comment classifications; near-duplicates only reuse labels of the same labeler."""
+    if comment_classifier is None or comment_classifier.name == "gemini":
+        return f"gemini:{model.model_name}"
+    return comment_classifier.labeler
+
+def is_reusable_classification(classification):
+    """False for the "Uncategorized" defaults used for failed and heuristic labels, which are not worth copying."""
+    return classification[2] != classification_schema.DEFAULT_CLASSIFICATION[2]
+
+def classify_comment_records(model, refs, comment_records, context="", post_id=None):
+    """
+    Classifies comment records (which carry their post_id unless `post_id` is given).
+    Comments that are near-duplicates of an already classified comment reuse its
+    labels and get a "duplicateOf" entry with the source document path; the rest
+    go to the classifier backend and are added to the index.
+    """
+    results = {}
+    pending = []
+    labeler = comment_labeler(model)
+    for comment in comment_records:
+        match = duplicate_index.lookup("comment", comment["body"], labeler) if duplicate_index is not None else None
+        if match is not None:
+            results[comment["comment_id"]] = match.classification
+            comment["duplicateOf"] = match.source_id
+        else:
+            pending.append(comment)
+    if len(pending) < len(comment_records):
+        print(f"{context} Reused the labels of near-duplicates for {len(comment_records) - len(pending)} comments.")
+
+    classified = classify_comment_items(model, [(comment["comment_id"], comment["body"]) for comment in pending], context=context)
+    results.update(classified)
+    if duplicate_index is not None:
+        for comment in pending:
+            classification = classified[comment["comment_id"]]
+            if is_reusable_classification(classification):
+                comment_ref = refs["posts"].document(comment.get("post_id", post_id)).collection("comments").document(comment["comment_id"])
+                duplicate_index.add("comment", comment["body"], comment_ref.path, classification, labeler)
+    return results
+
+def analyze_new_post(model, refs, post_record, comment_records, context=""):
+    """
+    analyze_thread for a new post, unless its title and body are a near-duplicate
+    of an already analyzed post (e.g. a crosspost): then that post's classification
+    and summary are reused and the record gets a "duplicateOf" entry.
+    """
+    post_text = f"{post_record['title']}\n{post_record['body']}"
+    match = duplicate_index.lookup("post", post_text, f"gemini:{model.model_name}") if duplicate_index is not None else None
+    if match is not None and match.summary:
+        print(f"{context} Near-duplicate of {match.source_id} ({match.distance} bits apart), reusing its analysis.")
+        post_record["duplicateOf"] = match.source_id
+        return match.classification + (match.summary,)
+
+    analysis = analyze_thread(model, thread_parts_for(post_record, comment_records), context=context)
+    if duplicate_index is not None and is_reusable_classification(analysis) and analysis[4] not in GENERATION_ERROR_TEXTS:
+        duplicate_index.add("post", post_text, refs["posts"].document(post_record["post_id"]).path, analysis[:4],
+                            f"gemini:{model.model_name}", summary=analysis[4])
+    return analysis
+
+def analyze_post(model, combined_post_comments, context="", combined=COMBINED_POST_ANALYSIS):
+    """
+    Classifies and summarizes a post together with its comments.
+    Returns (sentiment, emotion, category, iit_flag, summary).
+
+    In combined mode a single PROMPT_POST_ANALYSIS request returns both the
+    classification and the summary; if no valid reply comes back, the
+    separate PROMPT_POST_COMMENTS and PROMPT_SUMMARY requests are used instead.
+    """
+    text = f" Text: ${combined_post_comments}"
+    if combined:
+        analysis = request_structured(model, PROMPT_POST_ANALYSIS, text, POST_ANALYSIS_GENERATION_CONFIG,
+                                      classification_schema.parse_analysis, context=context, kind="post_analysis")
+        if analysis is not None:
+            return analysis
+        logging.warning(f"No valid combined analysis for {context}. Falling back to separate requests.")
+
+    classification = request_structured(model, PROMPT_POST_COMMENTS, text, CLASSIFICATION_GENERATION_CONFIG,
+                                        classification_schema.parse_classification, context=context, kind="post",
+                                        default=classification_schema.DEFAULT_CLASSIFICATION)
+    summary = safe_generate_content(model, PROMPT_SUMMARY, text)
+    return classification + (summary,)
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) used for chunking decisions."""
+    return len(text) // 4 + 1
+
+def chunk_thread_parts(thread_parts, chunk_tokens=MAP_REDUCE_CHUNK_TOKENS):
+    """
+    Greedily groups the post body and comment bodies into chunks of at most
+    `chunk_tokens` estimated tokens, keeping thread order. A single part that
+    is larger than the budget is split into fixed-size slices.
+    """
+    max_chars = max(1, chunk_tokens * 4)
+    chunks = []
+    current = []
+    current_chars = 0
+    for part in thread_parts:
+        slices = [part[i:i + max_chars] for i in range(0, len(part), max_chars)] or [""]
+        for piece in slices:
+            if current and current_chars + len(piece) + 1 > max_chars:
+                chunks.append("\n".join(current))
+                current = []
+                current_chars = 0
+            current.append(piece)
+            current_chars += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def analyze_thread(model, thread_parts, context=""):
+    """
+    Classifies and summarizes a whole thread given as [post body, comment body, ...].
+    Returns (sentiment, emotion, category, iit_flag, summary) like analyze_post.
+
+    Threads above MAP_REDUCE_THRESHOLD_TOKENS are split into token-bounded
+    chunks that are summarized concurrently (map); the partial summaries are
+    then analyzed together to produce the final summary and classification (reduce).
+    """
+    total_tokens = sum(estimate_tokens(part) for part in thread_parts)
+    if total_tokens <= MAP_REDUCE_THRESHOLD_TOKENS:
+        return analyze_post(model, "\n".join(thread_parts), context=context)
+
+    chunks = chunk_thread_parts(thread_parts)
+    print(f"{context} Thread is ~{total_tokens} tokens, summarizing {len(chunks)} chunks before the final analysis...")
+
+    def summarize_chunk(chunk):
+        return safe_generate_content(model, PROMPT_CHUNK_SUMMARY, f" Text: ${chunk}")
+
+    with ThreadPoolExecutor(max_workers=max(1, GEMINI_MAX_CONCURRENCY)) as executor:
+        partial_summaries = list(executor.map(get_telemetry().bind(summarize_chunk), chunks))
+
+    partial_summaries = [
+        summary for summary in partial_summaries
+        if summary not in (GENERATION_FAILED_TEXT, GENERATION_BLOCKED_TEXT)
+    ]
+    if not partial_summaries:
+        logging.error(f"All chunk summaries failed for {context}.")
+        return 0, "Neutral", "Uncategorized", "no", GENERATION_FAILED_TEXT
+
+    reduced_text = "\n\n".join(
+        f"[Part {i + 1} of {len(partial_summaries)} of a long thread]\n{summary}"
+        for i, summary in enumerate(partial_summaries)
+    )
+    return analyze_post(model, reduced_text, context=context)
+
+def refresh_post_summary(model, existing_summary, new_comment_bodies, context=""):
+    """
+    Updates an existing post summary with comments posted since it was written,
+    sending only the old summary and the new comments. Returns
+    (sentiment, emotion, category, iit_flag, summary), or None if the reply is unusable.
+    """
+    new_comments_text = "\n".join(f"- {body}" for body in new_comment_bodies)
+    text = f" EXISTING SUMMARY: {existing_summary}\n\nNEW COMMENTS:\n{new_comments_text}"
+    refreshed = request_structured(model, PROMPT_SUMMARY_REFRESH, text, POST_ANALYSIS_GENERATION_CONFIG,
+                                   classification_schema.parse_analysis, context=context, kind="summary_refresh")
+    if refreshed is None:
+        logging.warning(f"No valid summary refresh for {context}.")
+    return refreshed
 
 # OPTIMIZED: Accumulate author stats in memory
 def update_author_stats_memory(author_updates, author, sentiment, is_post=True, post_id=None, comment_id=None):
@@ -234,8 +824,7 @@ def commit_author_stats(author_updates, refs):
 
     print(f"Committing stats for {len(author_updates)} authors...")
     authors_ref = refs["authors"]
-    batch = db.batch()
-    count = 0
+    writer = BulkWriter(db, context="[authors]")
 
     authors_to_fetch = list(author_updates.keys())
     existing_authors_data = {}
@@ -296,33 +885,10 @@ def commit_author_stats(author_updates, refs):
         total_interactions = current_stats["postCount"] + current_stats["commentCount"]
         current_stats["averageSentiment"] = (current_stats["totalSentimentScore"] / total_interactions) if total_interactions > 0 else 0
 
-        # Add update to batch
-        batch.set(author_ref, current_stats) # Use set to overwrite completely with merged data
-        count += 1
-
-        # Commit batch if size limit reached
-        if count >= BATCH_COMMIT_SIZE:
-            try:
-                print(f"Committing author batch ({count} operations)...")
-                batch.commit()
-                print("Author batch committed.")
-                batch = db.batch() # Start new batch
-                count = 0
-            except Exception as e:
-                logging.error(f"Error committing author batch: {e}")
-                # Consider retry logic or partial failure handling here
-                batch = db.batch() # Start new batch even on error
-                count = 0
-
+        writer.set(author_ref, current_stats) # Use set to overwrite completely with merged data
 
-    # Commit any remaining operations in the last batch
-    if count > 0:
-        try:
-            print(f"Committing final author batch ({count} operations)...")
-            batch.commit()
-            print("Final author batch committed.")
-        except Exception as e:
-            logging.error(f"Error committing final author batch: {e}")
+    committed, failed = writer.flush()
+    print(f"Author stats written: {committed} ok, {failed} failed.")
 
 def update_category_stats_memory(category_updates, date_str, category, sentiment, post_id=None, comment_id=None):
     """
@@ -538,21 +1104,12 @@ def commit_category_stats_non_transactional(category_updates, refs):
                 print(f"[{date_str}] No create payload generated for new doc.")
 
 
-# Main crawling function
-def crawl_subreddit(subreddit_name, model):
-    print(f"\n--- Starting crawl for r/{subreddit_name} ---")
-    last_timestamp = get_last_timestamp(subreddit_name)
-    print(f"[{subreddit_name}] Last timestamp: {datetime.datetime.fromtimestamp(last_timestamp)} ({last_timestamp})")
-    new_last_timestamp = last_timestamp
-
-    refs = get_collections(subreddit_name)
-    sub = reddit.subreddit(subreddit_name)
+# --- Crawl stages ---
+# Fetching (Reddit), analysis (Gemini) and storing (Firestore) are separate steps,
+# so a deferred run can fetch now and store once the batch job has finished.
 
-    updated_posts_count = 0
-    processed_comments_count = 0
-    new_comments_on_old_posts_count = 0
-
-    # --- In-memory stores for aggregation ---
+def new_aggregation_stores():
+    """Returns empty (author_updates, category_updates) stores for update_*_stats_memory."""
     author_updates = defaultdict(lambda: { # Use defaultdict for easier initialization
         "deltaSentimentScore": 0, "deltaPostCount": 0, "deltaCommentCount": 0,
         "deltaNegativeCount": 0, "deltaPositiveCount": 0,
@@ -562,484 +1119,907 @@ def crawl_subreddit(subreddit_name, model):
          "deltaSentiment": 0, "deltaCount": 0, "deltaPositiveCount": 0, "deltaNegativeCount": 0,
          "newPostIds": set(), "newComments": defaultdict(set)
     })
-    # ---
+    return author_updates, category_updates
 
-    try:
-        # =============================================
-        # 1. Process NEW posts and their comments
-        # =============================================
-        print(f"[{subreddit_name}] Fetching new submissions...")
-        for submission in sub.new(limit=100): # Adjust limit as needed
-            submission_time = submission.created_utc
-            if submission_time <= last_timestamp:
-                # print(f"[{subreddit_name}] Skipping post {submission.id} (already processed or older)")
-                continue # Skip already processed posts
+def fetch_new_post(submission, subreddit_name, reddit_client=None):
+    """
+    Reads a submission and its comments from Reddit, expanding "load more"
+    stubs within the per-post budget (reddit_fetch.fetch_comment_tree).
+    Returns (post_record, comment_records) as plain JSON-serializable dicts;
+    stubs left unexpanded are kept in post_record["pendingMoreComments"].
+    """
+    post_record = post_record_from(submission)
 
-            # Update the latest timestamp seen in this run
-            if submission_time > new_last_timestamp:
-                new_last_timestamp = submission_time
+    print(f"[{subreddit_name}] Fetching comments for post {submission.id}...")
+    all_comments, remaining, expansions = fetch_comment_tree(reddit_client or reddit, submission)
+    if remaining:
+        post_record["pendingMoreComments"] = remaining
+        print(f"[{subreddit_name}] Post {submission.id} partially expanded: {len(remaining)} 'load more' stubs left "
+              f"after {expansions} requests, resuming on a later run.")
+    print(f"[{subreddit_name}] Got {len(all_comments)} comments for post {submission.id}.")
 
-            print(f"[{subreddit_name}] Processing NEW post: {submission.id} : {submission.title[:50]}...")
+    # Skip deleted comments or malformed objects
+    return post_record, comment_records_from(submission, all_comments, subreddit_name)
 
-            try:
-                # --- Prepare Post Data ---
-                post_id = submission.id
-                post_author = str(submission.author) if submission.author else "[deleted]"
-                post_created_dt = datetime.datetime.fromtimestamp(submission_time)
-                post_date_str = post_created_dt.strftime("%Y-%m-%d")
-
-                # Initial post doc (summary, sentiment etc. will be added after comment processing)
-                post_doc = {
-                    "subreddit": subreddit_name,
-                    "title": submission.title,
-                    "author": post_author,
-                    "created": post_created_dt,
-                    "body": submission.selftext,
-                    "score": submission.score,
-                    "URL": submission.url,
-                    # Placeholders - will be updated later in one go
-                    "summary": "", "engagementScore": 0.0, "rawSentimentScore": 0.0,
-                    "weightedSentimentScore": 0.0, "category": "Uncategorized", "emotion": "Neutral",
-                    "sentiment": 0, "iit": "no", "relatedToTemasekPoly": False,
-                    "totalComments": 0, "totalPositiveSentiments": 0, "totalNegativeSentiments": 0
-                }
+def thread_parts_for(post_record, comment_records):
+    """Post body followed by comment bodies, the input of analyze_thread."""
+    return [post_record["body"]] + [comment["body"] for comment in comment_records]
 
-                # --- Process Comments ---
-                comments_data = [] # Store comment data temporarily
-                combined_post_comments = submission.selftext # Start summary text with post body
-
-                print(f"[{subreddit_name}] Fetching comments for post {post_id}...")
-                submission.comments.replace_more(limit=None) # Fetch all comments
-                all_comments = submission.comments.list()
-                print(f"[{subreddit_name}] Got {len(all_comments)} comments for post {post_id}.")
-
-
-                weighted_sentiment_sum = 0.0
-                total_weight = 0.0
-                raw_sentiment_score_agg = 0.0 # Renamed to avoid clash with post_doc field
-                total_comments_agg = 0       # Renamed
-                total_positive_sentiments_agg = 0 # Renamed
-                total_negative_sentiments_agg = 0 # Renamed
-
-                # Use a batch for writing comments of this post
-                comment_batch = db.batch()
-                comment_write_count = 0
-
-                for comment in all_comments:
-                    if not hasattr(comment, 'body') or not hasattr(comment, 'id') or not hasattr(comment, 'author'):
-                        logging.warning(f"[{subreddit_name}] Skipping malformed comment object in post {post_id}")
-                        continue # Skip deleted comments or malformed objects
-
-                    comment_id = comment.id
-                    comment_author = str(comment.author) if comment.author else "[deleted]"
-                    comment_body = comment.body
-                    comment_score = comment.score
-                    comment_created_dt = datetime.datetime.fromtimestamp(comment.created_utc) if hasattr(comment, 'created_utc') else post_created_dt # Fallback
-                    comment_date_str = comment_created_dt.strftime("%Y-%m-%d")
-
-                    combined_post_comments += f"\n{comment_body}" # Append for overall summary/sentiment
-
-                    # --- Gemini Analysis for Comment ---
-                    # prompt = f"""
-                    # Analyze the following Reddit comment.
-                    # Provide output as: <sentiment_score>,<emotion>,<category>,<iit_flag>
-                    # - sentiment_score: 1 (positive), -1 (negative), 0 (neutral)
-                    # - emotion: happy, relief, stress, frustration, pride, disappointment, confusion, neutral
-                    # - category: academic, exams, facilities, subjects, administration, career, admission, results, internship, lecturer, student life, infrastructure, classroom, events, CCA, other
-                    # - iit_flag: yes (related to School of IIT/Informatics & IT programs, including diplomas such as Big Data Analytics/BDA, 
-                    # Applied Artificial Intelligence/AAI,
-                    # Information Technology,
-                    # Cyber Security & Digital Forensics/CDF,
-                    # Immersive Media & Game Development/IGD
-                    # ) or no
-                    # Text: "{comment_body}"
-                    # """
-
-                    prompt = PROMPT_COMMENT + f" Text: ${comment.body}"
-                    response_text = safe_generate_content(model, prompt)
-                    parts = response_text.split(',')
-
-                    # Default values in case of parsing failure
-                    sentiment = 0
-                    emotion = "Neutral"
-                    category = "Uncategorized" # Default category
-                    iit_flag = "no"
-
-                    if len(parts) >= 4:
-                        try:
-                            sentiment = int(parts[0].strip())
-                        except ValueError:
-                            logging.warning(f"[{subreddit_name}] Failed to parse sentiment for comment {comment_id} in post {post_id}. Response: {response_text}")
-                        emotion = parts[1].strip() if parts[1].strip() else "Neutral"
-                        category = parts[2].strip().lower() if parts[2].strip() else "Uncategorized" # Use lower case consistently
-                        iit_flag = parts[3].strip().lower() if parts[3].strip().lower() in ["yes", "no"] else "no"
-                    else:
-                         logging.warning(f"[{subreddit_name}] Unexpected Gemini response format for comment {comment_id}. Response: {response_text}")
-
-
-                    # --- Aggregate Comment Stats ---
-                    weight = 1 + math.log2(max(comment_score, 0) + 1)
-                    weighted_sentiment_sum += sentiment * weight
-                    total_weight += weight
-                    raw_sentiment_score_agg += sentiment
-                    total_comments_agg += 1
-                    processed_comments_count += 1
-
-                    if sentiment > 0:
-                        total_positive_sentiments_agg += sentiment # Summing the scores (e.g., all +1s)
-                    elif sentiment < 0:
-                        total_negative_sentiments_agg += sentiment # Summing the scores (e.g., all -1s)
-
-                    # --- Prepare Comment Document for Batch ---
-                    comment_doc = {
-                        "body": comment_body,
-                        "author": comment_author,
-                        "created": comment_created_dt,
-                        "score": comment_score,
-                        "sentiment": sentiment,
-                        "emotion": emotion,
-                        "category": category,
-                        "iit": iit_flag,
-                        # Add parent post id if needed for easier querying, though structure implies it
-                        # "postId": post_id
-                    }
-                    comment_ref = refs["posts"].document(post_id).collection("comments").document(comment_id)
-                    comment_batch.set(comment_ref, comment_doc)
-                    comment_write_count += 1
-
-                    # --- Update In-Memory Aggregations ---
-                    update_author_stats_memory(author_updates, comment_author, sentiment, is_post=False, post_id=post_id, comment_id=comment_id)
-                    update_category_stats_memory(category_updates, comment_date_str, category, sentiment, post_id=post_id, comment_id=comment_id)
-
-                    # Commit comment batch periodically if needed (unlikely for single post)
-                    if comment_write_count >= BATCH_COMMIT_SIZE:
-                         print(f"[{subreddit_name}] Committing intermediate comment batch for post {post_id} ({comment_write_count} ops)...")
-                         try:
-                             comment_batch.commit()
-                             print(f"[{subreddit_name}] Intermediate comment batch committed.")
-                             comment_batch = db.batch() # New batch
-                             comment_write_count = 0
-                         except Exception as e:
-                             logging.error(f"[{subreddit_name}] Error committing intermediate comment batch for post {post_id}: {e}")
-                             comment_batch = db.batch() # Reset batch on error
-                             comment_write_count = 0
-
-
-                # Commit remaining comments for the post
-                if comment_write_count > 0:
-                    print(f"[{subreddit_name}] Committing final comment batch for post {post_id} ({comment_write_count} ops)...")
-                    try:
-                        comment_batch.commit()
-                        print(f"[{subreddit_name}] Final comment batch committed for post {post_id}.")
-                    except Exception as e:
-                         logging.error(f"[{subreddit_name}] Error committing final comment batch for post {post_id}: {e}")
-
-
-                # --- Gemini Analysis for Overall Post (incl. comments) ---
-                print(f"[{subreddit_name}] Analyzing overall post {post_id}...")
-                # prompt_overall = f"""
-                # Analyze the following Reddit post and its comments.
-                # Provide output as: <sentiment_score>,<emotion>,<category>,<iit_flag>
-                # - sentiment_score: 1 (positive), -1 (negative), 0 (neutral)
-                # - emotion: happy, relief, stress, frustration, pride, disappointment, confusion, neutral
-                # - category: academic, exams, facilities, subjects, administration, career, admission, results, internship, lecturer, student life, infrastructure, classroom, events, CCA, other
-                # - iit_flag: yes (related to School of IIT/Informatics & IT programs, including diplomas such as Big Data Analytics/BDA, 
-                # Applied Artificial Intelligence/AAI,
-                # Information Technology,
-                # Cyber Security & Digital Forensics/CDF,
-                # Immersive Media & Game Development/IGD
-                # ) or no
-                # Text: "{combined_post_comments}"
-                # """
-
-                prompt_overall = PROMPT_POST_COMMENTS + f" Text: ${combined_post_comments}"
-                response_text_overall = safe_generate_content(model, prompt_overall)
-                parts_overall = response_text_overall.split(',')
-
-                # Default values
-                post_sentiment = 0
-                post_emotion = "Neutral"
-                post_category = "Uncategorized"
-                post_iit_flag = "no"
-
-                if len(parts_overall) >= 4:
-                    try:
-                        post_sentiment = int(parts_overall[0].strip())
-                    except ValueError:
-                         logging.warning(f"[{subreddit_name}] Failed to parse overall sentiment for post {post_id}. Response: {response_text_overall}")
-                    post_emotion = parts_overall[1].strip() if parts_overall[1].strip() else "Neutral"
-                    post_category = parts_overall[2].strip().lower() if parts_overall[2].strip() else "Uncategorized"
-                    post_iit_flag = parts_overall[3].strip().lower() if parts_overall[3].strip().lower() in ["yes", "no"] else "no"
-                else:
-                    logging.warning(f"[{subreddit_name}] Unexpected Gemini response format for overall post {post_id}. Response: {response_text_overall}")
-
-                # --- Gemini Summary ---
-                # prompt_summary = f"""
-                # Create a 3-paragraph summary of the Reddit post and comments.
-                # 1.  Summarize key topics/themes.
-                # 2.  Describe overall sentiment/emotion, mentioning specific subjects, facilities, or campus life aspects if relevant.
-                # 3.  (If applicable) Highlight concerns or suggestions for authorities, referencing specifics.
-                # If the text is too short or lacks meaning, state: "The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations."
-                # Do not use headings.
-                # Text: "{combined_post_comments}"
-                # """
-                prompt_summary = PROMPT_SUMMARY + f" Text: ${combined_post_comments}"
-                summary = safe_generate_content(model, prompt_summary)
-
-
-                # --- Final Calculations for Post ---
-                weighted_sentiment_score = weighted_sentiment_sum / total_weight if total_weight > 0 else 0
-                engagement_score = (submission.score + 1) * math.log2(total_comments_agg + 1) # Use aggregated count
-                related_to_tp = detect_temasek_poly_related(combined_post_comments)
-
-                # --- Update In-Memory Aggregations for Post Author & Category ---
-                update_author_stats_memory(author_updates, post_author, post_sentiment, is_post=True, post_id=post_id)
-                update_category_stats_memory(category_updates, post_date_str, post_category, post_sentiment, post_id=post_id)
-
-
-                # --- CONSOLIDATED Post Update ---
-                post_update_data = {
-                    "summary": summary,
-                    "engagementScore": engagement_score,
-                    "rawSentimentScore": raw_sentiment_score_agg, # Use aggregated value
-                    "weightedSentimentScore": weighted_sentiment_score,
-                    "sentiment": post_sentiment, # Overall sentiment from Gemini
-                    "emotion": post_emotion,
-                    "category": post_category,
-                    "iit": post_iit_flag,
-                    "relatedToTemasekPoly": related_to_tp,
-                    "totalComments": total_comments_agg,
-                    "totalPositiveSentiments": total_positive_sentiments_agg,
-                    "totalNegativeSentiments": total_negative_sentiments_agg,
-                    "lastUpdated": firestore.SERVER_TIMESTAMP # Track when updated
-                }
+def store_new_post(refs, subreddit_name, post_record, comment_records, classifications, analysis, author_updates, category_updates):
+    """
+    Writes a new post and its classified comments to Firestore and adds them
+    to the in-memory author/category aggregations.
+    `classifications` is {comment_id: (sentiment, emotion, category, iit_flag)},
+    `analysis` is (sentiment, emotion, category, iit_flag, summary) for the whole thread.
+    """
+    post_id = post_record["post_id"]
+    post_author = post_record["author"]
+    post_created_dt = datetime.datetime.fromtimestamp(post_record["created_utc"])
+    post_date_str = post_created_dt.strftime("%Y-%m-%d")
+
+    # Initial post doc (summary, sentiment etc. are added with the update below)
+    post_doc = {
+        "subreddit": subreddit_name,
+        "title": post_record["title"],
+        "author": post_author,
+        "created": post_created_dt,
+        "body": post_record["body"],
+        "score": post_record["score"],
+        "URL": post_record["url"],
+        # Placeholders - will be updated later in one go
+        "summary": "", "engagementScore": 0.0, "rawSentimentScore": 0.0,
+        "weightedSentimentScore": 0.0, "category": "Uncategorized", "emotion": "Neutral",
+        "sentiment": 0, "iit": "no", "relatedToTemasekPoly": False,
+        "totalComments": 0, "totalPositiveSentiments": 0, "totalNegativeSentiments": 0
+    }
 
-                # Write the initial post doc and the update in one go if possible,
-                # but usually safer to set first, then update.
-                # Let's set the initial doc then update with aggregated/analyzed data.
-                post_ref = refs["posts"].document(post_id)
-                post_ref.set(post_doc, merge=True) # Use merge=True just in case it ran partially before
-                post_ref.update(post_update_data) # Single update call!
+    weighted_sentiment_sum = 0.0
+    total_weight = 0.0
+    raw_sentiment_score_agg = 0.0 # Renamed to avoid clash with post_doc field
+    total_comments_agg = 0       # Renamed
+    total_positive_sentiments_agg = 0 # Renamed
+    total_negative_sentiments_agg = 0 # Renamed
+
+    # Use a batch for writing comments of this post
+    comment_writer = new_writer(f"[{subreddit_name}] post {post_id} comments")
+
+    for comment in comment_records:
+        comment_id = comment["comment_id"]
+        comment_author = comment["author"]
+        comment_score = comment["score"]
+        comment_created_dt = datetime.datetime.fromtimestamp(comment["created_utc"])
+        comment_date_str = comment_created_dt.strftime("%Y-%m-%d")
+
+        sentiment, emotion, category, iit_flag = classifications[comment_id]
+
+        # --- Aggregate Comment Stats ---
+        weight = 1 + math.log2(max(comment_score, 0) + 1)
+        weighted_sentiment_sum += sentiment * weight
+        total_weight += weight
+        raw_sentiment_score_agg += sentiment
+        total_comments_agg += 1
+
+        if sentiment > 0:
+            total_positive_sentiments_agg += sentiment # Summing the scores (e.g., all +1s)
+        elif sentiment < 0:
+            total_negative_sentiments_agg += sentiment # Summing the scores (e.g., all -1s)
+
+        # --- Prepare Comment Document for Batch ---
+        comment_doc = {
+            "body": comment["body"],
+            "author": comment_author,
+            "created": comment_created_dt,
+            "score": comment_score,
+            "sentiment": sentiment,
+            "emotion": emotion,
+            "category": category,
+            "iit": iit_flag,
+            # Add parent post id if needed for easier querying, though structure implies it
+            # "postId": post_id
+        }
+        if comment.get("duplicateOf"):
+            comment_doc["duplicateOf"] = comment["duplicateOf"] # Labels copied from this near-duplicate
+        comment_ref = refs["posts"].document(post_id).collection("comments").document(comment_id)
+        comment_writer.set(comment_ref, comment_doc)
+
+        # --- Update In-Memory Aggregations ---
+        update_author_stats_memory(author_updates, comment_author, sentiment, is_post=False, post_id=post_id, comment_id=comment_id)
+        update_category_stats_memory(category_updates, comment_date_str, category, sentiment, post_id=post_id, comment_id=comment_id)
+
+    # Commit the comments of the post
+    committed, failed = comment_writer.flush()
+    if committed or failed:
+        print(f"[{subreddit_name}] Comments of post {post_id} written: {committed} ok, {failed} failed.")
+
+    post_sentiment, post_emotion, post_category, post_iit_flag, summary = analysis
+
+    # --- Final Calculations for Post ---
+    weighted_sentiment_score = weighted_sentiment_sum / total_weight if total_weight > 0 else 0
+    engagement_score = engagement_score_for(post_record["score"], total_comments_agg) # Use aggregated count
+    related_to_tp = any(detect_temasek_poly_related(part) for part in thread_parts_for(post_record, comment_records))
+
+    # --- Update In-Memory Aggregations for Post Author & Category ---
+    update_author_stats_memory(author_updates, post_author, post_sentiment, is_post=True, post_id=post_id)
+    update_category_stats_memory(category_updates, post_date_str, post_category, post_sentiment, post_id=post_id)
+
+
+    # --- CONSOLIDATED Post Update ---
+    post_update_data = {
+        "summary": summary,
+        "engagementScore": engagement_score,
+        "rawSentimentScore": raw_sentiment_score_agg, # Use aggregated value
+        "weightedSentimentScore": weighted_sentiment_score,
+        "sentiment": post_sentiment, # Overall sentiment from Gemini
+        "emotion": post_emotion,
+        "category": post_category,
+        "iit": post_iit_flag,
+        "relatedToTemasekPoly": related_to_tp,
+        "totalComments": total_comments_agg,
+        "totalPositiveSentiments": total_positive_sentiments_agg,
+        "totalNegativeSentiments": total_negative_sentiments_agg,
+        "summaryCommentCount": total_comments_agg, # Comments covered by the summary
+        "lastUpdated": firestore.SERVER_TIMESTAMP # Track when updated
+    }
+    if post_record.get("duplicateOf"):
+        post_update_data["duplicateOf"] = post_record["duplicateOf"] # Analysis copied from this near-duplicate
+    if post_record.get("pendingMoreComments"):
+        # Comments still behind "load more" stubs, picked up by resume_partial_posts() on later runs
+        post_update_data["commentsPartial"] = True
+        post_update_data["pendingMoreComments"] = post_record["pendingMoreComments"]
+
+    # Set the initial doc, then update with the aggregated/analyzed data
+    post_ref = refs["posts"].document(post_id)
+    post_ref.set(post_doc, merge=True) # Use merge=True just in case it ran partially before
+    if id_index is not None:
+        id_index.add([post_ref.path])
+    post_ref.update(post_update_data) # Single update call!
+
+    print(f"[{subreddit_name}] Successfully processed and updated post {post_id}.")
+    get_telemetry().add_posts(1)
+    return total_comments_agg
+
+def resolve_submissions(reddit_client, fullnames, subreddit_name=""):
+    """
+    {fullname: submission} for submission fullnames ("t3_..."), looked up with
+    reddit.info() REDDIT_INFO_BATCH at a time. Fullnames Reddit does not return
+    (removed posts) or whose lookup failed are missing from the result.
+    """
+    fullnames = list(dict.fromkeys(fullnames))
+    submissions = {}
+    for i in range(0, len(fullnames), REDDIT_INFO_BATCH):
+        chunk = fullnames[i:i + REDDIT_INFO_BATCH]
+        try:
+            for submission in reddit_client.info(fullnames=chunk):
+                submissions[submission.fullname] = submission
+        except Exception as e:
+            logging.error(f"[{subreddit_name}] Error resolving {len(chunk)} submissions with reddit.info(): {e}")
+    return submissions
+
+def get_existing_documents(doc_refs, chunk_size=FIRESTORE_GET_ALL_CHUNK):
+    """{document path: snapshot} of the documents among `doc_refs` that exist, read with batched get_all() calls."""
+    found = {}
+    for i in range(0, len(doc_refs), chunk_size):
+        for snapshot in db.get_all(doc_refs[i:i + chunk_size]):
+            if snapshot.exists:
+                found[snapshot.reference.path] = snapshot
+    return found
+
+def new_writer(context=""):
+    """BulkWriter whose committed set() writes are recorded in the local ID index."""
+    return BulkWriter(db, index=id_index, context=context)
+
+def find_stored(doc_refs):
+    """
+    Paths of the documents among `doc_refs` that exist. The local ID index
+    answers for what it knows and for collections it fully covers; only the
+    rest is read from Firestore (and added to the index).
+    """
+    if id_index is None:
+        return set(get_existing_documents(doc_refs))
+    stored = id_index.known([ref.path for ref in doc_refs])
+    unsure = [ref for ref in doc_refs if ref.path not in stored and not id_index.covers(ref.path)]
+    if unsure:
+        found = get_existing_documents(unsure)
+        id_index.add(found)
+        stored.update(found)
+    return stored
+
+def find_new_comments_on_old_posts(sub, refs, subreddit_name, last_timestamp, limit=RECENT_COMMENTS_LIMIT, reddit_client=None):
+    """
+    Scans the subreddit's recent comments for ones posted on already stored posts.
+    With limit=None (catch-up) the listing is paged back until `last_timestamp`.
+    Parent submissions are resolved in bulk with reddit.info() and stored
+    comments/posts are checked with batched Firestore reads, instead of one
+    lazy submission fetch and two get() calls per comment.
+    Returns (comment_records, old_posts_data) where each record also carries its
+    post_id and old_posts_data maps post_id to the stored post fields.
+    """
+    comment_records = []
+    old_posts_data = {}
+    reached = False
+    oldest_seen = None
+    listed = 0
+    candidates = [] # Comments newer than last_timestamp
+
+    for comment in sub.comments(limit=limit):
+        listed += 1
+        if not hasattr(comment, 'created_utc') or not hasattr(comment, 'id') or not hasattr(comment, 'link_id'):
+            continue # Skip malformed
+
+        comment_created_utc = comment.created_utc
+        if comment_created_utc <= last_timestamp:
+            reached = True
+            if limit is None:
+                break # The listing is newest first, the rest is older still
+            continue
+        oldest_seen = comment_created_utc if oldest_seen is None else min(oldest_seen, comment_created_utc)
+        candidates.append(comment)
+
+    if not reached and last_timestamp > 0 and oldest_seen is not None and (limit is None or listed >= limit):
+        report_gap(refs, subreddit_name, "comments", last_timestamp, oldest_seen)
+    if not candidates:
+        return comment_records, old_posts_data
+
+    # Skip comments whose parent post was processed *in this run*
+    # (avoids double processing comments added during the run)
+    submissions = resolve_submissions(reddit_client or reddit, [comment.link_id for comment in candidates], subreddit_name)
+    candidates = [comment for comment in candidates
+                  if comment.link_id in submissions and submissions[comment.link_id].created_utc <= last_timestamp]
+
+    # Check if comment *documents* already exist (more robust than just timestamp),
+    # then read the parent posts of the remaining ones
+    post_refs = {}
+    comment_refs = {}
+    for comment in candidates:
+        post_id = comment.link_id.split("_", 1)[1]
+        post_refs.setdefault(post_id, refs["posts"].document(post_id))
+        comment_refs[comment.id] = post_refs[post_id].collection("comments").document(comment.id)
+    stored_comments = find_stored(list(comment_refs.values()))
+    candidates = [comment for comment in candidates if comment_refs[comment.id].path not in stored_comments]
+    parent_ids = {comment.link_id.split("_", 1)[1] for comment in candidates}
+    existing = get_existing_documents([post_refs[post_id] for post_id in parent_ids])
+
+    for comment in candidates:
+        try:
+            post_id = comment.link_id.split("_", 1)[1]
+            comment_id = comment.id
+            post_snapshot = existing.get(post_refs[post_id].path)
+            if post_snapshot is None:
+                 logging.warning(f"[{subreddit_name}] Skipping comment {comment_id} as parent post {post_id} not found.")
+                 continue # Parent post not in DB, skip
+            old_posts_data[post_id] = post_snapshot.to_dict() or {}
+
+            print(f"[{subreddit_name}] Found NEW comment {comment_id} on OLD post {post_id}")
+
+            comment_records.append({
+                "post_id": post_id,
+                "comment_id": comment_id,
+                "author": str(comment.author) if comment.author else "[deleted]",
+                "body": comment.body,
+                "score": comment.score,
+                "created_utc": comment.created_utc,
+            })
 
-                print(f"[{subreddit_name}] Successfully processed and updated post {post_id}.")
-                updated_posts_count += 1
+        except Exception as e:
+            logging.exception(f"[{subreddit_name}] Unexpected error processing comment {getattr(comment, 'id', 'N/A')} on old post: {e}")
+            continue # Continue with the next comment
 
-            except praw.exceptions.PRAWException as pe:
-                 logging.error(f"[{subreddit_name}] PRAW error processing submission {submission.id}: {pe}")
-                 print(f"[{subreddit_name}] PRAW Error on {submission.id}: {pe}")
-            except Exception as e:
-                logging.exception(f"[{subreddit_name}] Unexpected error processing submission {submission.id}: {e}") # Log full traceback
-                print(f"[{subreddit_name}] Error on {submission.id}: {e}")
-                # Continue to next submission
+    return comment_records, old_posts_data
+
+def resume_partial_posts(reddit_client, refs, subreddit_name, limit=MORE_COMMENTS_RESUME_POSTS, skip_post_ids=()):
+    """
+    Continues expanding the "load more" stubs of posts stored with commentsPartial,
+    within the usual per-post budget. Posts in `skip_post_ids` (stored earlier in
+    this run, so they already had this run's budget) are left for the next run.
+    Returns (comment_records, old_posts_data, expansion_state) where the records
+    carry their post_id (like find_new_comments_on_old_posts) and expansion_state
+    maps post_id to the stubs still left, for save_expansion_state().
+    """
+    comment_records = []
+    old_posts_data = {}
+    expansion_state = {}
+
+    for post_snapshot in refs["posts"].where("commentsPartial", "==", True).limit(limit).stream():
+        post_id = post_snapshot.id
+        if post_id in skip_post_ids:
+            continue
+        post_data = post_snapshot.to_dict() or {}
+        stubs = post_data.get("pendingMoreComments") or []
+        comments, remaining, expansions = expand_more_comments(reddit_client, post_id, stubs)
+        if not expansions and stubs:
+            continue # Nothing could be fetched, try again next run
+
+        # Skip comments that reached Firestore another way (e.g. the recent comment scan)
+        comment_refs = {comment.id: refs["posts"].document(post_id).collection("comments").document(comment.id) for comment in comments}
+        stored = find_stored(list(comment_refs.values()))
+        post_created = post_data.get("created")
+        new_records = []
+        for comment in comments:
+            if comment_refs[comment.id].path in stored or not hasattr(comment, 'body'):
                 continue
+            new_records.append({
+                "post_id": post_id,
+                "comment_id": comment.id,
+                "author": str(comment.author) if comment.author else "[deleted]",
+                "body": comment.body,
+                "score": comment.score,
+                "created_utc": getattr(comment, 'created_utc', post_created.timestamp() if post_created else time.time()),
+            })
+        print(f"[{subreddit_name}] Resumed post {post_id}: {len(new_records)} more comments from {expansions} requests, "
+              f"{len(remaining)} 'load more' stubs left.")
+        comment_records.extend(new_records)
+        old_posts_data[post_id] = post_data
+        expansion_state[post_id] = remaining
+
+    return comment_records, old_posts_data, expansion_state
+
+def save_expansion_state(refs, subreddit_name, expansion_state):
+    """Stores the stubs left on resumed posts; posts with none left stop being partial."""
+    if not expansion_state:
+        return
+    with BulkWriter(db, context=f"[{subreddit_name}] comment expansion state") as writer:
+        for post_id, remaining in expansion_state.items():
+            writer.update(refs["posts"].document(post_id), {"commentsPartial": bool(remaining), "pendingMoreComments": remaining})
 
-        # =====================================================
-        # 2. Check for NEW Comments on OLD Posts (Hybrid Approach)
-        # =====================================================
-        print(f"\n[{subreddit_name}] Scanning recent comments for updates to older posts...")
-        # Use a batch for writing these new comments
-        new_comment_batch = db.batch()
-        new_comment_write_count = 0
-        # Track posts that need recalculation due to new comments
-        posts_to_recalculate = defaultdict(list) # {post_id: [new_comment_data_dict]}
+def store_comments_on_old_posts(refs, subreddit_name, comment_records, classifications, author_updates, category_updates):
+    """
+    Writes classified new comments on old posts and adds them to the aggregations.
+    Returns {post_id: [{'sentiment', 'score'}, ...]} for the posts that need recalculating.
+    """
+    new_comment_writer = new_writer(f"[{subreddit_name}] new comments on old posts")
+    posts_to_recalculate = defaultdict(list)
 
+    for new_comment in comment_records:
         try:
-            # Limit might need adjustment based on comment frequency vs. run frequency
-            for comment in sub.comments(limit=200):
-                if not hasattr(comment, 'created_utc') or not hasattr(comment, 'id') or not hasattr(comment, 'submission'):
-                    continue # Skip malformed
-
-                comment_created_utc = comment.created_utc
-                # Skip if comment is not new OR if its parent post was processed *in this run*
-                # (avoids double processing comments added during the run)
-                if comment_created_utc <= last_timestamp or comment.submission.created_utc > last_timestamp:
-                    continue
+            post_id = new_comment["post_id"]
+            comment_id = new_comment["comment_id"]
+            comment_author = new_comment["author"]
+            comment_score = new_comment["score"]
+            comment_created_dt = datetime.datetime.fromtimestamp(new_comment["created_utc"])
+            sentiment, emotion, category, iit_flag = classifications[comment_id]
+
+            comment_doc = {
+                "body": new_comment["body"], "author": comment_author, "created": comment_created_dt,
+                "score": comment_score, "sentiment": sentiment, "emotion": emotion,
+                "category": category, "iit": iit_flag
+            }
+            if new_comment.get("duplicateOf"):
+                comment_doc["duplicateOf"] = new_comment["duplicateOf"]
 
-                try:
-                    post_id = comment.submission.id
-                    comment_id = comment.id
-
-                    # Check if comment *document* already exists (more robust than just timestamp)
-                    comment_ref = refs["posts"].document(post_id).collection("comments").document(comment_id)
-                    if comment_ref.get().exists:
-                        # print(f"[{subreddit_name}] Skipping comment {comment_id} on old post {post_id} (already exists)")
-                        continue # Already stored
-
-                    # Check if parent post exists (it should if it's older)
-                    post_ref = refs["posts"].document(post_id)
-                    post_snapshot = post_ref.get()
-                    if not post_snapshot.exists:
-                         logging.warning(f"[{subreddit_name}] Skipping comment {comment_id} as parent post {post_id} not found.")
-                         continue # Parent post not in DB, skip
-
-                    print(f"[{subreddit_name}] Found NEW comment {comment_id} on OLD post {post_id}")
-
-                    # --- Process the new comment (similar to above) ---
-                    comment_author = str(comment.author) if comment.author else "[deleted]"
-                    comment_body = comment.body
-                    comment_score = comment.score
-                    comment_created_dt = datetime.datetime.fromtimestamp(comment_created_utc)
-                    comment_date_str = comment_created_dt.strftime("%Y-%m-%d")
-
-                    # prompt = f"""
-                    # Analyze the following Reddit comment.
-                    # Provide output as: <sentiment_score>,<emotion>,<category>,<iit_flag>
-                    # - sentiment_score: 1 (positive), -1 (negative), 0 (neutral)
-                    # - emotion: happy, relief, stress, frustration, pride, disappointment, confusion, neutral
-                    # - category: academic, exams, facilities, subjects, administration, career, admission, results, internship, lecturer, student life, infrastructure, classroom, events, CCA, other
-                    # - iit_flag: yes (related to School of IIT/Informatics & IT programs, including diplomas such as Big Data Analytics/BDA, 
-                    # Applied Artificial Intelligence/AAI,
-                    # Information Technology,
-                    # Cyber Security & Digital Forensics/CDF,
-                    # Immersive Media & Game Development/IGD
-                    # ) or no
-                    # Text: "{comment_body}"
-                    # """
-                    prompt_comment = PROMPT_COMMENT + f" Text: ${comment_body}"
-                    response_text = safe_generate_content(model, prompt_comment)
-                    parts = response_text.split(',')
-                    # Parse response with defaults (same logic as above)
-                    sentiment = 0; emotion = "Neutral"; category = "Uncategorized"; iit_flag = "no"
-                    if len(parts) >= 4:
-                        try: sentiment = int(parts[0].strip())
-                        except ValueError: pass
-                        emotion = parts[1].strip() or "Neutral"
-                        category = parts[2].strip().lower() or "Uncategorized"
-                        iit_flag = parts[3].strip().lower() if parts[3].strip().lower() in ["yes", "no"] else "no"
-                    else:
-                         logging.warning(f"[{subreddit_name}] Unexpected Gemini format for new comment {comment_id} on old post {post_id}.")
-
-                    comment_doc = {
-                        "body": comment_body, "author": comment_author, "created": comment_created_dt,
-                        "score": comment_score, "sentiment": sentiment, "emotion": emotion,
-                        "category": category, "iit": iit_flag
-                    }
-
-                    # Add comment write to batch
-                    new_comment_batch.set(comment_ref, comment_doc)
-                    new_comment_write_count += 1
-                    new_comments_on_old_posts_count += 1
-                    processed_comments_count += 1 # Also count this as a processed comment
-
-                    # Add data needed for recalculation later
-                    posts_to_recalculate[post_id].append({
-                        'sentiment': sentiment, 'score': comment_score
+            # Add comment write to batch
+            comment_ref = refs["posts"].document(post_id).collection("comments").document(comment_id)
+            new_comment_writer.set(comment_ref, comment_doc)
+
+            # Add data needed for recalculation later
+            posts_to_recalculate[post_id].append({
+                'sentiment': sentiment, 'score': comment_score
+            })
+
+
+            # --- Update In-Memory Aggregations ---
+            update_author_stats_memory(author_updates, comment_author, sentiment, is_post=False, post_id=post_id, comment_id=comment_id)
+            update_category_stats_memory(category_updates, comment_created_dt.strftime("%Y-%m-%d"), category, sentiment, post_id=post_id, comment_id=comment_id)
+
+        except Exception as e:
+            logging.exception(f"[{subreddit_name}] Unexpected error storing comment {new_comment.get('comment_id', 'N/A')} on old post: {e}")
+            continue # Continue with the next comment
+
+    # Commit the new comments before their posts are recalculated from Firestore
+    committed, failed = new_comment_writer.flush()
+    if committed or failed:
+        print(f"[{subreddit_name}] New comments on old posts written: {committed} ok, {failed} failed.")
+
+    return posts_to_recalculate
+
+def recalculate_old_posts(model, refs, subreddit_name, posts_to_recalculate, old_posts_data=None):
+    """
+    Recomputes the comment aggregates of old posts that received new comments
+    and refreshes their summary once enough unsummarized comments have piled up.
+    Posts missing from `old_posts_data` are read from Firestore.
+    """
+    if not posts_to_recalculate:
+        return
+    old_posts_data = old_posts_data or {}
+
+    print(f"\n[{subreddit_name}] Recalculating stats for {len(posts_to_recalculate)} old posts with new comments...")
+    recalc_writer = BulkWriter(db, context=f"[{subreddit_name}] recalc")
+
+    for post_id, new_comments in posts_to_recalculate.items():
+        try:
+            post_ref = refs["posts"].document(post_id)
+            # Fetch ALL comments for the post *now* including the newly added ones
+            comments_snapshot = post_ref.collection("comments").stream()
+
+            # Recalculate aggregate scores
+            total_comments = 0
+            total_positive = 0
+            total_negative = 0
+            weighted_sum = 0.0
+            weight_total = 0.0
+            raw_sum = 0.0
+            comment_entries = [] # (created, body) for the summary refresh
+
+            for c_snap in comments_snapshot:
+                c_data = c_snap.to_dict()
+                sent = c_data.get("sentiment", 0)
+                score = c_data.get("score", 0)
+                comment_entries.append((c_data.get("created"), c_data.get("body", "")))
+
+                weight = 1 + math.log2(max(score, 0) + 1)
+                weighted_sum += sent * weight
+                weight_total += weight
+                raw_sum += sent
+                total_comments += 1
+                if sent > 0:
+                    total_positive += sent
+                elif sent < 0:
+                    total_negative += sent
+
+            # Calculate final scores
+            weighted_sent = weighted_sum / weight_total if weight_total > 0 else 0
+
+            # Prepare update data for the post
+            post_recalc_update = {
+                'totalComments': total_comments,
+                'totalPositiveSentiments': total_positive,
+                'totalNegativeSentiments': total_negative,
+                'weightedSentimentScore': weighted_sent,
+                'rawSentimentScore': raw_sum, # Update raw score too
+                'lastUpdated': firestore.SERVER_TIMESTAMP
+            }
+
+            # --- Incremental summary refresh ---
+            # Posts written before summaryCommentCount existed are assumed to be
+            # summarized up to the comments stored before this run.
+            post_data = old_posts_data.get(post_id)
+            if post_data is None:
+                post_data = post_ref.get().to_dict() or {}
+            summarized_count = post_data.get(
+                "summaryCommentCount", total_comments - len(new_comments))
+            summarized_count = max(0, min(summarized_count, total_comments))
+            unsummarized_count = total_comments - summarized_count
+            if (SUMMARY_REFRESH_MIN_NEW_COMMENTS > 0
+                    and unsummarized_count >= SUMMARY_REFRESH_MIN_NEW_COMMENTS
+                    and post_data.get("summary")):
+                # Comments are only ever added, so the newest ones are the unsummarized ones
+                comment_entries.sort(key=lambda entry: entry[0].timestamp() if entry[0] else 0)
+                new_bodies = [body for _, body in comment_entries[summarized_count:]]
+                print(f"[{subreddit_name}] Refreshing summary of post {post_id} with {len(new_bodies)} new comments...")
+                refreshed = refresh_post_summary(
+                    model, post_data["summary"], new_bodies, context=f"[{subreddit_name}] post {post_id}")
+                if refreshed:
+                    r_sentiment, r_emotion, r_category, r_iit_flag, r_summary = refreshed
+                    post_recalc_update.update({
+                        'summary': r_summary,
+                        'sentiment': r_sentiment,
+                        'emotion': r_emotion,
+                        'category': r_category,
+                        'iit': r_iit_flag,
+                        'summaryCommentCount': total_comments,
                     })
 
+            # Add update to batch
+            recalc_writer.update(post_ref, post_recalc_update)
 
-                    # --- Update In-Memory Aggregations ---
-                    update_author_stats_memory(author_updates, comment_author, sentiment, is_post=False, post_id=post_id, comment_id=comment_id)
-                    update_category_stats_memory(category_updates, comment_date_str, category, sentiment, post_id=post_id, comment_id=comment_id)
+        except Exception as e:
+            logging.error(f"[{subreddit_name}] Error recalculating stats for old post {post_id}: {e}")
+            continue # Skip to next post on error
 
-                    # Commit batch periodically
-                    if new_comment_write_count >= BATCH_COMMIT_SIZE:
-                        print(f"[{subreddit_name}] Committing intermediate new comment batch ({new_comment_write_count} ops)...")
-                        try:
-                            new_comment_batch.commit()
-                            print(f"[{subreddit_name}] Intermediate new comment batch committed.")
-                            new_comment_batch = db.batch()
-                            new_comment_write_count = 0
-                        except Exception as e:
-                            logging.error(f"[{subreddit_name}] Error committing intermediate new comment batch: {e}")
-                            new_comment_batch = db.batch() # Reset
-                            new_comment_write_count = 0
+    committed, failed = recalc_writer.flush()
+    print(f"[{subreddit_name}] Recalculated posts written: {committed} ok, {failed} failed.")
 
+def engagement_score_for(score, total_comments):
+    return (score + 1) * math.log2(total_comments + 1)
 
-                except praw.exceptions.PRAWException as pe:
-                     logging.error(f"[{subreddit_name}] PRAW error processing comment {getattr(comment, 'id', 'N/A')} on old post: {pe}")
-                except Exception as e:
-                    logging.exception(f"[{subreddit_name}] Unexpected error processing comment {getattr(comment, 'id', 'N/A')} on old post: {e}")
-                    continue # Continue with the next comment
+def refresh_engagement(reddit_client, refs, subreddit_name, days=ENGAGEMENT_REFRESH_DAYS):
+    """
+    Re-reads the score and comment count of the posts created in the last
+    `days` days with reddit.info() (REDDIT_INFO_BATCH posts per request) and
+    updates `score`, `numComments` and `engagementScore` of the posts whose
+    values changed. engagementScore is recomputed from Reddit's current
+    comment count, or from the stored `totalComments` if Reddit has none.
+    Posts stored without `numComments` are not rewritten just for that
+    field. Returns (posts checked, posts updated).
+    """
+    cutoff = datetime.datetime.fromtimestamp(time.time() - days * 86400)
+    stored = {}
+    for snapshot in refs["posts"].where("created", ">=", cutoff).select(
+            ["score", "numComments", "totalComments", "engagementScore"]).stream():
+        stored[f"t3_{snapshot.id}"] = snapshot.to_dict() or {}
+    if not stored:
+        return 0, 0
+
+    submissions = resolve_submissions(reddit_client, list(stored), subreddit_name)
+    writer = BulkWriter(db, context=f"[{subreddit_name}] engagement refresh")
+    for fullname, submission in submissions.items():
+        post_data = stored[fullname]
+        score = submission.score
+        num_comments = getattr(submission, "num_comments", None)
+        comment_count = num_comments if num_comments is not None else post_data.get("totalComments", 0)
+        engagement_score = engagement_score_for(score, comment_count)
+        comments_changed = (num_comments is not None and "numComments" in post_data
+                            and num_comments != post_data["numComments"])
+        if (score == post_data.get("score") and not comments_changed
+                and math.isclose(engagement_score, post_data.get("engagementScore", 0.0))):
+            continue
+        fields = {
+            "score": score,
+            "engagementScore": engagement_score,
+            "engagementRefreshed": firestore.SERVER_TIMESTAMP,
+        }
+        if num_comments is not None:
+            fields["numComments"] = num_comments
+        writer.update(refs["posts"].document(fullname[3:]), fields)
+    updated, _ = writer.flush()
+    return len(stored), updated
+
+def engagement_refresh_due(refs, subreddit_name):
+    """True if the last engagement refresh of the subreddit is more than ENGAGEMENT_REFRESH_HOURS old."""
+    try:
+        snapshot = refs["meta"].document(f"engagement_refresh_{subreddit_name}").get()
+        last = (snapshot.to_dict() or {}).get("value", 0) if snapshot.exists else 0
+        return time.time() - last >= ENGAGEMENT_REFRESH_HOURS * 3600
+    except Exception as e:
+        logging.error(f"[{subreddit_name}] Error reading engagement refresh time: {e}")
+        return False
+
+# --- Deferred (batch job) mode ---
+# Instead of calling Gemini, a deferred crawl writes each request to a BatchJob
+# (see batch_jobs.py) together with the crawled records. apply_batch_job() later
+# builds the same classifications/analysis tuples from the responses and stores
+# them with the functions above. Anything the job could not answer (failed
+# responses, threads too large for a single request) goes through the live path.
+
+def defer_comment_classifications(job, comment_records):
+    for comment in comment_records:
+        if comment_heuristics.classify_trivial(comment["body"]) is None:
+            job.add_request(f"comment:{comment['comment_id']}", f" Text: ${comment['body']}",
+                            generation_config=CLASSIFICATION_GENERATION_CONFIG, system_instruction=PROMPT_COMMENT)
+
+def defer_post_analysis(job, post_record, comment_records):
+    thread_parts = thread_parts_for(post_record, comment_records)
+    if sum(estimate_tokens(part) for part in thread_parts) > MAP_REDUCE_THRESHOLD_TOKENS:
+        return # Needs map-reduce, analyzed live when the job is applied
+    text = " Text: $" + "\n".join(thread_parts)
+    post_id = post_record["post_id"]
+    if COMBINED_POST_ANALYSIS:
+        job.add_request(f"post:{post_id}:analysis", text, generation_config=POST_ANALYSIS_GENERATION_CONFIG,
+                        system_instruction=PROMPT_POST_ANALYSIS)
+    else:
+        job.add_request(f"post:{post_id}:overall", text, generation_config=CLASSIFICATION_GENERATION_CONFIG,
+                        system_instruction=PROMPT_POST_COMMENTS)
+        job.add_request(f"post:{post_id}:summary", text, system_instruction=PROMPT_SUMMARY)
+
+def classifications_from_responses(model, responses, comment_records, context=""):
+    """{comment_id: classification} from the job responses; unanswered comments are classified live."""
+    results = {}
+    missing = []
+    for comment in comment_records:
+        comment_id = comment["comment_id"]
+        trivial = comment_heuristics.classify_trivial(comment["body"])
+        if trivial is not None:
+            results[comment_id] = trivial
+            continue
+        classification = None
+        if f"comment:{comment_id}" in responses:
+            classification = parse_classification_response(
+                responses[f"comment:{comment_id}"], context=f"{context} comment {comment_id}")
+        if classification is not None:
+            results[comment_id] = classification
+        else:
+            missing.append((comment_id, comment["body"]))
+    if missing:
+        print(f"{context} {len(missing)} comments have no valid batch response, classifying them live...")
+        results.update(classify_comments(model, missing, context=context))
+    return results
+
+def analysis_from_responses(model, responses, post_record, comment_records, context=""):
+    """Post analysis tuple from the job responses, falling back to analyze_thread."""
+    post_id = post_record["post_id"]
+    if f"post:{post_id}:analysis" in responses:
+        response_text = responses[f"post:{post_id}:analysis"]
+        try:
+            analysis = classification_schema.parse_analysis(response_text)
+            classification_schema.record("post_analysis", parsed=1)
+            return analysis
+        except classification_schema.ClassificationError as e:
+            classification_schema.record("post_analysis", failed=1)
+            logging.warning(f"Invalid batch analysis for {context} ({e}). Response: {response_text[:200]}")
+    elif f"post:{post_id}:overall" in responses and f"post:{post_id}:summary" in responses:
+        classification = parse_classification_response(responses[f"post:{post_id}:overall"], context=context, kind="post")
+        if classification is not None:
+            return classification + (responses[f"post:{post_id}:summary"],)
+
+    print(f"{context} No usable batch response, analyzing live...")
+    return analyze_thread(model, thread_parts_for(post_record, comment_records), context=context)
+
+def apply_batch_job(job, model):
+    """
+    Folds the responses of a finished batch job into Firestore, subreddit by
+    subreddit, then advances each subreddit's last timestamp.
+    """
+    responses = job.load_responses()
+    records_by_subreddit = defaultdict(list)
+    for record in job.iter_records():
+        records_by_subreddit[record["subreddit"]].append(record)
+    print(f"Applying batch job {job.job_dir}: {len(responses)} responses for {len(records_by_subreddit)} subreddits.")
+
+    for subreddit_name, records in records_by_subreddit.items():
+        print(f"\n--- Applying batch results for r/{subreddit_name} ---")
+        get_telemetry().set_subreddit(subreddit_name)
+        refs = get_collections(subreddit_name)
+        author_updates, category_updates = new_aggregation_stores()
+        new_last_timestamp = None
+
+        for record in records:
+            try:
+                if record["type"] == "post":
+                    post_record, comment_records = record["post"], record["comments"]
+                    context = f"[{subreddit_name}] post {post_record['post_id']}"
+                    classifications = classifications_from_responses(model, responses, comment_records, context=context)
+                    analysis = analysis_from_responses(model, responses, post_record, comment_records, context=context)
+                    store_new_post(refs, subreddit_name, post_record, comment_records, classifications, analysis,
+                                   author_updates, category_updates)
+                elif record["type"] == "old_post_comments":
+                    comment_records = record["comments"]
+                    classifications = classifications_from_responses(
+                        model, responses, comment_records, context=f"[{subreddit_name}] new comments on old posts")
+                    posts_to_recalculate = store_comments_on_old_posts(
+                        refs, subreddit_name, comment_records, classifications, author_updates, category_updates)
+                    recalculate_old_posts(model, refs, subreddit_name, posts_to_recalculate)
+                    save_expansion_state(refs, subreddit_name, record.get("expansions"))
+                elif record["type"] == "timestamp":
+                    new_last_timestamp = record["last_timestamp"]
+            except Exception as e:
+                logging.exception(f"[{subreddit_name}] Error applying batch record {record.get('type')}: {e}")
+                print(f"[{subreddit_name}] Error applying batch record {record.get('type')}: {e}")
 
-            # Commit remaining new comments
-            if new_comment_write_count > 0:
-                print(f"[{subreddit_name}] Committing final new comment batch ({new_comment_write_count} ops)...")
+        print(f"\n[{subreddit_name}] Committing aggregated author and category stats...")
+        commit_author_stats(author_updates, refs)
+        commit_category_stats_non_transactional(category_updates, refs)
+
+        if new_last_timestamp is not None and new_last_timestamp > get_last_timestamp(subreddit_name):
+            set_last_timestamp(new_last_timestamp, subreddit_name, refs)
+            print(f"[{subreddit_name}] Updated last timestamp to: {datetime.datetime.fromtimestamp(new_last_timestamp)} ({new_last_timestamp})")
+
+    job.save_state(status="applied", applied=time.time())
+
+
+# Main crawling function
+_PIPELINE_DONE = object() # End-of-stream marker passed down the pipeline queues
+
+def run_pipeline(source, stages, queue_size=PIPELINE_QUEUE_SIZE, context=""):
+    """
+    Feeds the items of `source` (iterated on the calling thread) through `stages`,
+    each running on its own thread and connected by bounded queues, so a slow
+    stage holds back the ones before it instead of piling up items in memory.
+    A stage returns the item for the next stage (None drops it); an exception
+    drops only that item. Returns once every item has left the last stage.
+    Errors raised by `source` itself are re-raised after the stages have
+    finished the items already fetched.
+    """
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+
+    def work(stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _PIPELINE_DONE:
+                break
+            try:
+                result = stage(item)
+            except Exception as e:
+                logging.exception(f"{context} Pipeline stage {stage.__name__} failed: {e}")
+                print(f"{context} Error in {stage.__name__}: {e}")
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+        if outbox is not None:
+            outbox.put(_PIPELINE_DONE)
+
+    telemetry = get_telemetry()
+    threads = [
+        threading.Thread(target=telemetry.bind(work), args=(stage, queues[i], queues[i + 1] if i + 1 < len(stages) else None),
+                         name=f"pipeline-{stage.__name__}", daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in source:
+            queues[0].put(item)
+    finally:
+        queues[0].put(_PIPELINE_DONE) # Lets every stage finish what is already queued, then stop
+        for thread in threads:
+            thread.join()
+
+def crawl_subreddit(subreddit_name, model, job=None, reddit_client=None, stats=None):
+    """
+    Crawls new posts and new comments on old posts of one subreddit.
+    With a BatchJob as `job`, Gemini requests and crawled records are written
+    to the job instead, and nothing is stored until apply_batch_job().
+    New posts go through a fetch -> classify -> persist pipeline (run_pipeline),
+    so Reddit, Gemini and Firestore work overlap.
+    With CATCH_UP the listings are paged back to the last timestamp and new
+    posts are stored oldest first, checkpointing every CATCH_UP_CHECKPOINT_POSTS
+    posts so an interrupted catch-up resumes where it stopped.
+    `reddit_client` defaults to the module's PRAW instance. Returns False if
+    the crawl was aborted by an error, True otherwise. A `stats` dict is filled
+    with the number of new posts, new comments and listing gaps found (used by
+    the polling scheduler to adapt its interval).
+    """
+    print(f"\n--- Starting crawl for r/{subreddit_name} ---")
+    gaps_before = len(crawl_gaps)
+    get_telemetry().set_subreddit(subreddit_name)
+    last_timestamp = get_last_timestamp(subreddit_name)
+    print(f"[{subreddit_name}] Last timestamp: {datetime.datetime.fromtimestamp(last_timestamp)} ({last_timestamp})")
+    new_last_timestamp = last_timestamp
+
+    refs = get_collections(subreddit_name)
+    checkpoint = None
+    if CATCH_UP:
+        checkpoint = load_catch_up_checkpoint(refs, subreddit_name)
+        if checkpoint:
+            # Checkpoints advance last_timestamp, so resuming mostly means starting from it
+            print(f"[{subreddit_name}] Resuming interrupted catch-up after {checkpoint.get('cursor')} "
+                  f"({checkpoint.get('stored', 0)} posts stored before it stopped)")
+    reddit_client = reddit_client or reddit
+    sub = reddit_client.subreddit(subreddit_name)
+
+    updated_posts_count = 0
+    stored_post_ids = set() # New posts stored by this run
+    unstored_posts = {} # post_id -> created_utc of listed new posts not stored (yet): failed or still in the pipeline
+    unstored_lock = threading.Lock()
+    processed_comments_count = 0
+    new_comments_on_old_posts_count = 0
+
+    # --- In-memory stores for aggregation ---
+    author_updates, category_updates = new_aggregation_stores()
+
+    def report_stats():
+        if stats is not None:
+            stats.update({
+                "newPosts": updated_posts_count,
+                "newComments": processed_comments_count,
+                "gaps": sum(1 for gap in crawl_gaps[gaps_before:] if gap["subreddit"] == subreddit_name),
+            })
+
+    try:
+        # =============================================
+        # 1. Process NEW posts and their comments
+        # =============================================
+        # Stage 1 (fetch): submissions and their comment trees from Reddit
+        def fetch_new_posts():
+            nonlocal new_last_timestamp
+            print(f"[{subreddit_name}] Fetching new submissions...")
+            if reddit_fetcher is not None and not CATCH_UP:
+                # Comment trees are fetched concurrently; records arrive as the trees complete
+                listed = []
+                def note_timestamp(submission):
+                    nonlocal new_last_timestamp
+                    new_last_timestamp = max(new_last_timestamp, submission.created_utc)
+                    listed.append(submission.created_utc)
+                    with unstored_lock:
+                        unstored_posts[submission.id] = submission.created_utc
+                yield from reddit_fetcher.iter_new_posts(subreddit_name, last_timestamp, limit=NEW_POSTS_LIMIT, listed=note_timestamp)
+                if len(listed) >= NEW_POSTS_LIMIT and last_timestamp > 0:
+                    report_gap(refs, subreddit_name, "posts", last_timestamp, min(listed))
+                return
+            submissions, reached = list_new_submissions(sub, last_timestamp, None if CATCH_UP else NEW_POSTS_LIMIT)
+            if not reached and submissions and last_timestamp > 0 and (CATCH_UP or len(submissions) >= NEW_POSTS_LIMIT):
+                report_gap(refs, subreddit_name, "posts", last_timestamp, submissions[-1].created_utc)
+            if CATCH_UP:
+                print(f"[{subreddit_name}] Catch-up: {len(submissions)} new submissions, storing them oldest first...")
+                submissions.reverse()
+                if checkpoint:
+                    # A checkpoint stops short of posts that failed, so newer ones may be stored already
+                    stored = find_stored([refs["posts"].document(submission.id) for submission in submissions])
+                    if stored:
+                        print(f"[{subreddit_name}] Skipping {len(stored)} posts stored before the catch-up was interrupted.")
+                        submissions = [submission for submission in submissions
+                                       if refs["posts"].document(submission.id).path not in stored]
+            with unstored_lock:
+                unstored_posts.update((submission.id, submission.created_utc) for submission in submissions)
+            for submission in submissions:
+                submission_time = submission.created_utc
+
+                # Update the latest timestamp seen in this run
+                if submission_time > new_last_timestamp:
+                    new_last_timestamp = submission_time
+
+                print(f"[{subreddit_name}] Processing NEW post: {submission.id} : {submission.title[:50]}...")
                 try:
-                    new_comment_batch.commit()
-                    print(f"[{subreddit_name}] Final new comment batch committed.")
+                    post_record, comment_records = fetch_new_post(submission, subreddit_name, reddit_client)
+                except praw.exceptions.PRAWException as pe:
+                    logging.error(f"[{subreddit_name}] PRAW error processing submission {submission.id}: {pe}")
+                    print(f"[{subreddit_name}] PRAW Error on {submission.id}: {pe}")
+                    continue
                 except Exception as e:
-                    logging.error(f"[{subreddit_name}] Error committing final new comment batch: {e}")
-
-
-            # =====================================================
-            # 3. Recalculate Stats for Old Posts with New Comments
-            # =====================================================
-            if posts_to_recalculate:
-                print(f"\n[{subreddit_name}] Recalculating stats for {len(posts_to_recalculate)} old posts with new comments...")
-                recalc_batch = db.batch()
-                recalc_ops_count = 0
-
-                for post_id, _ in posts_to_recalculate.items(): # We only need post_id here
-                    try:
-                        post_ref = refs["posts"].document(post_id)
-                        # Fetch ALL comments for the post *now* including the newly added ones
-                        comments_snapshot = post_ref.collection("comments").stream()
-
-                        # Recalculate aggregate scores
-                        total_comments = 0
-                        total_positive = 0
-                        total_negative = 0
-                        weighted_sum = 0.0
-                        weight_total = 0.0
-                        raw_sum = 0.0
-
-                        for c_snap in comments_snapshot:
-                            c_data = c_snap.to_dict()
-                            sent = c_data.get("sentiment", 0)
-                            score = c_data.get("score", 0)
-
-                            weight = 1 + math.log2(max(score, 0) + 1)
-                            weighted_sum += sent * weight
-                            weight_total += weight
-                            raw_sum += sent
-                            total_comments += 1
-                            if sent > 0:
-                                total_positive += sent
-                            elif sent < 0:
-                                total_negative += sent
-
-                        # Calculate final scores
-                        weighted_sent = weighted_sum / weight_total if weight_total > 0 else 0
-
-                        # Prepare update data for the post
-                        post_recalc_update = {
-                            'totalComments': total_comments,
-                            'totalPositiveSentiments': total_positive,
-                            'totalNegativeSentiments': total_negative,
-                            'weightedSentimentScore': weighted_sent,
-                            'rawSentimentScore': raw_sum, # Update raw score too
-                            'lastUpdated': firestore.SERVER_TIMESTAMP
-                        }
-
-                        # Add update to batch
-                        recalc_batch.update(post_ref, post_recalc_update)
-                        recalc_ops_count += 1
-
-                        # Commit batch periodically
-                        if recalc_ops_count >= BATCH_COMMIT_SIZE:
-                             print(f"[{subreddit_name}] Committing intermediate recalc batch ({recalc_ops_count} ops)...")
-                             try:
-                                 recalc_batch.commit()
-                                 print(f"[{subreddit_name}] Intermediate recalc batch committed.")
-                                 recalc_batch = db.batch()
-                                 recalc_ops_count = 0
-                             except Exception as e:
-                                 logging.error(f"[{subreddit_name}] Error committing intermediate recalc batch: {e}")
-                                 recalc_batch = db.batch() # Reset
-                                 recalc_ops_count = 0
-
-                    except Exception as e:
-                        logging.error(f"[{subreddit_name}] Error recalculating stats for old post {post_id}: {e}")
-                        continue # Skip to next post on error
-
-                # Commit final recalc batch
-                if recalc_ops_count > 0:
-                    print(f"[{subreddit_name}] Committing final recalc batch ({recalc_ops_count} ops)...")
-                    try:
-                        recalc_batch.commit()
-                        print(f"[{subreddit_name}] Final recalc batch committed.")
-                    except Exception as e:
-                        logging.error(f"[{subreddit_name}] Error committing final recalc batch: {e}")
+                    logging.exception(f"[{subreddit_name}] Unexpected error processing submission {submission.id}: {e}") # Log full traceback
+                    print(f"[{subreddit_name}] Error on {submission.id}: {e}")
+                    continue
+                yield post_record, comment_records
+
+        # Stage 2 (classify): Gemini analysis of the comments and the whole thread
+        def classify_new_post(item):
+            post_record, comment_records = item
+            post_id = post_record["post_id"]
+            # --- Gemini Analysis for Comments (batched/concurrent) ---
+            classifications = classify_comment_records(
+                model, refs, comment_records, context=f"[{subreddit_name}] post {post_id}", post_id=post_id)
+
+            # --- Gemini Analysis & Summary for Overall Post (incl. comments) ---
+            print(f"[{subreddit_name}] Analyzing overall post {post_id}...")
+            analysis = analyze_new_post(
+                model, refs, post_record, comment_records, context=f"[{subreddit_name}] overall post {post_id}")
+            return post_record, comment_records, classifications, analysis
+
+        # Stage 3 (persist): Firestore writes; the only stage touching the aggregation stores
+        def persist_new_post(item):
+            nonlocal processed_comments_count, updated_posts_count
+            post_record, comment_records, classifications, analysis = item
+            processed_comments_count += store_new_post(
+                refs, subreddit_name, post_record, comment_records, classifications, analysis,
+                author_updates, category_updates)
+            stored_post_ids.add(post_record["post_id"])
+            with unstored_lock:
+                unstored_posts.pop(post_record["post_id"], None)
+                oldest_unstored = min(unstored_posts.values(), default=None)
+            updated_posts_count += 1
+            if CATCH_UP and updated_posts_count % CATCH_UP_CHECKPOINT_POSTS == 0:
+                # Commit the aggregates so far with the checkpoint, so a resumed run neither repeats nor loses them
+                print(f"[{subreddit_name}] Catch-up checkpoint after {updated_posts_count} posts...")
+                commit_author_stats(author_updates, refs)
+                commit_category_stats_non_transactional(category_updates, refs)
+                author_updates.clear()
+                category_updates.clear()
+                # Posts are stored oldest first, so an older unstored post failed; stop just before it
+                checkpoint_timestamp = post_record["created_utc"]
+                if oldest_unstored is not None and oldest_unstored <= checkpoint_timestamp:
+                    checkpoint_timestamp = oldest_unstored - 1
+                save_catch_up_checkpoint(refs, subreddit_name, post_record, updated_posts_count, checkpoint_timestamp)
+
+        if job is not None:
+            for post_record, comment_records in fetch_new_posts():
+                defer_comment_classifications(job, comment_records)
+                defer_post_analysis(job, post_record, comment_records)
+                job.add_record({"type": "post", "subreddit": subreddit_name, "post": post_record, "comments": comment_records})
+                processed_comments_count += len(comment_records)
+                updated_posts_count += 1
+        else:
+            run_pipeline(fetch_new_posts(), [classify_new_post, persist_new_post], context=f"[{subreddit_name}]")
+            if unstored_posts:
+                failed_ids = sorted(unstored_posts, key=unstored_posts.get)
+                message = (f"[{subreddit_name}] {len(failed_ids)} new posts could not be stored and will not be "
+                           f"retried by later runs: {', '.join(failed_ids[:20])}{' ...' if len(failed_ids) > 20 else ''}")
+                logging.warning(message)
+                print(message)
+
+        # =====================================================
+        # 2. Check for NEW Comments on OLD Posts (Hybrid Approach)
+        # =====================================================
+        print(f"\n[{subreddit_name}] Scanning recent comments for updates to older posts...")
+        try:
+            new_comments, old_posts_data = find_new_comments_on_old_posts(
+                sub, refs, subreddit_name, last_timestamp, limit=None if CATCH_UP else RECENT_COMMENTS_LIMIT,
+                reddit_client=reddit_client)
+            new_comments_on_old_posts_count = len(new_comments)
+            processed_comments_count += len(new_comments) # Also count these as processed comments
+
+            if job is not None:
+                if new_comments:
+                    defer_comment_classifications(job, new_comments)
+                    job.add_record({"type": "old_post_comments", "subreddit": subreddit_name, "comments": new_comments})
+            else:
+                # --- Gemini Analysis for the new comments (batched) ---
+                classifications = classify_comment_records(
+                    model, refs, new_comments, context=f"[{subreddit_name}] new comments on old posts")
+                posts_to_recalculate = store_comments_on_old_posts(
+                    refs, subreddit_name, new_comments, classifications, author_updates, category_updates)
+
+                # =====================================================
+                # 3. Recalculate Stats for Old Posts with New Comments
+                # =====================================================
+                recalculate_old_posts(model, refs, subreddit_name, posts_to_recalculate, old_posts_data)
 
         except praw.exceptions.PRAWException as pe:
             logging.error(f"[{subreddit_name}] PRAW error during recent comment scan: {pe}")
@@ -1048,6 +2028,52 @@ def crawl_subreddit(subreddit_name, model):
             logging.exception(f"[{subreddit_name}] Unexpected error during recent comment scan: {e}")
             print(f"[{subreddit_name}] Error during comment scan: {e}")
 
+        # =====================================================
+        # 2b. Resume posts whose comments were only partially expanded
+        # =====================================================
+        try:
+            expanded_comments, partial_posts_data, expansion_state = resume_partial_posts(
+                reddit_client, refs, subreddit_name, skip_post_ids=stored_post_ids)
+            processed_comments_count += len(expanded_comments)
+            if job is not None:
+                if expansion_state:
+                    defer_comment_classifications(job, expanded_comments)
+                    job.add_record({"type": "old_post_comments", "subreddit": subreddit_name,
+                                    "comments": expanded_comments, "expansions": expansion_state})
+            else:
+                classifications = classify_comment_records(
+                    model, refs, expanded_comments, context=f"[{subreddit_name}] resumed comment trees")
+                posts_to_recalculate = store_comments_on_old_posts(
+                    refs, subreddit_name, expanded_comments, classifications, author_updates, category_updates)
+                recalculate_old_posts(model, refs, subreddit_name, posts_to_recalculate, partial_posts_data)
+                # Only after the comments are stored, so an interrupted run resumes the same stubs
+                save_expansion_state(refs, subreddit_name, expansion_state)
+        except Exception as e:
+            logging.exception(f"[{subreddit_name}] Unexpected error while resuming partial comment trees: {e}")
+            print(f"[{subreddit_name}] Error resuming partial comment trees: {e}")
+
+        # =====================================================
+        # 2c. Refresh score and engagement of recent posts
+        # =====================================================
+        # Scores are captured when a post is first stored, usually within hours
+        # of posting. Needs no Gemini calls, so it is done in live crawls only.
+        if job is None and ENGAGEMENT_REFRESH_DAYS > 0 and engagement_refresh_due(refs, subreddit_name):
+            try:
+                checked, refreshed = refresh_engagement(reddit_client, refs, subreddit_name)
+                refs["meta"].document(f"engagement_refresh_{subreddit_name}").set({"value": time.time()})
+                print(f"[{subreddit_name}] Engagement refresh: {refreshed} of {checked} recent posts changed")
+            except Exception as e:
+                logging.exception(f"[{subreddit_name}] Unexpected error while refreshing engagement scores: {e}")
+                print(f"[{subreddit_name}] Error refreshing engagement scores: {e}")
+
+        if job is not None:
+            # Stats and the timestamp are written when the job is applied
+            job.add_record({"type": "timestamp", "subreddit": subreddit_name, "last_timestamp": new_last_timestamp})
+            print(f"\n--- Finished deferred crawl for r/{subreddit_name} ---")
+            print(f"  New posts queued: {updated_posts_count}")
+            print(f"  Comments queued (new posts + new on old): {processed_comments_count}")
+            report_stats()
+            return True
 
         # =============================================
         # 4. Commit Aggregated Stats (Authors & Categories)
@@ -1066,6 +2092,8 @@ def crawl_subreddit(subreddit_name, model):
              print(f"[{subreddit_name}] Updated last timestamp to: {datetime.datetime.fromtimestamp(new_last_timestamp)} ({new_last_timestamp})")
         else:
              print(f"[{subreddit_name}] Last timestamp remains unchanged.")
+        if CATCH_UP:
+            clear_catch_up_checkpoint(refs, subreddit_name)
 
 
         # --- Final Summary ---
@@ -1073,6 +2101,8 @@ def crawl_subreddit(subreddit_name, model):
         print(f"  New posts processed: {updated_posts_count}")
         print(f"  Total comments processed (new posts + new on old): {processed_comments_count}")
         print(f"  New comments found on old posts: {new_comments_on_old_posts_count}")
+        report_stats()
+        return True
 
     except praw.exceptions.PRAWException as pe:
         logging.error(f"[{subreddit_name}] CRITICAL PRAW error during main crawl loop: {pe}")
@@ -1080,12 +2110,71 @@ def crawl_subreddit(subreddit_name, model):
     except Exception as e:
         logging.exception(f"[{subreddit_name}] CRITICAL unexpected error in main crawl function: {e}") # Log full traceback
         print(f"[{subreddit_name}] CRITICAL Error: {e}")
+    return False
+
+def crawl_subreddits(subreddit_names, model, job=None, workers=CRAWL_WORKERS):
+    """
+    Crawls every subreddit, `workers` at a time. Subreddits write to their own
+    collections, so they are independent; the Gemini limiter and the Reddit
+    request bucket are process-wide and shared by all workers. A failing
+    subreddit does not affect the others. Returns {subreddit: (ok, seconds)}.
+    """
+    def crawl_one(subreddit_name, reddit_client=None):
+        started = time.time()
+        try:
+            ok = crawl_subreddit(subreddit_name, model, job=job, reddit_client=reddit_client)
+        except Exception as e: # e.g. Firestore unreachable before the crawl's own error handling starts
+            logging.exception(f"[{subreddit_name}] Crawl worker failed: {e}")
+            print(f"[{subreddit_name}] CRITICAL Error in crawl worker: {e}")
+            ok = False
+        finally:
+            get_telemetry().set_subreddit(None)
+        return ok, time.time() - started
+
+    results = {}
+    if workers <= 1 or len(subreddit_names) <= 1:
+        for subreddit_name in subreddit_names:
+            results[subreddit_name] = crawl_one(subreddit_name)
+            print("-" * 50) # Separator between subreddits
+        return results
+
+    print(f"Crawling {len(subreddit_names)} subreddits with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(lambda name=name: crawl_one(name, make_reddit())) for name in subreddit_names}
+        for subreddit_name, future in futures.items():
+            results[subreddit_name] = future.result()
+    return results
 
 
 # ----------------------------
 # Main - run for all subreddits
 # ----------------------------
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl subreddits and analyze posts/comments with Gemini.")
+    parser.add_argument("--deferred", action="store_true",
+                        help="Write Gemini requests to a batch job instead of calling the API; nothing is stored until --apply")
+    parser.add_argument("--apply", metavar="JOB_DIR",
+                        help="Fold the responses of a finished batch job into Firestore")
+    parser.add_argument("--runner", choices=["gemini", "local"], default=os.getenv("BATCH_JOB_RUNNER", "gemini"),
+                        help="Where batch jobs run: the Gemini Batch API or locally (for testing)")
+    parser.add_argument("--jobs-dir", default=os.getenv("BATCH_JOBS_DIR", "jobs"), help="Directory for new batch jobs")
+    parser.add_argument("--workers", type=int, default=CRAWL_WORKERS,
+                        help="Number of subreddits crawled concurrently (default: CRAWL_WORKERS or 1)")
+    parser.add_argument("--fetch", choices=["sync", "async"], default=os.getenv("REDDIT_FETCH_BACKEND", "sync"),
+                        help="Fetch new posts with PRAW one by one, or with asyncpraw, many comment trees at once")
+    parser.add_argument("--classifier", choices=["gemini", "local"], default=classifier_backends.CLASSIFIER_BACKEND,
+                        help="Backend for comment classification in live crawls (post summaries always use Gemini)")
+    parser.add_argument("--catch-up", action="store_true", default=CATCH_UP,
+                        help="Page back through the listings until the last crawl is reached (after missed runs or busy periods)")
+    parser.add_argument("--schedule", action="store_true",
+                        help="Keep running and poll each subreddit at an interval adapted to its activity (see poll_scheduler.py)")
+    parser.add_argument("--schedule-hours", type=float, default=None,
+                        help="With --schedule, stop after this many hours (default: run until interrupted)")
+    args = parser.parse_args()
+    CATCH_UP = args.catch_up
+    if args.schedule and (args.deferred or args.apply):
+        parser.error("--schedule crawls live and cannot be combined with --deferred or --apply")
+
     start_time = time.time()
     print("Script started.")
 
@@ -1099,7 +2188,8 @@ if __name__ == "__main__":
         #     # ... other categories
         # ]
         # model = genai.GenerativeModel(safety_settings=safety_settings)
-        model = genai.GenerativeModel("gemini-2.5-flash-lite") # Default settings
+        # One handle per prompt template, with the template as system instruction
+        model = PromptModels("gemini-2.5-flash-lite")
       
         print("Google Gemini Configured.")
     except Exception as e:
@@ -1107,14 +2197,141 @@ if __name__ == "__main__":
         print(f"CRITICAL: Failed to configure Google Gemini: {e}")
         exit()
 
-    subreddits = load_subreddits()
-    if not subreddits:
-        print("No subreddits loaded. Exiting.")
+    def make_job_runner():
+        if args.runner == "local":
+            return LocalJobRunner(model)
+        return GeminiJobRunner(GOOGLE_GEMINI_API_KEY, model.model_name)
+
+    # A deferred crawl submits its job at the end; check the runner works before crawling for it
+    job_runner = None
+    if args.deferred:
+        try:
+            job_runner = make_job_runner()
+        except RuntimeError as e:
+            logging.error(f"Failed to create batch job runner '{args.runner}': {e}")
+            print(f"CRITICAL: Failed to create batch job runner '{args.runner}': {e} (or use --runner local)")
+            exit()
+
+    # Persistent response cache shared by every Gemini call in this run
+    llm_cache = LLMCache(os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'))
+
+    # Comment classifier for live crawls (deferred jobs always go to Gemini)
+    try:
+        comment_classifier = classifier_backends.create_backend(
+            args.classifier, gemini_classify=lambda items, context="": classify_comments(model, items, context=context))
+        print(f"Comment classifier backend: {comment_classifier.name}")
+    except (RuntimeError, ValueError) as e:
+        logging.error(f"Failed to create classifier backend '{args.classifier}': {e}")
+        print(f"CRITICAL: Failed to create classifier backend '{args.classifier}': {e}")
+        llm_cache.close()
         exit()
 
-    for sb_name in subreddits:
-        crawl_subreddit(sb_name, model)
-        print("-" * 50) # Separator between subreddits
+    if args.fetch == "async":
+        reddit_fetcher = AsyncRedditFetcher()
+
+    # Near-duplicate index kept across runs (crossposts, repeated bot comments)
+    if NEAR_DUPLICATES:
+        duplicate_index = NearDuplicateIndex(
+            os.getenv('NEAR_DUP_INDEX_PATH', 'near_duplicates.sqlite3'),
+            max_distance=NEAR_DUP_MAX_DISTANCE, min_tokens=NEAR_DUP_MIN_TOKENS)
+
+    # Local index of stored post/comment IDs, kept across runs (rebuild with `python id_index.py rebuild ...`)
+    if ID_INDEX:
+        id_index = IdIndex(os.getenv('ID_INDEX_PATH', 'id_index.sqlite3'))
+        id_index.claim(db, "reddit") # Stops trusting misses if an earlier run's index was not saved
+
+    if args.apply:
+        job = BatchJob(args.apply)
+        state = job.load_state()
+        if state.get("status") == "submitted":
+            try:
+                state = make_job_runner().fetch(job)
+            except RuntimeError as e:
+                print(f"CRITICAL: Failed to create batch job runner '{args.runner}': {e}")
+                llm_cache.close()
+                exit()
+        if state.get("status") != "succeeded":
+            print(f"Batch job {args.apply} is not ready to apply (status: {state.get('status')}, remote: {state.get('remote_state')}).")
+            llm_cache.close()
+            exit()
+        apply_batch_job(job, model)
+    else:
+        subreddits = load_subreddits()
+        if not subreddits:
+            print("No subreddits loaded. Exiting.")
+            exit()
+
+        job = BatchJob.create(args.jobs_dir) if args.deferred else None
+        if args.schedule:
+            def poll(subreddit_name):
+                poll_stats = {}
+                try:
+                    ok = crawl_subreddit(subreddit_name, model, reddit_client=make_reddit(), stats=poll_stats)
+                finally:
+                    get_telemetry().set_subreddit(None)
+                return {"ok": ok, **poll_stats}
+
+            scheduler = PollScheduler(poll, subreddits)
+            signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop()) # Finish running polls, then exit
+            print(f"Polling {len(subreddits)} subreddits, {scheduler.max_concurrency} at a time "
+                  f"(state in {scheduler.state_path})...")
+            try:
+                scheduler.run(max_seconds=args.schedule_hours * 3600 if args.schedule_hours else None)
+            except KeyboardInterrupt:
+                print("Scheduler interrupted.")
+            for sb_name, entry in scheduler.summary().items():
+                print(f"r/{sb_name}: {entry['polls']} polls, {entry['ratePerHour']} items/h, "
+                      f"every {entry['intervalMinutes']} min")
+        else:
+            crawl_results = crawl_subreddits(subreddits, model, job=job, workers=args.workers)
+            for sb_name, (ok, seconds) in crawl_results.items():
+                print(f"r/{sb_name}: {'ok' if ok else 'FAILED'} in {seconds:.1f}s")
+        for gap in crawl_gaps:
+            print(f"GAP r/{gap['subreddit']} {gap['kind']}: {datetime.datetime.fromtimestamp(gap['from'])} - "
+                  f"{datetime.datetime.fromtimestamp(gap['to'])}{'' if gap['catchUp'] else ' (run with --catch-up)'}")
+
+        if job is not None:
+            job.close()
+            if job.request_count:
+                job_runner.submit(job)
+            else:
+                job.save_state(status="succeeded") # Nothing for Gemini to do, only records to apply
+            print(f"Batch job {job.job_dir}: {job.request_count} requests ({job.load_state().get('status')}). "
+                  f"Run `python crawler.py --apply {job.job_dir}` once it has finished.")
+
+    print(f"Model calls skipped by local heuristics: {comment_heuristics.stats()}")
+    print(f"Classification parse results: {classification_schema.stats()}")
+    write_stats = get_write_stats()
+    print(f"Firestore bulk writes: {write_stats.summary()}")
+    for path, error in write_stats.failures:
+        print(f"  FAILED write {path}: {error}")
+    limiter = get_rate_limiter()
+    print(f"Gemini rate limiter: waited {limiter.throttled_seconds:.1f}s for budget, {limiter.quota_errors} quota errors")
+
+    evicted = llm_cache.evict()
+    print(f"LLM cache: {llm_cache.stats()} (evicted {evicted} entries)")
+    llm_cache.close()
+    if duplicate_index is not None:
+        evicted = duplicate_index.evict()
+        print(f"Near-duplicate index: {duplicate_index.stats()} (evicted {evicted} entries)")
+        duplicate_index.close()
+    if id_index is not None:
+        print(f"ID index: {id_index.stats()}")
+        id_index.close()
+    comment_classifier.close()
+    model.close()
+
+    # Per-call latency, token and cost telemetry (JSON + Prometheus text format)
+    telemetry = get_telemetry()
+    telemetry.set_subreddit(None)
+    run_summary = telemetry.summary()["run"]
+    print(f"Gemini telemetry: {run_summary['calls']} calls, {run_summary['inputTokens']} input / {run_summary['outputTokens']} output tokens, "
+          f"p50 {run_summary['latencyP50']}s, p95 {run_summary['latencyP95']}s, ~${run_summary['costUsd']:.4f}")
+    try:
+        json_path, prom_path = telemetry.write_reports(os.getenv('LLM_TELEMETRY_DIR', '.'))
+        print(f"Telemetry written to {json_path} and {prom_path}")
+    except OSError as e:
+        logging.error(f"Failed to write LLM telemetry: {e}")
 
     end_time = time.time()
     print(f"\nScript finished in {end_time - start_time:.2f} seconds.")
@@ -3,6 +3,7 @@ import math
 import time
 import logging
 import re
+import json
 import datetime
 from collections import defaultdict
 
@@ -16,6 +17,14 @@ from firebase_admin import credentials, firestore
 
 # Google Gemini
 import google.generativeai as genai
+from llm_cache import LLMCache
+from prompt_models import PromptModels, response_block_reason, reply_text
+import comment_heuristics
+import classification_schema
+import classifier_backends
+from id_index import IdIndex
+from bulk_writer import BulkWriter, get_write_stats
+from rate_limiter import EmptyResponseError, get_rate_limiter, is_retryable_error, is_quota_error, retry_after_seconds, backoff_delay
 
 # Load .env
 from dotenv import load_dotenv
@@ -24,26 +33,22 @@ load_dotenv()
 # ---------------------- PROMPTS ----------------------
 PROMPT_COMMENT = """
 You are an AI assigned to evaluate a Discord message (a reply).
-Review the following text and provide a concise output in this format: 
-a sentiment score (1 for positive, -1 for negative, 0 for neutral), 
-then a comma, the identified emotion (happy, relief, stress, frustration, 
-pride, disappointment, confusion, neutral), another comma, the determined category 
-(academic, exams, facilities, subjects, administration, career, admission, results, internship,
-lecturer, student life, infrastructure, classroom, events, CCA),
-and finally, a comma followed by "yes" or "no" indicating whether the text 
-relates to the School of IIT (Informatics & IT).
+Review the following text and respond with ONLY a JSON object with these fields:
+- "sentiment": 1 for positive, -1 for negative, 0 for neutral
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (Informatics & IT)
 """
 
 PROMPT_POST_COMMENTS = """
 You are an AI assigned to evaluate a Discord message and all its replies.
-Review the following text (message + replies) and provide a concise output in this format: 
-a sentiment score (1 for positive, -1 for negative, 0 for neutral), 
-then a comma, the identified emotion (happy, relief, stress, frustration, 
-pride, disappointment, confusion, neutral), another comma, the determined category 
-(academic, exams, facilities, subjects, administration, career, admission, results, internship,
-lecturer, student life, infrastructure, classroom, events, CCA), 
-and finally, another comma followed by "yes" or "no" indicating whether the text 
-relates to the School of IIT (Informatics & IT).
+Review the following text (message + replies) and respond with ONLY a JSON object with these fields:
+- "sentiment": the overall sentiment score (1 for positive, -1 for negative, 0 for neutral)
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (Informatics & IT)
 """
 
 PROMPT_SUMMARY = """
@@ -67,8 +72,32 @@ attachments, or unrelated filler), simply state:
 “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
 """
 
+PROMPT_POST_ANALYSIS = """
+You are an AI tasked with analyzing a Discord message and its replies.
+Produce a single JSON object with exactly these fields:
+- "sentiment": the overall sentiment score (1 for positive, -1 for negative, 0 for neutral)
+- "emotion": one of happy, relief, stress, frustration, pride, disappointment, confusion, neutral
+- "category": one of academic, exams, facilities, subjects, administration, career, admission, results, internship,
+lecturer, student life, infrastructure, classroom, events, CCA
+- "iit": "yes" or "no" indicating whether the text relates to the School of IIT (Informatics & IT)
+- "summary": a summary written as follows (do not provide headings or titles for any paragraphs):
+  1. A concise paragraph summarizing the key topics, issues, or themes discussed across the message and replies.
+  2. A second paragraph describing the overall sentiment and emotional tone expressed, mentioning any references
+  to specific academic subjects, school facilities, or aspects of campus life, if applicable.
+  3. If appropriate, a third paragraph highlighting any concerns raised or constructive suggestions for school
+  authorities, clearly referencing any specific subjects, facilities, or experiences mentioned.
+  Separate paragraphs with a blank line. If the provided text lacks sufficient content for analysis (e.g., it only
+  contains links, attachments, or unrelated filler), the summary should simply be:
+  “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
+Respond with ONLY the JSON object and no other text.
+"""
+
 # ---------------------- CONSTANTS & LOGGING ----------------------
-BATCH_COMMIT_SIZE = 400
+COMBINED_POST_ANALYSIS = os.getenv('COMBINED_POST_ANALYSIS', '0') == '1'  # One PROMPT_POST_ANALYSIS call per post
+CLASSIFY_MAX_REASKS = int(os.getenv('CLASSIFY_MAX_REASKS', '1'))  # Re-asks of an invalid classification before using defaults
+CLASSIFICATION_GENERATION_CONFIG = classification_schema.json_generation_config(classification_schema.CLASSIFICATION_SCHEMA)
+POST_ANALYSIS_GENERATION_CONFIG = classification_schema.json_generation_config(classification_schema.POST_ANALYSIS_SCHEMA)
+GENERATION_FAILED_TEXT = "Error generating response after multiple attempts."
 logging.basicConfig(
     filename='crawler_errors.log',
     level=logging.ERROR,
@@ -92,7 +121,7 @@ except Exception as e:
 # ---------------------- GOOGLE GEMINI INIT ----------------------
 try:
     genai.configure(api_key=GOOGLE_GEMINI_API_KEY)
-    model = genai.GenerativeModel()
+    model = PromptModels("gemini-1.5-flash-002")  # SDK default model; one handle per prompt with the prompt as system instruction
     print("Google Gemini Configured.")
 except Exception as e:
     logging.error(f"Failed to configure Google Gemini: {e}")
@@ -156,21 +185,151 @@ def get_collection_refs(guild_name: str, channel_name: str):
         "meta": meta_collection,
     }
 
+id_index = None  # Set to an IdIndex before the bot starts; None checks every parent message in Firestore
+
+def document_exists(doc_ref):
+    """Existence check answered by the local ID index when it can, otherwise by a Firestore read."""
+    if id_index is not None:
+        if id_index.contains(doc_ref.path):
+            return True
+        if id_index.covers(doc_ref.path):
+            return False
+    exists = doc_ref.get().exists
+    if exists:
+        record_stored(doc_ref)
+    return exists
+
+def record_stored(*doc_refs):
+    if id_index is not None:
+        id_index.add([doc_ref.path for doc_ref in doc_refs])
+
 # ---------------------- GEMINI HELPER ----------------------
-def safe_generate_content(gemini_model, prompt, retries=3, delay=5):
-    """Safely call Gemini with retries."""
+llm_cache = None  # Set to an LLMCache before the bot starts; None disables caching
+
+def safe_generate_content(gemini_model, template, text, retries=5, delay=2, generation_config=None, validate=None):
+    """
+    Safely call Gemini with retries, serving repeats from the response cache.
+    Calls go through the shared rate limiter; quota and transient errors are
+    retried with backoff, permanent errors are not. Replies rejected by
+    `validate` are not cached.
+    """
+    model_name = getattr(gemini_model, "model_name", type(gemini_model).__name__)
+    cache_template = template
+    if generation_config is not None:
+        cache_template = template + json.dumps(generation_config, sort_keys=True)
+    if llm_cache is not None:
+        cached = llm_cache.get(model_name, cache_template, text)
+        if cached is not None:
+            return cached
+
+    prompt = template + text
+    handle, contents = gemini_model, prompt
+    if hasattr(gemini_model, "for_template"):
+        handle, contents = gemini_model.for_template(template), text
+    limiter = get_rate_limiter()
     for attempt in range(retries):
         try:
-            response = gemini_model.generate_content(prompt)
-            if response and hasattr(response, 'text') and response.text:
-                return response.text.strip()
+            limiter.acquire(len(prompt) // 4 + 1)
+            if generation_config is not None:
+                response = handle.generate_content(contents, generation_config=generation_config)
             else:
-                raise ValueError("Empty or invalid Gemini response.")
+                response = handle.generate_content(contents)
+            # Blocked replies first: response.text raises ValueError on them
+            block_reason = response_block_reason(response)
+            if block_reason:
+                logging.warning(f"Content generation blocked. Reason: {block_reason}")
+                return GENERATION_FAILED_TEXT # Final: asking again gets the same answer
+            response_text = reply_text(response)
+            if not response_text:
+                raise EmptyResponseError("Empty or invalid Gemini response.")
+            response_text = response_text.strip()
+            if llm_cache is not None and (validate is None or validate(response_text)):
+                llm_cache.put(model_name, cache_template, text, response_text)
+            return response_text
         except Exception as e:
             logging.error(f"Error generate_content (Attempt {attempt+1}/{retries}): {e}. Prompt snippet: {prompt[:80]}...")
+            if not is_retryable_error(e):
+                break
             if attempt < retries - 1:
-                time.sleep(delay)
-    return "Error generating response after multiple attempts."
+                wait = retry_after_seconds(e) or backoff_delay(attempt, base_delay=delay)
+                if is_quota_error(e):
+                    limiter.pause(wait)
+                else:
+                    time.sleep(wait)
+    return GENERATION_FAILED_TEXT
+
+def request_structured(gemini_model, template, text, generation_config, parse, kind, default=None):
+    """
+    Schema-constrained request; invalid replies are re-asked up to CLASSIFY_MAX_REASKS
+    times before `default` is returned. Parse outcomes are counted under `kind`.
+    """
+    def is_valid(response_text):
+        try:
+            parse(response_text)
+            return True
+        except classification_schema.ClassificationError:
+            return False
+
+    for attempt in range(1 + max(0, CLASSIFY_MAX_REASKS)):
+        response_text = safe_generate_content(gemini_model, template, text, generation_config=generation_config, validate=is_valid)
+        if response_text == GENERATION_FAILED_TEXT:
+            return default
+        try:
+            result = parse(response_text)
+            classification_schema.record(kind, parsed=1)
+            return result
+        except classification_schema.ClassificationError as e:
+            classification_schema.record(kind, failed=1)
+            logging.warning(f"Invalid {kind} reply (attempt {attempt + 1}): {e}. Response: {response_text[:200]}")
+    classification_schema.record(kind, gave_up=1)
+    return default
+
+def classify_reply(gemini_model, text):
+    """
+    Returns (sentiment, emotion, category, iit_flag) for a reply. Trivial
+    replies are handled by comment_heuristics without calling Gemini.
+    """
+    trivial = comment_heuristics.classify_trivial(text)
+    if trivial is not None:
+        return trivial
+
+    return request_structured(gemini_model, PROMPT_COMMENT, f"\nText: {text}", CLASSIFICATION_GENERATION_CONFIG,
+                              classification_schema.parse_classification, kind="comment",
+                              default=classification_schema.DEFAULT_CLASSIFICATION)
+
+def classify_replies(gemini_model, reply_items):
+    """Gemini classification of (message_id, text) pairs, one request per reply (the "gemini" classifier backend)."""
+    return {message_id: classify_reply(gemini_model, text) for message_id, text in reply_items}
+
+# Reply classifier selected with CLASSIFIER_BACKEND (gemini or local); post summaries always use Gemini
+try:
+    comment_classifier = classifier_backends.create_backend(
+        gemini_classify=lambda items, context="": classify_replies(model, items))
+    print(f"Comment classifier backend: {comment_classifier.name}")
+except (RuntimeError, ValueError) as e:
+    logging.error(f"Failed to create classifier backend: {e}")
+    print(f"CRITICAL: Failed to create classifier backend: {e}")
+    exit()
+
+def analyze_post(gemini_model, combined_text):
+    """
+    Returns (sentiment, emotion, category, iit_flag, summary) for a post.
+    Uses a single PROMPT_POST_ANALYSIS request in combined mode and falls back
+    to separate PROMPT_POST_COMMENTS + PROMPT_SUMMARY requests otherwise.
+    """
+    text = f"\nText: {combined_text}"
+    if COMBINED_POST_ANALYSIS:
+        analysis = request_structured(gemini_model, PROMPT_POST_ANALYSIS, text, POST_ANALYSIS_GENERATION_CONFIG,
+                                      classification_schema.parse_analysis, kind="post_analysis")
+        if analysis is not None:
+            return analysis
+        logging.error("No valid combined analysis, falling back to separate requests.")
+
+    classification = request_structured(gemini_model, PROMPT_POST_COMMENTS, text, CLASSIFICATION_GENERATION_CONFIG,
+                                        classification_schema.parse_classification, kind="post",
+                                        default=classification_schema.DEFAULT_CLASSIFICATION)
+    summary = safe_generate_content(gemini_model, PROMPT_SUMMARY, text)
+    return classification + (summary,)
 
 # ---------------------- AUTHOR STATS ----------------------
 def update_author_stats_memory(author_updates, author, sentiment, is_post=True, message_id=None):
@@ -207,8 +366,7 @@ def commit_author_stats(author_updates, refs):
         return
 
     authors_ref = refs["authors"]
-    batch = db.batch()
-    count = 0
+    writer = BulkWriter(db, context="[discord authors]")
 
     # Pre-fetch existing docs
     authors_to_fetch = list(author_updates.keys())
@@ -243,21 +401,10 @@ def commit_author_stats(author_updates, refs):
         total = current_stats["postCount"]
         current_stats["averageSentiment"] = current_stats["totalSentimentScore"] / total if total else 0
 
-        batch.set(ref, current_stats)
-        count += 1
-        if count >= BATCH_COMMIT_SIZE:
-            try:
-                batch.commit()
-            except Exception as e:
-                logging.error(f"Error committing author batch: {e}")
-            batch = db.batch()
-            count = 0
+        writer.set(ref, current_stats)
 
-    if count > 0:
-        try:
-            batch.commit()
-        except Exception as e:
-            logging.error(f"Error committing final author batch: {e}")
+    committed, failed = writer.flush()
+    print(f"Author stats written: {committed} ok, {failed} failed")
 
 # ---------------------- CATEGORY / TIME-SERIES STATS ----------------------
 def update_category_stats_memory(category_updates, date_str, category, sentiment, message_id=None):
@@ -395,30 +542,14 @@ async def on_ready():
 
                         # Ensure parent doc
                         parent_ref = refs["posts"].document(parent_id)
-                        parent_doc = parent_ref.get()
-                        if not parent_doc.exists:
+                        if not document_exists(parent_ref):
                             # create a stub
                             parent_ref.set({"body": "[missing parent stub]", "created": message.created_at}, merge=True)
+                            record_stored(parent_ref)
 
-                        # Analyze
-                        prompt = PROMPT_COMMENT + f"\nText: {message.content}"
-                        reply_resp = safe_generate_content(model, prompt)
-                        parts = reply_resp.split(',')
-
-                        sentiment = 0
-                        emotion = "Neutral"
-                        category = "Uncategorized"
-                        iit_flag = "no"
-                        if len(parts) >= 4:
-                            try:
-                                sentiment = int(parts[0].strip())
-                            except:
-                                pass
-                            emotion = parts[1].strip() or "Neutral"
-                            category = parts[2].strip() or "Uncategorized"
-                            iit_flag_candidate = parts[3].strip().lower()
-                            if iit_flag_candidate in ["yes","no"]:
-                                iit_flag = iit_flag_candidate
+                        # Analyze (trivial replies are labelled locally)
+                        sentiment, emotion, category, iit_flag = comment_classifier.classify(
+                            [(message.id, message.content)])[message.id]
 
                         comment_doc = {
                             # "message_id": message.id,
@@ -430,7 +561,9 @@ async def on_ready():
                             "category": category,
                             "iit": iit_flag,
                         }
-                        parent_ref.collection("comments").document(str(message.id)).set(comment_doc)
+                        reply_ref = parent_ref.collection("comments").document(str(message.id))
+                        reply_ref.set(comment_doc)
+                        record_stored(reply_ref)
 
                         # Update author stats (reply => is_post=False)
                         update_author_stats_memory(author_updates, str(message.author), sentiment, is_post=False)
@@ -443,29 +576,8 @@ async def on_ready():
                         logging.info(f"Storing post {message.id}")
                         combined_text = message.content  # no advanced logic for children here
 
-                        # Overall analysis
-                        prompt_overall = PROMPT_POST_COMMENTS + f"\nText: {combined_text}"
-                        overall_resp = safe_generate_content(model, prompt_overall)
-                        parts_overall = overall_resp.split(',')
-
-                        post_sentiment = 0
-                        post_emotion = "Neutral"
-                        post_category = "Uncategorized"
-                        post_iit_flag = "no"
-                        if len(parts_overall) >= 4:
-                            try:
-                                post_sentiment = int(parts_overall[0].strip())
-                            except:
-                                pass
-                            post_emotion = parts_overall[1].strip() or "Neutral"
-                            post_category = parts_overall[2].strip() or "Uncategorized"
-                            iit_candidate = parts_overall[3].strip().lower()
-                            if iit_candidate in ["yes","no"]:
-                                post_iit_flag = iit_candidate
-
-                        # Summaries
-                        prompt_summary = PROMPT_SUMMARY + f"\nText: {combined_text}"
-                        summary = safe_generate_content(model, prompt_summary)
+                        # Overall analysis & summary
+                        post_sentiment, post_emotion, post_category, post_iit_flag, summary = analyze_post(model, combined_text)
 
                         # Weighted sentiment (Discord has no built-in upvote, so treat all equally)
                         weighted_sentiment_score = post_sentiment
@@ -489,7 +601,9 @@ async def on_ready():
                             "relatedToTemasekPoly": related_to_tp,
                             "lastUpdated": firestore.SERVER_TIMESTAMP,
                         }
-                        refs["posts"].document(str(message.id)).set(post_doc)
+                        post_ref = refs["posts"].document(str(message.id))
+                        post_ref.set(post_doc)
+                        record_stored(post_ref)
 
                         # Update author stats
                         update_author_stats_memory(author_updates, str(message.author), post_sentiment, is_post=True, message_id=str(message.id))
@@ -515,6 +629,13 @@ async def on_ready():
             commit_author_stats(author_updates, some_refs)
             commit_category_stats_non_transactional(category_updates, some_refs["category_stats"])
 
+    print(f"Model calls skipped by local heuristics: {comment_heuristics.stats()}")
+    print(f"Classification parse results: {classification_schema.stats()}")
+    if llm_cache is not None:
+        print(f"LLM cache: {llm_cache.stats()} (evicted {llm_cache.evict()} entries)")
+    if id_index is not None:
+        print(f"ID index: {id_index.stats()}")
+    print(f"Firestore bulk writes: {get_write_stats().summary()}")
     logging.info("Crawling complete. Shutting down bot.")
 
     # Remove this line if you want the bot to run continuously
@@ -522,4 +643,15 @@ async def on_ready():
 
 # ---------------------- LAUNCH BOT ----------------------
 if __name__ == "__main__":
-    bot.run(DISCORD_TOKEN)
+    llm_cache = LLMCache(os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'))
+    if os.getenv('ID_INDEX', '1') == '1':
+        id_index = IdIndex(os.getenv('ID_INDEX_PATH', 'id_index.sqlite3'))
+        id_index.claim(db, "discord") # Stops trusting misses if an earlier run's index was not saved
+    try:
+        bot.run(DISCORD_TOKEN)
+    finally:
+        llm_cache.close()
+        if id_index is not None:
+            id_index.close()
+        comment_classifier.close()
+        model.close()
@@ -0,0 +1,111 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+import argparse
+import os
+import sys
+import time
+from dotenv import load_dotenv
+
+# Allow importing shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import classifier_backends
+from bulk_writer import BulkWriter
+
+load_dotenv()
+
+"""
+Re-labels stored comments (sentiment, emotion, category, iit) with a classifier
+backend from classifier_backends.py, e.g. to backfill old comments with the
+CPU-local model instead of paying for Gemini calls:
+
+    python database_patches/reclassify_comments.py --backend local temasekpoly
+    python database_patches/reclassify_comments.py --backend gemini --only-missing sgexams
+
+Comments are classified CLASSIFY_CHUNK at a time and written back through a
+BulkWriter (parallel batches, retried on errors). Author and category aggregates are not touched; re-run
+update_author_aggregation.py / update_category_stats_optimized.py afterwards.
+"""
+
+# --- Constants ---
+CLASSIFY_CHUNK = 256 # Comments handed to the backend per call
+
+
+def init_firebase():
+    if not firebase_admin._apps:
+        cred = credentials.Certificate("firebase-credentials.json")
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+def create_backend(name):
+    if name != "gemini":
+        return classifier_backends.create_backend(name)
+    # The Gemini backend reuses the crawler's pipeline (prompts, batching, cache, rate limits)
+    import crawler
+    from llm_cache import LLMCache
+    from prompt_models import PromptModels
+    crawler.genai.configure(api_key=crawler.GOOGLE_GEMINI_API_KEY)
+    model = PromptModels("gemini-2.5-flash-lite")
+    crawler.llm_cache = LLMCache(os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'))
+    return classifier_backends.create_backend(
+        "gemini", gemini_classify=lambda items, context="": crawler.classify_comments(model, items, context=context))
+
+
+def posts_collection_name(subreddit_name):
+    sub_lower = subreddit_name.lower()
+    return "posts" if sub_lower == "temasekpoly" else f"{sub_lower}_posts"
+
+
+def reclassify_subreddit(db, backend, subreddit_name, only_missing=False):
+    print(f"--- Reclassifying comments of r/{subreddit_name} with the {backend.name} backend ---")
+    start_time = time.time()
+    pending = [] # (comment_ref, body)
+    writer = BulkWriter(db, context=f"[{subreddit_name}] reclassify")
+    classified = 0
+
+    def classify_pending():
+        nonlocal classified
+        results = backend.classify([(ref.path, body) for ref, body in pending], context=f"[{subreddit_name}]")
+        for ref, _ in pending:
+            sentiment, emotion, category, iit_flag = results[ref.path]
+            writer.update(ref, {"sentiment": sentiment, "emotion": emotion, "category": category, "iit": iit_flag})
+        classified += len(pending)
+        pending.clear()
+
+    for post_snapshot in db.collection(posts_collection_name(subreddit_name)).stream():
+        for comment_snapshot in post_snapshot.reference.collection("comments").stream():
+            comment_data = comment_snapshot.to_dict() or {}
+            if only_missing and comment_data.get("category") not in (None, "", "Uncategorized"):
+                continue
+            pending.append((comment_snapshot.reference, comment_data.get("body", "")))
+            if len(pending) >= CLASSIFY_CHUNK:
+                classify_pending()
+                print(f"[{subreddit_name}] Classified {classified} comments ({time.time() - start_time:.1f}s elapsed)")
+    if pending:
+        classify_pending()
+    written, write_errors = writer.flush()
+
+    elapsed = time.time() - start_time
+    rate = classified / elapsed if elapsed else 0
+    print(f"[{subreddit_name}] Classified {classified} comments in {elapsed:.1f}s ({rate:.1f} comments/s); "
+          f"updated {written}, write errors {write_errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-label stored comments with a classifier backend.")
+    parser.add_argument("subreddits", nargs="+", help="Subreddit names (temasekpoly uses the 'posts' collection)")
+    parser.add_argument("--backend", choices=["gemini", "local"], default=os.getenv("CLASSIFIER_BACKEND", "local"))
+    parser.add_argument("--only-missing", action="store_true", help="Only comments that are still 'Uncategorized'")
+    args = parser.parse_args()
+
+    backend = create_backend(args.backend) # Before init_firebase(): importing crawler initializes Firebase itself
+    db = init_firebase()
+    try:
+        for subreddit_name in args.subreddits:
+            reclassify_subreddit(db, backend, subreddit_name, only_missing=args.only_missing)
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
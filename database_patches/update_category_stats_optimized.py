@@ -2,10 +2,13 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 import datetime
 import logging
+import os
+import sys
 from collections import defaultdict # Use defaultdict for easier aggregation
 
-# --- Constants ---
-BATCH_COMMIT_SIZE = 400 # Max operations per batch is 500, use a lower number for safety
+# Allow importing shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_writer import BulkWriter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -188,37 +191,10 @@ def save_to_firestore_batched(final_data):
 
     logging.info(f"Starting Firestore save for {len(final_data)} dates...")
     target_collection_ref = db.collection("nus_category_stats")
-    batch = db.batch()
-    count = 0
-
-    # Iterate through the finalized data (dates are keys)
-    for date_str, cat_dict_data in final_data.items():
-        try:
-            doc_ref = target_collection_ref.document(date_str)
-            batch.set(doc_ref, cat_dict_data) # Use set to overwrite existing daily doc
-            count += 1
-
-            # Commit batch periodically
-            if count >= BATCH_COMMIT_SIZE:
-                logging.info(f"Committing batch of {count} date documents...")
-                batch.commit()
-                logging.info("Batch committed.")
-                # Start a new batch
-                batch = db.batch()
-                count = 0
-        except Exception as e:
-            logging.error(f"Error adding document for date {date_str} to batch: {e}", exc_info=True)
-            # Optionally skip this doc or handle error differently
-            # Reset batch and count if a specific doc fails? Maybe better to log and continue adding others.
-
-    # Commit any remaining operations in the last batch
-    if count > 0:
-        try:
-            logging.info(f"Committing final batch of {count} date documents...")
-            batch.commit()
-            logging.info("Final batch committed.")
-        except Exception as e:
-            logging.error(f"Error committing final batch: {e}", exc_info=True)
+    with BulkWriter(db, context="[category stats]") as writer:
+        for date_str, cat_dict_data in final_data.items():
+            writer.set(target_collection_ref.document(date_str), cat_dict_data) # Use set to overwrite existing daily doc
+    logging.info(f"Saved {writer.committed} date documents, {writer.failed} failed.")
 
     logging.info("Firestore save process completed.")
 
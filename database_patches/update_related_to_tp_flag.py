@@ -4,12 +4,14 @@ import os
 import re
 # import math # Not used in this script
 from dotenv import load_dotenv
+import sys
 import time # For timing and progress
 
-load_dotenv()
+# Allow importing shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_writer import BulkWriter
 
-# --- Constants ---
-BATCH_WRITE_SIZE = 500 # Max operations per batch write is 500
+load_dotenv()
 
 # --- Firebase Initialization ---
 # Consider adding more robust error handling if initialization fails
@@ -154,49 +156,19 @@ def patch_related_to_tp_for_subreddit_optimized(subreddit_name: str):
     print(f"[{subreddit_name}] Found {len(docs_to_update)} documents requiring an update.")
     print(f"[{subreddit_name}] Read/analysis phase took {read_end_time - start_time:.2f} seconds.")
 
-    # --- Batch Update Phase ---
-    total_updated = 0
-    write_errors = 0
-    print(f"[{subreddit_name}] Starting batched writes...")
+    # --- Write Phase ---
+    print(f"[{subreddit_name}] Starting bulk writes...")
     if not docs_to_update:
         print(f"[{subreddit_name}] No documents require updates.")
-    else:
-        for i in range(0, len(docs_to_update), BATCH_WRITE_SIZE):
-            batch_start_time = time.time()
-            chunk = docs_to_update[i:i + BATCH_WRITE_SIZE]
-            batch = db.batch()
-            added_to_batch = 0
-            for doc_ref, related_flag in chunk:
-                try:
-                     # Ensure related_flag is boolean, default to False if somehow invalid
-                     final_flag = bool(related_flag)
-                     batch.update(doc_ref, {"relatedToTemasekPoly": final_flag})
-                     added_to_batch += 1
-                except Exception as batch_add_e:
-                     # Log which doc failed to be added to batch
-                     print(f"ERROR: Failed to add update for {doc_ref.id} to batch {i // BATCH_WRITE_SIZE + 1}: {batch_add_e}")
-                     write_errors += 1
-
-            if added_to_batch > 0:
-                try:
-                    batch.commit()
-                    total_updated += added_to_batch
-                    batch_time = time.time() - batch_start_time
-                    print(f"[{subreddit_name}] Committed batch {i // BATCH_WRITE_SIZE + 1} ({added_to_batch} ops) in {batch_time:.2f}s. Total updated: {total_updated}/{len(docs_to_update)}")
-                except Exception as commit_e:
-                    print(f"ERROR: COMMIT FAILED for batch {i // BATCH_WRITE_SIZE + 1}: {commit_e}")
-                    # How many failed? Assume all in batch for error count, though some might have succeeded before failure
-                    write_errors += added_to_batch
-                    # Consider more sophisticated retry logic or saving failed batches?
-                    # For a one-time patch, logging might be sufficient.
-            else:
-                 print(f"[{subreddit_name}] Skipped committing empty batch {i // BATCH_WRITE_SIZE + 1}.")
-
+    with BulkWriter(db, context=f"[{subreddit_name}] relatedToTemasekPoly") as writer:
+        for doc_ref, related_flag in docs_to_update:
+            writer.update(doc_ref, {"relatedToTemasekPoly": bool(related_flag)})
+    total_updated, write_errors = writer.committed, writer.failed
 
     write_end_time = time.time()
     print(f"[{subreddit_name}] Write phase finished.")
     print(f"[{subreddit_name}] Successfully committed updates for {total_updated} documents.")
-    print(f"[{subreddit_name}] Write errors encountered (individual add or commit failures): {write_errors}")
+    print(f"[{subreddit_name}] Write errors encountered (after retries): {write_errors}")
     print(f"[{subreddit_name}] Write phase took {write_end_time - read_end_time:.2f} seconds.")
     print(f"--- Finished patch for r/{subreddit_name} in {write_end_time - start_time:.2f} seconds ---")
 
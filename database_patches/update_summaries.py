@@ -2,10 +2,37 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 import google.generativeai as genai
 import os
+import sys
 import time
 
+# Allow importing shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_cache import LLMCache
+
 GOOGLE_GEMINI_API_KEY = os.getenv('GOOGLE_GEMINI_API_KEY')
 
+PROMPT_SUMMARY = """
+                You are an AI tasked with analyzing a Reddit post and its accompanying comments about 
+                Temasek Polytechnic. Perform the following steps (do not provide headings or titles for any paragraphs):
+
+                1. Start with a concise paragraph summarizing the key topics, issues, 
+                or themes discussed across the post and comments.
+
+                2. In the second paragraph, describe the overall sentiment and emotional 
+                tone expressed. Mention any references to specific academic subjects, school facilities, 
+                or aspects of campus life, if applicable.
+
+                3. If appropriate, include a third paragraph highlighting any 
+                concerns raised or constructive suggestions for school authorities. Clearly reference 
+                any specific subjects, facilities, or experiences mentioned.
+
+                If the provided text lacks sufficient content for analysis (e.g., it only contains links, 
+                attachments, or unrelated filler), simply state:
+
+                “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
+
+                """
+
 # Utility functions to load/save the last processed post ID
 def load_last_processed_id():
     try:
@@ -45,7 +72,8 @@ this script:
 - Iterates through each Reddit post in the 'posts' collection.
 - Fetches all comments associated with each post.
 - Combines the post body and all comment bodies into a single text block.
-- Sends this combined content to the Gemini model for summarization.
+- Sends this combined content to the Gemini model for summarization, reusing
+  cached replies from 'llm_cache.sqlite3' for text that was already summarized.
 - Writes the AI-generated summary back to the Firestore 'posts' document under the 'summary' field.
 - Logs the last processed post ID so that processing can resume if the app crashes.
 
@@ -82,7 +110,7 @@ def init_firebase():
     firebase_admin.initialize_app(cred)
     return firestore.client()
 
-def aggregate_comments(db, last_post_id='None', batch_size=10):
+def aggregate_comments(db, last_post_id='None', batch_size=10, llm_cache=None):
     posts_ref = db.collection('posts')
     # Base query ordering by document ID
     query_base = posts_ref.order_by('__name__')
@@ -122,37 +150,21 @@ def aggregate_comments(db, last_post_id='None', batch_size=10):
                     comment_data = comment.to_dict()
                     combined_post_comments += comment_data.get('body', '')
                 
-                prompt_summary = f"""
-                You are an AI tasked with analyzing a Reddit post and its accompanying comments about 
-                Temasek Polytechnic. Perform the following steps (do not provide headings or titles for any paragraphs):
-
-                1. Start with a concise paragraph summarizing the key topics, issues, 
-                or themes discussed across the post and comments.
-
-                2. In the second paragraph, describe the overall sentiment and emotional 
-                tone expressed. Mention any references to specific academic subjects, school facilities, 
-                or aspects of campus life, if applicable.
-
-                3. If appropriate, include a third paragraph highlighting any 
-                concerns raised or constructive suggestions for school authorities. Clearly reference 
-                any specific subjects, facilities, or experiences mentioned.
-
-                If the provided text lacks sufficient content for analysis (e.g., it only contains links, 
-                attachments, or unrelated filler), simply state:
-
-                “The text does not contain enough meaningful information to generate a summary, sentiment analysis, or recommendations.”
-
-                Text: "{combined_post_comments}"
-                """
-                response = model.generate_content(prompt_summary)
-
-                # Check if the Gemini response contains valid content
-                if not response.candidates or not response.candidates[0].content.parts:
-                    print(f"Skipping post {post_id} due to invalid content or blocked generation.")
-                    summary = ("The text does not contain enough meaningful information to generate a summary, "
-                               "sentiment analysis, or recommendations.")
-                else:
-                    summary = response.text.strip()
+                model_name = model.model_name
+                text = f'Text: "{combined_post_comments}"\n'
+                summary = llm_cache.get(model_name, PROMPT_SUMMARY, text) if llm_cache else None
+                if summary is None:
+                    response = model.generate_content(PROMPT_SUMMARY + text)
+
+                    # Check if the Gemini response contains valid content
+                    if not response.candidates or not response.candidates[0].content.parts:
+                        print(f"Skipping post {post_id} due to invalid content or blocked generation.")
+                        summary = ("The text does not contain enough meaningful information to generate a summary, "
+                                   "sentiment analysis, or recommendations.")
+                    else:
+                        summary = response.text.strip()
+                        if llm_cache:
+                            llm_cache.put(model_name, PROMPT_SUMMARY, text, summary)
                 
                 # Update the post with the generated summary
                 posts_ref.document(post_id).update({
@@ -174,7 +186,12 @@ def main():
     db = init_firebase()
     last_post_id = load_last_processed_id()
     print(f"Resuming from last processed post: {last_post_id}")
-    aggregate_comments(db, last_post_id=last_post_id)
+    llm_cache = LLMCache(os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'))
+    try:
+        aggregate_comments(db, last_post_id=last_post_id, llm_cache=llm_cache)
+    finally:
+        print(f"LLM cache: {llm_cache.stats()}")
+        llm_cache.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+'''
+Local index of the Firestore documents the crawlers have stored.
+
+Checking whether a post or comment is already stored costs a Firestore read
+per document. IdIndex keeps the paths of stored documents (for example
+"sgexams_posts/abc/comments/def") in SQLite, and loads them into an in-memory
+Bloom filter when opened:
+
+    index = IdIndex("id_index.sqlite3")
+    index.add(["sgexams_posts/abc"])
+    index.known(["sgexams_posts/abc", "sgexams_posts/xyz"])   # {"sgexams_posts/abc"}
+
+A Bloom filter miss answers "not stored" without touching SQLite, and a hit
+is confirmed with an exact SQLite lookup. Writes are recorded by a
+BulkWriter (bulk_writer.py) created with the index, which adds the documents
+it set() once their batch has been committed.
+
+id_index.sqlite3
+ ├─ stored_ids: path (document path)
+ ├─ complete_roots: root (top-level collection), rebuilt (unix time)
+ └─ index_meta: key, value (watermark_{name}: the run watermark of each crawler)
+
+A miss only proves that a document is absent if every document of its
+collection went into the index. rebuild() reads a top-level collection and
+its comments subcollections from Firestore and marks the collection complete.
+For other collections, callers still ask Firestore about IDs the index does
+not know:
+
+    python id_index.py rebuild sgexams_posts posts
+
+The index file is restored from a cache, so it can be older than Firestore:
+a run whose index was never saved back wrote documents the restored copy
+does not know. claim(db) detects this with a watermark that every run
+writes both to the index and to Firestore (meta/id_index_watermark_{name}).
+Each crawler (reddit, discord) has its own watermark, in Firestore and in
+the index, so both can share one index file. If the two differ, the
+collections stop counting as complete, so misses are confirmed in Firestore
+again until they are rebuilt.
+'''
+import argparse
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+import uuid
+
+SQL_CHUNK = 500 # Paths per SQLite IN (...) query
+WATERMARK_COLLECTION = "meta" # Firestore copies of the run watermarks: meta/id_index_watermark_{name}
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2)) # Bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] >> (position & 7) & 1 for position in self._positions(key))
+
+
+class IdIndex:
+    def __init__(self, path="id_index.sqlite3", capacity=2_000_000, error_rate=0.01):
+        self.path = path
+        self.bloom_negatives = 0 # Answered by the Bloom filter alone
+        self.confirmed = 0 # Bloom hits confirmed by SQLite
+        self.false_positives = 0 # Bloom hits SQLite rejected
+        # Shared by the crawl worker threads, so guard it with a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS stored_ids (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS complete_roots (root TEXT PRIMARY KEY, rebuilt REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        self._complete = {root for (root,) in self._conn.execute("SELECT root FROM complete_roots")}
+        count = self._conn.execute("SELECT COUNT(*) FROM stored_ids").fetchone()[0]
+        self._bloom = BloomFilter(max(capacity, count * 2), error_rate)
+        for (stored,) in self._conn.execute("SELECT path FROM stored_ids"):
+            self._bloom.add(stored)
+
+    def add(self, paths):
+        paths = list(paths)
+        if not paths:
+            return
+        try:
+            with self._lock:
+                self._conn.executemany("INSERT OR IGNORE INTO stored_ids (path) VALUES (?)", [(path,) for path in paths])
+                self._conn.commit()
+                for path in paths:
+                    self._bloom.add(path)
+        except sqlite3.Error as e:
+            logging.error(f"ID index write failed: {e}")
+
+    def known(self, paths):
+        """The subset of `paths` recorded as stored."""
+        candidates = []
+        with self._lock:
+            for path in paths:
+                if path in self._bloom:
+                    candidates.append(path)
+                else:
+                    self.bloom_negatives += 1
+            found = set()
+            try:
+                for i in range(0, len(candidates), SQL_CHUNK):
+                    chunk = candidates[i:i + SQL_CHUNK]
+                    rows = self._conn.execute(
+                        f"SELECT path FROM stored_ids WHERE path IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                    found.update(path for (path,) in rows)
+            except sqlite3.Error as e:
+                logging.error(f"ID index read failed: {e}")
+                return found # Unconfirmed paths count as unknown, so callers fall back to Firestore
+            self.confirmed += len(found)
+            self.false_positives += len(candidates) - len(found)
+            return found
+
+    def contains(self, path):
+        return path in self.known([path])
+
+    def covers(self, path):
+        """True if the top-level collection of `path` is complete, so a miss means the document is absent."""
+        return path.split("/", 1)[0] in self._complete
+
+    def claim(self, db, name="reddit"):
+        """
+        Checks the index against the watermark in Firestore before a run and
+        writes a new one, so a later run can tell whether this run's index
+        was saved. Returns False (and forgets which collections are complete)
+        if the index is missing writes of an earlier run.
+        """
+        watermark_ref = db.collection(WATERMARK_COLLECTION).document(f"id_index_watermark_{name}")
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM index_meta WHERE key = ?", (f"watermark_{name}",)).fetchone()
+        local = row[0] if row else None
+        try:
+            snapshot = watermark_ref.get()
+            remote = (snapshot.to_dict() or {}).get("value") if snapshot.exists else None
+        except Exception as e:
+            logging.error(f"ID index: could not read the watermark, not trusting misses this run: {e}")
+            with self._lock:
+                self._complete = set()
+            return False
+        current = local is not None and local == remote
+        if not current and self._complete:
+            logging.warning(f"ID index is older than Firestore (watermark {local} != {remote}); "
+                            f"misses in {sorted(self._complete)} are checked in Firestore until they are rebuilt")
+            print(f"ID index is stale, rebuild with `python id_index.py rebuild {' '.join(sorted(self._complete))}`")
+            with self._lock:
+                self._conn.execute("DELETE FROM complete_roots")
+                self._conn.commit()
+                self._complete = set()
+        self.stamp(db, name)
+        return current
+
+    def stamp(self, db, name="reddit"):
+        """Writes a new watermark to the index and to Firestore: the index has every write made so far."""
+        watermark = uuid.uuid4().hex
+        try:
+            db.collection(WATERMARK_COLLECTION).document(f"id_index_watermark_{name}").set(
+                {"value": watermark, "updated": time.time()})
+        except Exception as e:
+            logging.error(f"ID index: could not write the watermark: {e}")
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", (f"watermark_{name}", watermark))
+            self._conn.commit()
+
+    def rebuild(self, db, root, subcollections=("comments",)):
+        """
+        Replaces the entries of top-level collection `root` with the documents
+        currently in Firestore and marks it complete. Returns the number of paths.
+        """
+        paths = []
+        for snapshot in db.collection(root).select([]).stream():
+            paths.append(snapshot.reference.path)
+            for name in subcollections:
+                paths.extend(child.reference.path for child in snapshot.reference.collection(name).select([]).stream())
+        with self._lock:
+            # "0" sorts right after "/", so this range is exactly the paths under root/
+            self._conn.execute("DELETE FROM stored_ids WHERE path >= ? AND path < ?", (root + "/", root + "0"))
+            self._conn.executemany("INSERT OR IGNORE INTO stored_ids (path) VALUES (?)", [(path,) for path in paths])
+            self._conn.execute("INSERT OR REPLACE INTO complete_roots (root, rebuilt) VALUES (?, ?)", (root, time.time()))
+            self._conn.commit()
+            for path in paths:
+                self._bloom.add(path)
+            self._complete.add(root)
+        return len(paths)
+
+    def stats(self):
+        with self._lock:
+            stored = self._conn.execute("SELECT COUNT(*) FROM stored_ids").fetchone()[0]
+        return {"stored": stored, "completeRoots": sorted(self._complete), "bloomNegatives": self.bloom_negatives,
+                "confirmed": self.confirmed, "falsePositives": self.false_positives}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the local ID index from Firestore, or show its size.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="Re-read top-level collections (and their comments) from Firestore")
+    rebuild_parser.add_argument("collections", nargs="+", help="e.g. posts sgexams_posts discord_myserver_general_posts")
+    commands.add_parser("stats", help="Print the number of indexed documents and the complete collections")
+    parser.add_argument("--path", default="id_index.sqlite3")
+    parser.add_argument("--watermark", default="reddit", help="Crawler whose index file this is (reddit or discord)")
+    args = parser.parse_args()
+
+    index = IdIndex(args.path)
+    try:
+        if args.command == "rebuild":
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+            if not firebase_admin._apps:
+                firebase_admin.initialize_app(credentials.Certificate("firebase-credentials.json"))
+            db = firestore.client()
+            for root in args.collections:
+                started = time.time()
+                print(f"{root}: {index.rebuild(db, root)} documents indexed in {time.time() - started:.1f}s")
+            index.stamp(db, args.watermark)
+        print(index.stats())
+    finally:
+        index.close()
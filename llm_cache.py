@@ -0,0 +1,124 @@
+'''
+Persistent, content-addressed cache for Gemini responses.
+
+Entries are keyed on (model name, prompt template version, SHA-256 of the
+per-call text), so re-running a crawl after a crash, re-summarizing old posts,
+or classifying a repeated bot comment returns the stored reply instead of
+calling the API again. The template version is derived from the template text
+itself, so editing a prompt automatically stops old replies from matching.
+
+llm_cache (SQLite table)
+ └─ (model, template_version, text_hash) (primary key)
+     ├─ response
+     ├─ created (unix time)
+     └─ last_access (unix time)
+
+Eviction is age-based (entries not read for `max_age_days`) and size-based
+(least recently read entries beyond `max_entries`).
+'''
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+def template_version(template):
+    """Short, stable version id for a prompt template."""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path="llm_cache.sqlite3", max_entries=200000, max_age_days=90):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        # Shared by the classification worker threads, so guard it with a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (
+                   model TEXT NOT NULL,
+                   template_version TEXT NOT NULL,
+                   text_hash TEXT NOT NULL,
+                   response TEXT NOT NULL,
+                   created REAL NOT NULL,
+                   last_access REAL NOT NULL,
+                   PRIMARY KEY (model, template_version, text_hash)
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+        self._conn.commit()
+
+    def get(self, model_name, template, text):
+        """Returns the cached response or None, updating the hit/miss counters."""
+        key = (model_name, template_version(template), text_hash(text))
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT response FROM llm_cache WHERE model = ? AND template_version = ? AND text_hash = ?",
+                    key,
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._conn.execute(
+                    "UPDATE llm_cache SET last_access = ? WHERE model = ? AND template_version = ? AND text_hash = ?",
+                    (time.time(),) + key,
+                )
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+        except sqlite3.Error as e:
+            logging.error(f"LLM cache read failed: {e}")
+            self.misses += 1
+            return None
+
+    def put(self, model_name, template, text, response):
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (model, template_version, text_hash, response, created, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (model_name, template_version(template), text_hash(text), response, now, now),
+                )
+                self._conn.commit()
+                self.writes += 1
+        except sqlite3.Error as e:
+            logging.error(f"LLM cache write failed: {e}")
+
+    def evict(self):
+        """Drops stale entries, then trims the table down to max_entries. Returns rows removed."""
+        removed = 0
+        try:
+            with self._lock:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self._conn.execute("DELETE FROM llm_cache WHERE last_access < ?", (cutoff,)).rowcount
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+                if count > self.max_entries:
+                    removed += self._conn.execute(
+                        "DELETE FROM llm_cache WHERE rowid IN "
+                        "(SELECT rowid FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    ).rowcount
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"LLM cache eviction failed: {e}")
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "hitRate": round(hit_rate, 1)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,250 @@
+'''
+Per-call telemetry for Gemini requests.
+
+safe_generate_content() reports every call here: prompt type, latency, input
+and output tokens (from the response's usage_metadata, estimated when it is
+missing), retries, block reasons and cache hits. Calls are aggregated per
+(subreddit, prompt type) and written at the end of a run as
+
+    llm_telemetry.json   per run and per subreddit: p50/p95 latency, tokens, tokens per post, cost
+    llm_telemetry.prom   the same counters in Prometheus text format (node_exporter textfile collector)
+
+Configuration (environment variables):
+    LLM_TELEMETRY_DIR            output directory (default: current directory)
+    GEMINI_INPUT_PRICE_PER_M     USD per million input tokens (default 0.10)
+    GEMINI_OUTPUT_PRICE_PER_M    USD per million output tokens (default 0.40)
+'''
+import json
+import math
+import os
+import threading
+from collections import Counter, defaultdict
+
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0) # seconds, for the Prometheus histogram
+RUN_LABEL = "_run" # Subreddit label of calls made outside a crawl (e.g. batch job apply)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def usage_token_counts(response):
+    """(input tokens, output tokens) from a response's usage_metadata, or (0, 0) when it has none."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return 0, 0
+    return getattr(usage, "prompt_token_count", 0) or 0, getattr(usage, "candidates_token_count", 0) or 0
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latencies = []
+        self.block_reasons = Counter()
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.cache_hits += other.cache_hits
+        self.failed += other.failed
+        self.blocked += other.blocked
+        self.retries += other.retries
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.latencies.extend(other.latencies)
+        self.block_reasons.update(other.block_reasons)
+
+    def to_dict(self, telemetry):
+        return {
+            "calls": self.calls,
+            "cacheHits": self.cache_hits,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retries": self.retries,
+            "inputTokens": self.input_tokens,
+            "outputTokens": self.output_tokens,
+            "costUsd": round(telemetry.cost(self.input_tokens, self.output_tokens), 6),
+            "latencyP50": round(percentile(self.latencies, 50), 3),
+            "latencyP95": round(percentile(self.latencies, 95), 3),
+            "latencyMax": round(max(self.latencies), 3) if self.latencies else 0.0,
+            "blockReasons": dict(self.block_reasons),
+        }
+
+
+class LLMTelemetry:
+    def __init__(self, input_price_per_million=0.10, output_price_per_million=0.40):
+        self.input_price_per_million = input_price_per_million
+        self.output_price_per_million = output_price_per_million
+        self._stats = defaultdict(CallStats) # (subreddit, prompt_type) -> CallStats
+        self._posts = Counter() # subreddit -> posts analyzed
+        self._local = threading.local() # Subreddit label per thread, so parallel crawls don't mix their calls
+        self._lock = threading.Lock()
+
+    def set_subreddit(self, subreddit_name):
+        """Labels the calls this thread makes next with `subreddit_name` (None for calls outside a crawl)."""
+        self._local.subreddit = subreddit_name or RUN_LABEL
+
+    def current_subreddit(self):
+        return getattr(self._local, "subreddit", RUN_LABEL)
+
+    def bind(self, fn):
+        """Wraps `fn` so that calls it makes on pool threads are labelled with the caller's current subreddit."""
+        subreddit = self.current_subreddit()
+        def bound(*args, **kwargs):
+            previous = self.current_subreddit()
+            self.set_subreddit(subreddit)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.set_subreddit(previous)
+        return bound
+
+    def cost(self, input_tokens, output_tokens):
+        return (input_tokens * self.input_price_per_million + output_tokens * self.output_price_per_million) / 1e6
+
+    def record_call(self, prompt_type, latency, input_tokens=0, output_tokens=0, retries=0, outcome="ok", block_reason=None):
+        """`outcome` is "ok", "blocked" or "failed"; latency is the final attempt's API time in seconds."""
+        subreddit = self.current_subreddit()
+        with self._lock:
+            stats = self._stats[(subreddit, prompt_type)]
+            stats.calls += 1
+            stats.retries += retries
+            stats.input_tokens += input_tokens
+            stats.output_tokens += output_tokens
+            stats.latencies.append(latency)
+            if outcome == "blocked":
+                stats.blocked += 1
+                stats.block_reasons[str(block_reason)] += 1
+            elif outcome == "failed":
+                stats.failed += 1
+
+    def record_cache_hit(self, prompt_type):
+        subreddit = self.current_subreddit()
+        with self._lock:
+            self._stats[(subreddit, prompt_type)].cache_hits += 1
+
+    def add_posts(self, count=1):
+        subreddit = self.current_subreddit()
+        with self._lock:
+            self._posts[subreddit] += count
+
+    # --- Reports ---
+    def summary(self):
+        with self._lock:
+            items = list(self._stats.items())
+            posts = dict(self._posts)
+
+        run_total = CallStats()
+        run_by_type = defaultdict(CallStats)
+        by_subreddit = defaultdict(lambda: {"total": CallStats(), "byPromptType": {}})
+        for (subreddit, prompt_type), stats in items:
+            run_total.merge(stats)
+            run_by_type[prompt_type].merge(stats)
+            by_subreddit[subreddit]["total"].merge(stats)
+            by_subreddit[subreddit]["byPromptType"][prompt_type] = stats
+
+        def section(total, by_type, post_count):
+            result = total.to_dict(self)
+            result["posts"] = post_count
+            result["tokensPerPost"] = round((total.input_tokens + total.output_tokens) / post_count, 1) if post_count else 0
+            result["byPromptType"] = {name: stats.to_dict(self) for name, stats in sorted(by_type.items())}
+            return result
+
+        return {
+            "run": section(run_total, run_by_type, sum(posts.values())),
+            "subreddits": {
+                subreddit: section(data["total"], data["byPromptType"], posts.get(subreddit, 0))
+                for subreddit, data in sorted(by_subreddit.items())
+            },
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def prometheus_text(self):
+        with self._lock:
+            items = sorted(self._stats.items())
+
+        def labels(subreddit, prompt_type, **extra):
+            pairs = [("subreddit", subreddit), ("prompt_type", prompt_type)] + sorted(extra.items())
+            return "{" + ",".join(f'{key}="{str(value).replace(chr(34), "")}"' for key, value in pairs) + "}"
+
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        metric("tpcraw_llm_requests_total", "counter", "Gemini requests sent, by outcome.", [
+            f"tpcraw_llm_requests_total{labels(s, p, outcome=outcome)} {value}"
+            for (s, p), stats in items
+            for outcome, value in (("ok", stats.calls - stats.failed - stats.blocked), ("blocked", stats.blocked), ("failed", stats.failed))
+        ])
+        metric("tpcraw_llm_cache_hits_total", "counter", "Requests answered from the response cache.", [
+            f"tpcraw_llm_cache_hits_total{labels(s, p)} {stats.cache_hits}" for (s, p), stats in items
+        ])
+        metric("tpcraw_llm_retries_total", "counter", "Retried Gemini attempts.", [
+            f"tpcraw_llm_retries_total{labels(s, p)} {stats.retries}" for (s, p), stats in items
+        ])
+        metric("tpcraw_llm_tokens_total", "counter", "Prompt (input) and response (output) tokens.", [
+            f"tpcraw_llm_tokens_total{labels(s, p, direction=direction)} {value}"
+            for (s, p), stats in items
+            for direction, value in (("input", stats.input_tokens), ("output", stats.output_tokens))
+        ])
+        metric("tpcraw_llm_cost_usd_total", "counter", "Estimated Gemini cost in USD.", [
+            f"tpcraw_llm_cost_usd_total{labels(s, p)} {self.cost(stats.input_tokens, stats.output_tokens):.6f}"
+            for (s, p), stats in items
+        ])
+        metric("tpcraw_llm_blocked_total", "counter", "Blocked requests by block reason.", [
+            f"tpcraw_llm_blocked_total{labels(s, p, reason=reason)} {count}"
+            for (s, p), stats in items for reason, count in sorted(stats.block_reasons.items())
+        ])
+        histogram = []
+        for (s, p), stats in items:
+            for bound in LATENCY_BUCKETS:
+                histogram.append(f"tpcraw_llm_latency_seconds_bucket{labels(s, p, le=bound)} {sum(1 for l in stats.latencies if l <= bound)}")
+            histogram.append(f"tpcraw_llm_latency_seconds_bucket{labels(s, p, le='+Inf')} {len(stats.latencies)}")
+            histogram.append(f"tpcraw_llm_latency_seconds_sum{labels(s, p)} {sum(stats.latencies):.3f}")
+            histogram.append(f"tpcraw_llm_latency_seconds_count{labels(s, p)} {len(stats.latencies)}")
+        metric("tpcraw_llm_latency_seconds", "histogram", "Gemini request latency.", histogram)
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.prometheus_text())
+
+    def write_reports(self, directory="."):
+        """Writes llm_telemetry.json and llm_telemetry.prom to `directory`. Returns the two paths."""
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, "llm_telemetry.json")
+        prom_path = os.path.join(directory, "llm_telemetry.prom")
+        self.write_json(json_path)
+        self.write_prometheus(prom_path)
+        return json_path, prom_path
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """Returns the process-wide telemetry collector, creating it from the environment on first use."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = LLMTelemetry(
+                input_price_per_million=float(os.getenv("GEMINI_INPUT_PRICE_PER_M", "0.10")),
+                output_price_per_million=float(os.getenv("GEMINI_OUTPUT_PRICE_PER_M", "0.40")),
+            )
+        return _telemetry
@@ -0,0 +1,195 @@
+'''
+Persistent near-duplicate index for posts and comments.
+
+Crossposted announcements and bot comments show up almost verbatim in several
+subreddits. Each analyzed text is stored with a 64-bit SimHash fingerprint of
+its normalized words, together with its classification (and summary, for
+posts). A new text whose fingerprint is within `max_distance` bits of a
+stored one reuses those results instead of calling the model.
+
+Every entry records its labeler, the backend and model that produced the
+labels (e.g. "gemini:models/gemini-2.5-flash-lite"). Lookups only match
+entries of the same labeler, so local or fake labels are never passed off
+as Gemini labels, and a model change starts a fresh set of entries.
+
+near_duplicates (SQLite table)
+ └─ kind ("comment" / "post"), labeler, fingerprint (16 hex digits)
+     ├─ band0..band5 (the fingerprint split into six 10-11 bit blocks, indexed)
+     ├─ source_id (Firestore path of the analyzed document)
+     ├─ classification (JSON list), summary
+     └─ created (unix time)
+
+Lookups only compare candidates that share at least one block, which finds
+every match for max_distance <= 5 (pigeonhole) without scanning the table.
+Texts shorter than `min_tokens` words are not indexed: short replies ("same",
+"thanks") collide too easily and comment_heuristics labels most of them
+anyway.
+'''
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+FINGERPRINT_BITS = 64
+BAND_WIDTHS = (11, 11, 11, 11, 10, 10) # Bits per indexed block; six blocks make distances up to 5 exact
+
+
+def normalize_tokens(text):
+    """Lowercased words of `text` without URLs and punctuation."""
+    return WORD_PATTERN.findall(URL_PATTERN.sub(" ", (text or "").lower()))
+
+
+def simhash(tokens):
+    """
+    64-bit SimHash of a word list (0 for no words). Single words are used as
+    features: on comment-sized texts, shingles turn a one-word edit into
+    several changed features and push copies too far apart.
+    """
+    weights = [0] * FINGERPRINT_BITS
+    for feature in tokens:
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(FINGERPRINT_BITS) if weights[bit] > 0)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def bands(fingerprint):
+    blocks = []
+    for width in BAND_WIDTHS:
+        blocks.append(fingerprint & ((1 << width) - 1))
+        fingerprint >>= width
+    return blocks
+
+
+class DuplicateMatch:
+    def __init__(self, source_id, classification, summary, distance):
+        self.source_id = source_id
+        self.classification = classification
+        self.summary = summary
+        self.distance = distance
+
+
+class NearDuplicateIndex:
+    def __init__(self, path="near_duplicates.sqlite3", max_distance=4, min_tokens=8, max_age_days=180):
+        self.path = path
+        self.max_distance = max_distance
+        self.min_tokens = min_tokens
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped = 0 # Texts too short to fingerprint
+        # Shared by the classification worker threads, so guard it with a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(near_duplicates)")]
+        if columns and "labeler" not in columns:
+            # Older files do not say which backend produced their labels, so they cannot be trusted
+            logging.warning(f"Near-duplicate index {path} has no labeler column, starting it afresh")
+            self._conn.execute("DROP TABLE near_duplicates")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS near_duplicates (
+                   kind TEXT NOT NULL,
+                   labeler TEXT NOT NULL,
+                   fingerprint TEXT NOT NULL,
+                   band0 INTEGER NOT NULL,
+                   band1 INTEGER NOT NULL,
+                   band2 INTEGER NOT NULL,
+                   band3 INTEGER NOT NULL,
+                   band4 INTEGER NOT NULL,
+                   band5 INTEGER NOT NULL,
+                   source_id TEXT NOT NULL,
+                   classification TEXT NOT NULL,
+                   summary TEXT,
+                   created REAL NOT NULL,
+                   PRIMARY KEY (kind, labeler, fingerprint)
+               )"""
+        )
+        for band in range(len(BAND_WIDTHS)):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_near_duplicates_band{band} ON near_duplicates (kind, band{band})")
+        self._conn.commit()
+
+    def fingerprint(self, text):
+        """SimHash of `text`, or None when it is too short to be matched reliably."""
+        tokens = normalize_tokens(text)
+        if len(tokens) < self.min_tokens:
+            return None
+        return simhash(tokens)
+
+    def lookup(self, kind, text, labeler):
+        """Returns the closest DuplicateMatch of `kind` labelled by `labeler` within max_distance, or None."""
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            self.skipped += 1
+            return None
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT fingerprint, source_id, classification, summary FROM near_duplicates "
+                    "WHERE kind = ? AND labeler = ? AND (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ? OR band4 = ? OR band5 = ?)",
+                    [kind, labeler] + bands(fingerprint),
+                ).fetchall()
+                best = None
+                for stored, source_id, classification, summary in rows:
+                    distance = hamming_distance(fingerprint, int(stored, 16))
+                    if distance <= self.max_distance and (best is None or distance < best.distance):
+                        best = DuplicateMatch(source_id, tuple(json.loads(classification)), summary, distance)
+                if best is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                return best
+        except sqlite3.Error as e:
+            logging.error(f"Near-duplicate index read failed: {e}")
+            self.misses += 1
+            return None
+
+    def add(self, kind, text, source_id, classification, labeler, summary=None):
+        """Indexes a text analyzed by `labeler`; the first source of a fingerprint is kept."""
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO near_duplicates "
+                    "(kind, labeler, fingerprint, band0, band1, band2, band3, band4, band5, source_id, classification, summary, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [kind, labeler, f"{fingerprint:016x}"] + bands(fingerprint)
+                    + [source_id, json.dumps(list(classification)), summary, time.time()],
+                )
+                self._conn.commit()
+                self.writes += 1
+        except sqlite3.Error as e:
+            logging.error(f"Near-duplicate index write failed: {e}")
+
+    def evict(self):
+        """Drops entries older than max_age_days. Returns rows removed."""
+        try:
+            with self._lock:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed = self._conn.execute("DELETE FROM near_duplicates WHERE created < ?", (cutoff,)).rowcount
+                self._conn.commit()
+                return removed
+        except sqlite3.Error as e:
+            logging.error(f"Near-duplicate index eviction failed: {e}")
+            return 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "tooShort": self.skipped,
+                "hitRate": round(hit_rate, 1)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,184 @@
+'''
+Activity-adaptive polling of subreddits, for running the crawler continuously.
+
+Instead of crawling every subreddit once a day, each subreddit gets its own
+timer. After a poll, the number of new posts and comments it found over the
+time since the previous poll updates an exponentially weighted arrival rate,
+and the next poll is scheduled so that it should find about `target_items`
+new items. That is well inside the new-post and recent-comment listing
+windows for busy subreddits, and rare polls for quiet ones:
+
+    interval = clamp(target_items / rate, min_interval, max_interval) * jitter
+
+A poll that reported a listing gap halves the interval, and a failed poll
+keeps the previous rate and doubles the interval. Jitter (±`jitter`)
+keeps timers from lining up, and subreddits without saved state are
+staggered over the first `min_interval`, so the crawl load is spread out
+instead of arriving at once. At most `max_concurrency` subreddits are
+crawled at the same time.
+
+The state (rate, interval, next due time per subreddit) is written to a JSON
+file after every poll, so a restarted scheduler continues with the same
+timers instead of crawling everything again:
+
+    scheduler = PollScheduler(poll, ["sgexams", "temasekpoly"])
+    scheduler.run(max_seconds=6 * 3600)
+
+`poll(name)` crawls one subreddit and returns a dict with "ok", "newPosts",
+"newComments" and "gaps".
+'''
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "300")) # Seconds; busiest subreddits are polled this often
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "21600")) # Seconds; quiet subreddits are still polled this often
+POLL_TARGET_ITEMS = float(os.getenv("POLL_TARGET_ITEMS", "60")) # New posts + comments a poll should find
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "2")) # Subreddits crawled at the same time
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1")) # Random spread of each interval (fraction)
+POLL_RATE_SMOOTHING = 0.3 # Weight of the latest poll in the arrival rate
+POLL_STATE_PATH = os.getenv("POLL_STATE_PATH", "poll_state.json")
+
+
+class PollScheduler:
+    def __init__(self, poll, names, state_path=POLL_STATE_PATH, min_interval=POLL_MIN_INTERVAL,
+                 max_interval=POLL_MAX_INTERVAL, target_items=POLL_TARGET_ITEMS, max_concurrency=POLL_CONCURRENCY,
+                 jitter=POLL_JITTER, clock=time.time):
+        self.poll = poll
+        self.names = list(names)
+        self.state_path = state_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.max_concurrency = max(1, max_concurrency)
+        self.jitter = jitter
+        self.clock = clock
+        self.polls = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event() # Set when a poll finishes or stop() is called
+        self._stopping = False
+        self.state = self._load_state()
+
+    # --- State ---
+    def _load_state(self):
+        saved = {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.error(f"Poll scheduler state {self.state_path} unreadable, starting fresh: {e}")
+        now = self.clock()
+        fresh = [name for name in self.names if name not in saved]
+        state = {name: saved[name] for name in self.names if name in saved}
+        for position, name in enumerate(fresh):
+            # Stagger new subreddits over the first interval instead of polling them all at once
+            state[name] = {"rate": None, "interval": self.min_interval, "lastPolled": None,
+                           "nextDue": now + self.min_interval * position / max(1, len(fresh)), "polls": 0}
+        return state
+
+    def save_state(self):
+        with self._lock:
+            snapshot = json.dumps(self.state, indent=1)
+        temporary = f"{self.state_path}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as f:
+                f.write(snapshot)
+            os.replace(temporary, self.state_path) # Never leave a half-written state file
+        except OSError as e:
+            logging.error(f"Failed to save poll scheduler state: {e}")
+
+    # --- Intervals ---
+    def next_interval(self, entry, result):
+        """Updates the arrival rate of `entry` from a poll result and returns the next interval in seconds."""
+        if not result.get("ok"):
+            return min(self.max_interval, entry["interval"] * 2) # Says nothing about activity; back off
+        now = self.clock()
+        items = result.get("newPosts", 0) + result.get("newComments", 0)
+        if entry["lastPolled"] is not None and now > entry["lastPolled"]:
+            observed = items / (now - entry["lastPolled"]) # Items per second
+            previous = entry["rate"]
+            entry["rate"] = observed if previous is None else (
+                POLL_RATE_SMOOTHING * observed + (1 - POLL_RATE_SMOOTHING) * previous)
+        if entry["rate"]:
+            interval = self.target_items / entry["rate"]
+        else:
+            interval = self.max_interval if entry["rate"] == 0 else entry["interval"]
+        if result.get("gaps"):
+            interval = min(interval, entry["interval"] / 2) # The listing window overflowed, come back sooner
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _finish(self, name, result):
+        with self._lock:
+            entry = self.state[name]
+            interval = self.next_interval(entry, result)
+            now = self.clock()
+            entry.update({
+                "interval": interval,
+                # A failed crawl does not advance last_timestamp, so its window is measured by the next poll
+                "lastPolled": now if result.get("ok") else entry["lastPolled"],
+                "nextDue": now + interval * random.uniform(1 - self.jitter, 1 + self.jitter),
+                "polls": entry.get("polls", 0) + 1,
+                "lastOk": bool(result.get("ok")),
+            })
+            self.polls += 1
+        rate = entry["rate"] * 3600 if entry["rate"] is not None else None
+        print(f"[{name}] Poll done: {result.get('newPosts', 0)} posts, {result.get('newComments', 0)} comments"
+              f"{', GAP' if result.get('gaps') else ''}; rate {'?' if rate is None else f'{rate:.1f}'}/h, "
+              f"next poll in {(entry['nextDue'] - now) / 60:.1f} min")
+        self.save_state()
+
+    def _run_one(self, name):
+        try:
+            result = self.poll(name) or {}
+        except Exception as e:
+            logging.exception(f"[{name}] Scheduled poll failed: {e}")
+            result = {"ok": False}
+        self._finish(name, result)
+        self._wakeup.set()
+
+    # --- Loop ---
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def run(self, max_seconds=None, max_polls=None):
+        """Polls subreddits as they come due until stop(), `max_seconds` or `max_polls`; waits for running polls."""
+        deadline = None if max_seconds is None else self.clock() + max_seconds
+        running = {} # name -> Future
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while not self._stopping:
+                now = self.clock()
+                if deadline is not None and now >= deadline:
+                    break
+                if max_polls is not None and self.polls + len(running) >= max_polls:
+                    if not running:
+                        break
+                running = {name: future for name, future in running.items() if not future.done()}
+                with self._lock:
+                    due = sorted((entry["nextDue"], name) for name, entry in self.state.items() if name not in running)
+                for next_due, name in due:
+                    if next_due > now or len(running) >= self.max_concurrency:
+                        break
+                    if max_polls is not None and self.polls + len(running) >= max_polls:
+                        break
+                    running[name] = executor.submit(self._run_one, name)
+                upcoming = [next_due for next_due, name in due if name not in running]
+                wait = min(upcoming) - now if upcoming and len(running) < self.max_concurrency else self.max_interval
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                self._wakeup.wait(max(0.05, min(wait, 60)))
+                self._wakeup.clear()
+        self.save_state()
+
+    def summary(self):
+        with self._lock:
+            return {name: {"intervalMinutes": round(entry["interval"] / 60, 1),
+                           "ratePerHour": None if entry["rate"] is None else round(entry["rate"] * 3600, 2),
+                           "polls": entry.get("polls", 0)}
+                    for name, entry in self.state.items()}
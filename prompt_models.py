@@ -0,0 +1,151 @@
+'''
+One Gemini model handle per prompt template.
+
+The prompt templates (PROMPT_COMMENT, PROMPT_SUMMARY, ...) are long fixed
+preambles. Instead of concatenating the template onto every request,
+PromptModels creates a model per template with the template as its
+system_instruction, so a call only passes the per-call text:
+
+    models = PromptModels("gemini-2.5-flash-lite")
+    models.for_template(PROMPT_COMMENT).generate_content(" Text: $...")
+
+With CONTEXT_CACHE=1, templates of at least CONTEXT_CACHE_MIN_TOKENS (the
+API's minimum for explicit caching) are uploaded once as a CachedContent and
+referenced by name. Shorter templates, which is all of the current ones, stay
+system instructions. Call close() at the end of a run to delete the caches.
+
+StubModel is a local stand-in that records the size of every per-call payload.
+Running this file prints the per-call payload for each prompt type with and
+without system instructions.
+'''
+import datetime
+import logging
+import os
+import threading
+
+import google.generativeai as genai
+
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CONTEXT_CACHE_TTL_MINUTES = int(os.getenv("CONTEXT_CACHE_TTL_MINUTES", "60"))
+
+
+class PromptModels:
+    def __init__(self, model_name, factory=None, context_cache=CONTEXT_CACHE):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._factory = factory or self._gemini_model
+        self._context_cache = context_cache and factory is None
+        self._handles = {}
+        self._cached_contents = []
+        self._lock = threading.Lock()
+
+    def _gemini_model(self, system_instruction):
+        if self._context_cache and system_instruction and len(system_instruction) // 4 + 1 >= CONTEXT_CACHE_MIN_TOKENS:
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=self.model_name,
+                    system_instruction=system_instruction,
+                    ttl=datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES),
+                )
+                self._cached_contents.append(cached)
+                return genai.GenerativeModel.from_cached_content(cached)
+            except Exception as e:
+                logging.error(f"Failed to create cached context, using a system instruction instead: {e}")
+        return genai.GenerativeModel(self.model_name, system_instruction=system_instruction)
+
+    def for_template(self, template):
+        """Returns the model handle whose system instruction is `template` (created on first use)."""
+        with self._lock:
+            handle = self._handles.get(template)
+            if handle is None:
+                handle = self._factory(template.strip() or None)
+                self._handles[template] = handle
+            return handle
+
+    def generate_content(self, prompt, **kwargs):
+        """Plain call without a system instruction (for callers that build the whole prompt themselves)."""
+        return self.for_template("").generate_content(prompt, **kwargs)
+
+    def close(self):
+        for cached in self._cached_contents:
+            try:
+                cached.delete()
+            except Exception as e:
+                logging.error(f"Failed to delete cached context {getattr(cached, 'name', '?')}: {e}")
+        self._cached_contents = []
+
+
+# Candidate finish reasons that mean the model refused to answer
+BLOCKING_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+
+
+def response_block_reason(response):
+    """
+    Name of the reason Gemini blocked the prompt or its answer, or None.
+    Reads prompt_feedback and candidates only: response.text raises
+    ValueError on blocked or empty replies.
+    """
+    feedback = getattr(response, "prompt_feedback", None)
+    reason = getattr(feedback, "block_reason", None)
+    if reason:
+        return getattr(reason, "name", str(reason))
+    for candidate in getattr(response, "candidates", None) or []:
+        finish_reason = getattr(candidate, "finish_reason", None)
+        name = getattr(finish_reason, "name", str(finish_reason))
+        if name in BLOCKING_FINISH_REASONS and not _candidate_parts(candidate):
+            return name
+    return None
+
+
+def reply_text(response):
+    """The reply text, or None if the response has no text content. Call response_block_reason() first."""
+    if response is None:
+        return None
+    candidates = getattr(response, "candidates", None)
+    if candidates is not None and not any(_candidate_parts(candidate) for candidate in candidates):
+        return None
+    try:
+        return getattr(response, "text", None) or None
+    except ValueError: # e.g. several candidates, or a part without text
+        return None
+
+
+def _candidate_parts(candidate):
+    content = getattr(candidate, "content", None)
+    return list(getattr(content, "parts", None) or [])
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.prompt_feedback = None
+        self.usage_metadata = None
+
+
+class StubModel:
+    """Local stand-in for GenerativeModel: records per-call payload sizes and returns a fixed reply."""
+
+    def __init__(self, system_instruction=None, reply='{"sentiment": 0, "emotion": "neutral", "category": "academic", "iit": "no"}'):
+        self.system_instruction = system_instruction
+        self.reply = reply
+        self.payload_sizes = [] # UTF-8 bytes of the contents sent per call (system instruction excluded)
+
+    def generate_content(self, contents, **kwargs):
+        self.payload_sizes.append(len(contents.encode("utf-8")))
+        return StubResponse(self.reply)
+
+
+if __name__ == "__main__":
+    # Compares the per-call payload with and without system instructions using stub models
+    import crawler
+
+    sample_text = " Text: $" + "The exam results came out today and I am so relieved. " * 3
+    stubs = PromptModels("stub", factory=lambda system_instruction: StubModel(system_instruction))
+    concatenated = StubModel()
+    print(f"{'prompt type':<16}{'concatenated':>14}{'per call':>10}{'saved':>8}")
+    for template, prompt_type in crawler.PROMPT_TYPES.items():
+        concatenated.generate_content(template + sample_text)
+        handle = stubs.for_template(template)
+        handle.generate_content(sample_text)
+        before, after = concatenated.payload_sizes[-1], handle.payload_sizes[-1]
+        print(f"{prompt_type:<16}{before:>14}{after:>10}{(before - after) / before:>8.0%}")
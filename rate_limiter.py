@@ -0,0 +1,197 @@
+'''
+Process-wide rate limiting and retry policy for Gemini calls, plus the shared
+Reddit API request budget.
+
+Every request first takes one token from a requests-per-minute bucket and its
+estimated prompt size from a tokens-per-minute bucket, so all worker threads
+share the same quota. When the API still answers with a quota error, the
+limiter pauses every caller for the server-provided retry delay (or an
+exponential backoff with jitter), instead of each thread sleeping blindly.
+
+Reddit requests of every crawl worker (each has its own PRAW instance) take
+a token from one REDDIT_RPM bucket, so parallel crawls stay within the
+per-client API quota together.
+
+Configuration (environment variables, 0 disables a limit):
+    GEMINI_RPM   requests per minute (default 1000)
+    GEMINI_TPM   prompt tokens per minute (default 1000000)
+    REDDIT_RPM   Reddit API requests per minute (default 100)
+'''
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # google-api-core ships with google-generativeai, but keep this module importable on its own
+    google_exceptions = None
+try:
+    from requests import exceptions as requests_exceptions
+except ImportError:
+    requests_exceptions = None
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+QUOTA_STATUS_CODES = {429}
+
+
+class EmptyResponseError(Exception):
+    """A reply without any content (and no block reason), e.g. a dropped stream; worth asking again."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Blocks until `amount` tokens are available and takes them. Returns seconds waited."""
+        amount = min(amount, self.capacity)  # a single oversized request must still be able to go through
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate_per_second
+            time.sleep(wait)
+            waited += wait
+
+
+class GeminiRateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.quota_errors = 0
+
+    def acquire(self, estimated_tokens=0):
+        """Waits for any shared cooldown, then for request and token budget."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+            waited += pause
+        if self.request_bucket:
+            waited += self.request_bucket.acquire(1)
+        if self.token_bucket and estimated_tokens:
+            waited += self.token_bucket.acquire(estimated_tokens)
+        if waited:
+            with self._lock:
+                self.throttled_seconds += waited
+        return waited
+
+    def pause(self, seconds):
+        """Holds back every caller for `seconds` (used after a quota error)."""
+        with self._lock:
+            self.quota_errors += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def error_status_code(exc):
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_quota_error(exc):
+    return error_status_code(exc) in QUOTA_STATUS_CODES
+
+
+def is_retryable_error(exc):
+    """
+    Quota, timeout and server-side errors are worth retrying; other 4xx errors
+    (bad request, permission denied, invalid key, ...) will fail the same way
+    every time. Errors without a status code are permanent (for example the
+    ValueError of a blocked reply), except network failures, timeouts and
+    EmptyResponseError.
+    """
+    if isinstance(exc, (EmptyResponseError, ConnectionError, TimeoutError)):
+        return True
+    if google_exceptions is not None and isinstance(exc, (google_exceptions.DeadlineExceeded,
+                                                          google_exceptions.Aborted,
+                                                          google_exceptions.Unknown)):
+        return True
+    if requests_exceptions is not None and isinstance(exc, (requests_exceptions.ConnectionError,
+                                                            requests_exceptions.Timeout)):
+        return True
+    code = error_status_code(exc)
+    return code in RETRYABLE_STATUS_CODES
+
+
+def retry_after_seconds(exc):
+    """Extracts a server-provided retry delay from the error, if there is one."""
+    for detail in getattr(exc, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None and (retry_delay.seconds or retry_delay.nanos):
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    header_value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if header_value:
+        try:
+            return float(header_value)
+        except ValueError:
+            pass
+
+    message = str(exc)
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", message) or re.search(r"retry in ([\d.]+)\s*s", message, re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt, base_delay=2.0, max_delay=60.0):
+    """Exponential backoff with full jitter for the given 0-based attempt."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Returns the process-wide limiter, creating it from the environment on first use."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = GeminiRateLimiter(
+                requests_per_minute=int(os.getenv("GEMINI_RPM", "1000")),
+                tokens_per_minute=int(os.getenv("GEMINI_TPM", "1000000")),
+            )
+            logging.info(f"Gemini rate limiter: {os.getenv('GEMINI_RPM', '1000')} RPM, {os.getenv('GEMINI_TPM', '1000000')} TPM")
+        return _limiter
+
+
+_reddit_bucket = None
+
+
+def get_reddit_bucket():
+    """Returns the process-wide Reddit request bucket (None when REDDIT_RPM is 0)."""
+    global _reddit_bucket
+    with _limiter_lock:
+        if _reddit_bucket is None:
+            requests_per_minute = int(os.getenv("REDDIT_RPM", "100"))
+            _reddit_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else False
+        return _reddit_bucket or None
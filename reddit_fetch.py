@@ -0,0 +1,456 @@
+'''
+Reddit fetch backends.
+
+The crawler turns submissions and comments into plain JSON records
+(post_record_from / comment_records_from). With PRAW every lazy attribute
+and every replace_more() blocks the thread, so comment trees are fetched one
+post at a time. AsyncRedditFetcher lists a subreddit's new submissions with
+asyncpraw and fetches up to ASYNC_FETCH_CONCURRENCY comment trees at once,
+yielding records as the trees complete:
+
+    fetcher = AsyncRedditFetcher()
+    for post_record, comment_records in fetcher.iter_new_posts("sgexams", last_timestamp):
+        ...
+
+asyncprawcore already paces requests by Reddit's X-Ratelimit-* headers; every
+request additionally takes a token from the shared REDDIT_RPM bucket
+(rate_limiter.get_reddit_bucket), like the PRAW instances do.
+
+Large threads hide most of their comments behind "load more" stubs
+(MoreComments), each costing a request to expand. fetch_comment_tree expands
+them within a per-post budget (MORE_COMMENTS_MAX_EXPANSIONS requests,
+MORE_COMMENTS_MAX_SECONDS seconds), shallowest stubs and highest-scoring
+branches first, and returns the stubs it did not reach so a later run can
+continue with expand_more_comments. The async path expands them the same way
+(expand_more_comments_async).
+
+RecordedReddit replays a recording (JSON of post/comment records per
+subreddit) through the same asyncpraw-shaped interface, with an optional
+simulated per-request latency, so the async path can be tested offline:
+
+    python reddit_fetch.py record sgexams TemasekPoly --out recording.json
+    python reddit_fetch.py replay recording.json --latency 0.2
+
+asyncpraw is optional (pip install asyncpraw) and only needed for live fetches.
+'''
+import argparse
+import asyncio
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from rate_limiter import get_reddit_bucket
+
+ASYNC_FETCH_CONCURRENCY = int(os.getenv("ASYNC_FETCH_CONCURRENCY", "8")) # Comment trees fetched at once per subreddit
+MORE_COMMENTS_MAX_EXPANSIONS = int(os.getenv("MORE_COMMENTS_MAX_EXPANSIONS", "32")) # "Load more" requests per post per run
+MORE_COMMENTS_MAX_SECONDS = float(os.getenv("MORE_COMMENTS_MAX_SECONDS", "60")) # Time spent expanding one post per run
+MORECHILDREN_BATCH = 100 # Comment IDs per api/morechildren request (Reddit's maximum)
+
+
+# --- Records (shared by the sync and async paths) ---
+def post_record_from(submission):
+    return {
+        "post_id": submission.id,
+        "title": submission.title,
+        "author": str(submission.author) if submission.author else "[deleted]",
+        "created_utc": submission.created_utc,
+        "body": submission.selftext,
+        "score": submission.score,
+        "url": submission.url,
+    }
+
+
+def comment_records_from(submission, all_comments, subreddit_name=""):
+    """Records of the comments in a flattened tree, skipping deleted or malformed objects."""
+    comment_records = []
+    for comment in all_comments:
+        if not hasattr(comment, 'body') or not hasattr(comment, 'id') or not hasattr(comment, 'author'):
+            logging.warning(f"[{subreddit_name}] Skipping malformed comment object in post {submission.id}")
+            continue
+        comment_records.append({
+            "comment_id": comment.id,
+            "author": str(comment.author) if comment.author else "[deleted]",
+            "body": comment.body,
+            "score": comment.score,
+            "created_utc": getattr(comment, 'created_utc', submission.created_utc), # Fallback to the post time
+        })
+    return comment_records
+
+
+# --- Bounded MoreComments expansion ---
+def is_more_stub(item):
+    return hasattr(item, "children") and not hasattr(item, "body")
+
+
+def stub_from(more, parent_scores):
+    """Plain-dict form of a MoreComments stub, stored on the post until it is expanded."""
+    return {
+        "parentId": more.parent_id,
+        "children": list(more.children or []),
+        "count": more.count or 0,
+        "depth": getattr(more, "depth", 0) or 0,
+        "parentScore": parent_scores.get(more.parent_id, 0),
+    }
+
+
+def split_comment_tree(items, parent_scores, seen):
+    """
+    Flattens comments breadth-first (following replies) into (comments, stubs).
+    Records each comment's score in `parent_scores` by fullname and skips ids in `seen`.
+    """
+    comments, stubs = [], []
+    pending = collections.deque(items)
+    while pending:
+        item = pending.popleft()
+        if is_more_stub(item):
+            stubs.append(stub_from(item, parent_scores))
+            continue
+        if getattr(item, "id", None) in seen:
+            continue
+        seen.add(item.id)
+        comments.append(item)
+        parent_scores[f"t1_{item.id}"] = getattr(item, "score", 0) or 0
+        pending.extend(getattr(item, "replies", None) or [])
+    return comments, stubs
+
+
+class MoreCommentsQueue:
+    """
+    Expansion order and budget for MoreComments stubs (dicts from stub_from),
+    shared by the PRAW and asyncpraw paths. Shallower stubs go first, then
+    those under higher-scoring parents, then the larger ones. pop() returns
+    None once `max_expansions` requests or `max_seconds` are spent.
+    """
+
+    def __init__(self, stubs, max_expansions=MORE_COMMENTS_MAX_EXPANSIONS, max_seconds=MORE_COMMENTS_MAX_SECONDS,
+                 parent_scores=None, seen=None):
+        self.max_expansions = max_expansions
+        self.deadline = time.monotonic() + max_seconds
+        self.parent_scores = {} if parent_scores is None else parent_scores
+        self.seen = set() if seen is None else seen
+        self.expansions = 0
+        self._heap = []
+        self._order = itertools.count()
+        for stub in stubs:
+            self.push(stub)
+
+    def push(self, stub):
+        heapq.heappush(self._heap, ((stub["depth"], -stub["parentScore"], -stub["count"]), next(self._order), stub))
+
+    def pop(self):
+        if not self._heap or self.expansions >= self.max_expansions or time.monotonic() >= self.deadline:
+            return None
+        return heapq.heappop(self._heap)[2]
+
+    def expanded(self, stub, items):
+        """Records the items a request for `stub` returned and queues their stubs. Returns the new comments."""
+        self.expansions += 1
+        if stub["children"][MORECHILDREN_BATCH:]:
+            rest = stub["children"][MORECHILDREN_BATCH:]
+            self.push({**stub, "children": rest, "count": min(stub["count"], len(rest))})
+        comments, stubs = split_comment_tree(items, self.parent_scores, self.seen)
+        for new_stub in stubs:
+            self.push(new_stub)
+        return comments
+
+    def remaining(self):
+        return [stub for _, _, stub in sorted(self._heap, key=lambda entry: entry[:2])]
+
+
+def more_comments_request(submission_id, stub, sort):
+    """(method, path, keyword arguments) of the Reddit request that expands `stub`."""
+    if stub["children"]:
+        return "post", "api/morechildren/", {"data": {
+            "children": ",".join(stub["children"][:MORECHILDREN_BATCH]), "link_id": f"t3_{submission_id}", "sort": sort}}
+    # "Continue this thread": load the parent comment's subtree
+    comment_id = stub["parentId"].split("_", 1)[1]
+    return "get", f"comments/{submission_id}/_/{comment_id}", {"params": {"limit": 500, "sort": sort}}
+
+
+def more_comments_items(method, response):
+    if method == "post":
+        return response
+    _, listing = response
+    return [reply for parent in listing.children for reply in (getattr(parent, "replies", None) or [])]
+
+
+def expand_more_comments(reddit, submission_id, stubs, max_expansions=MORE_COMMENTS_MAX_EXPANSIONS,
+                         max_seconds=MORE_COMMENTS_MAX_SECONDS, parent_scores=None, seen=None, sort="confidence"):
+    """
+    Expands MoreComments stubs with a PRAW client in MoreCommentsQueue order,
+    within the budget. A failed request puts its stub back and ends the
+    expansion. Returns (comments, remaining_stubs, expansions).
+    """
+    pending = MoreCommentsQueue(stubs, max_expansions, max_seconds, parent_scores, seen)
+    comments = []
+    while (stub := pending.pop()) is not None:
+        method, path, kwargs = more_comments_request(submission_id, stub, sort)
+        try:
+            items = more_comments_items(method, getattr(reddit, method)(path, **kwargs))
+        except Exception as e:
+            logging.warning(f"Expanding comments of {submission_id} under {stub['parentId']} failed: {e}")
+            pending.push(stub)
+            break
+        comments.extend(pending.expanded(stub, items))
+    return comments, pending.remaining(), pending.expansions
+
+
+async def expand_more_comments_async(reddit, submission_id, stubs, max_expansions=MORE_COMMENTS_MAX_EXPANSIONS,
+                                     max_seconds=MORE_COMMENTS_MAX_SECONDS, parent_scores=None, seen=None, sort="confidence"):
+    """expand_more_comments with an asyncpraw client."""
+    pending = MoreCommentsQueue(stubs, max_expansions, max_seconds, parent_scores, seen)
+    comments = []
+    while (stub := pending.pop()) is not None:
+        method, path, kwargs = more_comments_request(submission_id, stub, sort)
+        try:
+            items = more_comments_items(method, await getattr(reddit, method)(path, **kwargs))
+        except Exception as e:
+            logging.warning(f"Expanding comments of {submission_id} under {stub['parentId']} failed: {e}")
+            pending.push(stub)
+            break
+        comments.extend(pending.expanded(stub, items))
+    return comments, pending.remaining(), pending.expansions
+
+
+def fetch_comment_tree(reddit, submission, max_expansions=MORE_COMMENTS_MAX_EXPANSIONS, max_seconds=MORE_COMMENTS_MAX_SECONDS):
+    """
+    Flattened comments of a PRAW submission, with its "load more" stubs
+    expanded within the budget (expand_more_comments).
+    Returns (comments, remaining_stubs, expansions).
+    """
+    seen = set()
+    parent_scores = {f"t3_{submission.id}": submission.score}
+    comments, stubs = split_comment_tree(list(submission.comments), parent_scores, seen)
+    more, remaining, expansions = expand_more_comments(
+        reddit, submission.id, stubs, max_expansions, max_seconds, parent_scores, seen,
+        sort=getattr(submission, "comment_sort", "confidence"))
+    return comments + more, remaining, expansions
+
+
+# --- asyncpraw client ---
+def make_async_reddit():
+    """asyncpraw client whose requests also draw from the shared Reddit request bucket."""
+    try:
+        import asyncpraw
+        import asyncprawcore
+    except ImportError:
+        raise RuntimeError("The async fetch backend needs the 'asyncpraw' package (pip install asyncpraw).")
+
+    class SharedBudgetAsyncRequestor(asyncprawcore.Requestor):
+        async def request(self, *args, **kwargs):
+            bucket = get_reddit_bucket()
+            if bucket is not None:
+                await asyncio.to_thread(bucket.acquire, 1)
+            return await super().request(*args, **kwargs)
+
+    return asyncpraw.Reddit(
+        client_id=os.getenv('REDDIT_CLIENT_ID'),
+        client_secret=os.getenv('REDDIT_CLIENT_SECRET'),
+        user_agent=os.getenv('REDDIT_USER_AGENT'),
+        requestor_class=SharedBudgetAsyncRequestor,
+    )
+
+
+_FETCH_DONE = object()
+
+
+class AsyncRedditFetcher:
+    def __init__(self, client_factory=make_async_reddit, concurrency=ASYNC_FETCH_CONCURRENCY):
+        # Called once per iter_new_posts() on its own event loop (aiohttp sessions are bound to a loop)
+        self.client_factory = client_factory
+        self.concurrency = max(1, concurrency)
+
+    async def _fetch_tree(self, reddit, submission, subreddit_name, semaphore):
+        """(post_record, comment_records) of one submission, or None if fetching it failed."""
+        try:
+            async with semaphore:
+                print(f"[{subreddit_name}] Fetching comments for post {submission.id}...")
+                await submission.load()
+                # Same budget and order as fetch_comment_tree; skipped stubs are resumed by a later run
+                seen = set()
+                parent_scores = {f"t3_{submission.id}": submission.score}
+                all_comments, stubs = split_comment_tree(list(submission.comments), parent_scores, seen)
+                more, skipped, _ = await expand_more_comments_async(
+                    reddit, submission.id, stubs, parent_scores=parent_scores, seen=seen,
+                    sort=getattr(submission, "comment_sort", "confidence"))
+                all_comments += more
+        except Exception as e:
+            logging.error(f"[{subreddit_name}] Error fetching comments of submission {submission.id}: {e}")
+            print(f"[{subreddit_name}] Error on {submission.id}: {e}")
+            return None
+        print(f"[{subreddit_name}] Got {len(all_comments)} comments for post {submission.id}.")
+        post_record = post_record_from(submission)
+        if skipped:
+            post_record["pendingMoreComments"] = skipped
+        return post_record, comment_records_from(submission, all_comments, subreddit_name)
+
+    async def _fetch_new_posts(self, subreddit_name, last_timestamp, limit, emit, listed):
+        reddit = self.client_factory()
+        try:
+            subreddit = await reddit.subreddit(subreddit_name)
+            submissions = []
+            async for submission in subreddit.new(limit=limit):
+                if submission.created_utc <= last_timestamp:
+                    continue # Skip already processed posts
+                if listed is not None:
+                    listed(submission)
+                submissions.append(submission)
+            print(f"[{subreddit_name}] {len(submissions)} new submissions, fetching up to {self.concurrency} comment trees at once...")
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+            for next_done in asyncio.as_completed([self._fetch_tree(reddit, submission, subreddit_name, semaphore) for submission in submissions]):
+                result = await next_done
+                if result is not None:
+                    emit(result)
+        finally:
+            await reddit.close()
+
+    def iter_new_posts(self, subreddit_name, last_timestamp, limit=100, listed=None):
+        """
+        Yields (post_record, comment_records) for submissions newer than `last_timestamp`,
+        in the order their comment trees finish. `listed(submission)` is called for
+        every new submission in the listing, before its tree is fetched. The event
+        loop runs on a helper thread, so this can be consumed from ordinary code.
+        """
+        results = queue.Queue()
+
+        def run():
+            try:
+                asyncio.run(self._fetch_new_posts(subreddit_name, last_timestamp, limit, results.put, listed))
+            except BaseException as e:
+                results.put(e)
+            results.put(_FETCH_DONE)
+
+        thread = threading.Thread(target=run, name=f"async-fetch-{subreddit_name}", daemon=True)
+        thread.start()
+        while True:
+            item = results.get()
+            if item is _FETCH_DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        thread.join()
+
+
+# --- Recorded-response fake (offline tests) ---
+class _Recorded:
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+class RecordedCommentForest:
+    def __init__(self, reddit, comments):
+        self._reddit = reddit
+        self._comments = comments
+
+    def __iter__(self):
+        return iter(self._comments)
+
+    def list(self):
+        return list(self._comments)
+
+
+class RecordedSubmission:
+    def __init__(self, reddit, post_record, comment_records):
+        self._reddit = reddit
+        self.id = post_record["post_id"]
+        self.title = post_record["title"]
+        self.author = post_record["author"]
+        self.created_utc = post_record["created_utc"]
+        self.selftext = post_record["body"]
+        self.score = post_record["score"]
+        self.url = post_record["url"]
+        self.comments = RecordedCommentForest(reddit, [
+            _Recorded({"id": c["comment_id"], "author": c["author"], "body": c["body"],
+                       "score": c["score"], "created_utc": c["created_utc"]})
+            for c in comment_records
+        ])
+
+    async def load(self):
+        await self._reddit.request()
+
+
+class RecordedSubreddit:
+    def __init__(self, reddit, posts):
+        self._reddit = reddit
+        self._posts = posts
+
+    async def new(self, limit=100):
+        await self._reddit.request()
+        ordered = sorted(self._posts, key=lambda post: post["post"]["created_utc"], reverse=True)
+        for post in ordered[:limit]:
+            yield RecordedSubmission(self._reddit, post["post"], post["comments"])
+
+
+class RecordedReddit:
+    """asyncpraw-shaped client serving a recording: {subreddit: [{"post": ..., "comments": [...]}, ...]}."""
+
+    def __init__(self, recording, latency=0.0):
+        self.recording = {name.lower(): posts for name, posts in recording.items()}
+        self.latency = latency
+        self.requests = 0
+
+    @classmethod
+    def from_file(cls, path, latency=0.0):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), latency=latency)
+
+    async def request(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def subreddit(self, display_name, fetch=False):
+        return RecordedSubreddit(self, self.recording.get(display_name.lower(), []))
+
+    async def close(self):
+        pass
+
+
+def record(subreddit_names, path, limit=100):
+    """Fetches the newest posts of each subreddit live and writes them as a recording."""
+    fetcher = AsyncRedditFetcher()
+    recording = {}
+    for subreddit_name in subreddit_names:
+        recording[subreddit_name] = [
+            {"post": post_record, "comments": comment_records}
+            for post_record, comment_records in fetcher.iter_new_posts(subreddit_name, 0, limit=limit)
+        ]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(recording, f, ensure_ascii=False, indent=1)
+    return recording
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record Reddit responses, or replay a recording to time the async fetch path.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="Fetch subreddits live (needs asyncpraw and Reddit credentials)")
+    record_parser.add_argument("subreddits", nargs="+")
+    record_parser.add_argument("--out", default="reddit_recording.json")
+    record_parser.add_argument("--limit", type=int, default=100)
+    replay_parser = commands.add_parser("replay", help="Time sequential vs concurrent tree fetches on a recording")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per Reddit request")
+    replay_parser.add_argument("--concurrency", type=int, default=ASYNC_FETCH_CONCURRENCY)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from dotenv import load_dotenv
+        load_dotenv()
+        recording = record(args.subreddits, args.out, limit=args.limit)
+        print(f"Recorded {sum(len(posts) for posts in recording.values())} posts to {args.out}")
+    else:
+        with open(args.recording, "r", encoding="utf-8") as f:
+            recording = json.load(f)
+        for concurrency in (1, args.concurrency):
+            fetcher = AsyncRedditFetcher(lambda: RecordedReddit(recording, latency=args.latency), concurrency=concurrency)
+            start = time.time()
+            posts = sum(1 for name in recording for _ in fetcher.iter_new_posts(name, 0))
+            print(f"concurrency {concurrency}: {posts} posts in {time.time() - start:.2f}s")